@@ -0,0 +1,185 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPOSITORY)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from generate import Settings, generate  # noqa: E402
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    # the largest of this process and every worker it waited for, kilobytes on linux
+    usage = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return round(usage / 1024, 1)
+
+
+def link(path, folder):
+    target = os.path.join(folder, os.path.basename(path))
+    try:
+        os.link(path, target)
+    except OSError:
+        shutil.copy(path, target)
+
+
+def run_case(case):
+    # Runs in its own process, so the peak memory of one case doesn't carry over into the next
+    from intermediate import run
+    from pipeline import run_pipeline
+    from uploader import Uploader, SQLiteBackend
+
+    work = tempfile.mkdtemp(prefix="pubmed_benchmark_", dir=case.get("work_dir"))
+    os.chdir(work)
+    for folder in ("temporary", "in/converted_xml", "out"):
+        os.makedirs(folder)
+    for path in case["files"]:
+        link(path, "in")
+
+    bigquery = case["conversion"] == "bigquery"
+    output = {"format": case["format"], "layout": case["layout"], "bg_load_mode": "batched", "spool_dir": "spool"}
+    uploader = Uploader(SQLiteBackend(os.path.join(work, "stand_in.db")), "spool", max_files=1,
+                        metrics_path=os.path.join(work, "metrics.jsonl"))
+    run_kwargs = dict(choice=case["choice"], bigquery=bigquery, bg_upload_type="append", bg_project_id="benchmark",
+                      bg_data_set="benchmark", bg_table_name="pubmed", in_dir=os.path.join(work, "in"),
+                      out_dir=os.path.join(work, "out"), xml_parser=case["xml_parser"], output=output,
+                      metrics_path=os.path.join(work, "metrics.jsonl"))
+
+    names = [os.path.basename(path) for path in case["files"]]
+    start = time.time()
+    if case.get("workers"):
+        run_pipeline(names, run_kwargs, uploader if bigquery else None, parse_workers=case["workers"],
+                     upload_workers=1)
+    else:
+        run(names[0], split_workers=case.get("split_workers"), split_min_mb=0, **run_kwargs)
+    if bigquery:
+        uploader.flush(force=True)
+    seconds = time.time() - start
+
+    with open("metrics.jsonl", "r", encoding="utf-8") as file:
+        records = [json.loads(line) for line in file]
+    files = [record for record in records if record.get("event") == "file"]
+
+    stages = {}
+    for record in files:
+        for stage, stage_seconds in record["stages"].items():
+            stages[stage] = stages.get(stage, 0) + stage_seconds
+    stages["load"] = sum(record["seconds"] for record in records if record.get("event") == "load")
+
+    os.chdir(REPOSITORY)
+    shutil.rmtree(work, ignore_errors=True)
+
+    return {"name": case["name"], "seconds": seconds, "files": len(files),
+            "failed": sum(record["status"] != "ok" for record in files),
+            "articles": sum(record["records"] for record in files),
+            "bytes_in": sum(os.path.getsize(path) for path in case["files"]),
+            "bytes_out": sum(record["bytes_out"] for record in files),
+            "peak_rss_mb": max([record["peak_rss_mb"] or 0 for record in files] + [peak_rss_mb() or 0]),
+            "stages": {stage: round(stage_seconds, 3) for stage, stage_seconds in stages.items()}}
+
+
+def measure(case):
+    completed = subprocess.run([sys.executable, os.path.abspath(__file__), "--case", json.dumps(case)],
+                               stdout=subprocess.PIPE, universal_newlines=True, cwd=REPOSITORY)
+    if completed.returncode != 0:
+        return {"name": case["name"], "error": completed.returncode}
+    # run() prints its progress, the result is the last line
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def create_cases(options, single, files):
+    common = {"conversion": options.conversion, "xml_parser": options.xml_parser, "work_dir": options.work_dir}
+    cases = []
+    for choice in options.choices:
+        for output_format in options.formats:
+            for layout in options.layouts:
+                cases.append(dict(common, name=f"{choice} {output_format} {layout}", choice=choice,
+                                  format=output_format, layout=layout, files=[single]))
+
+    # scaling: the same files over more parse processes, and one file cut into more ranges
+    for workers in options.workers:
+        cases.append(dict(common, name=f"pipeline x{workers} {options.scaling_choice}", choice=options.scaling_choice,
+                          format=options.formats[0], layout="flat", files=files, workers=workers))
+    for workers in options.workers:
+        if workers > 1:
+            cases.append(dict(common, name=f"split x{workers} {options.scaling_choice}", choice=options.scaling_choice,
+                              format=options.formats[0], layout="flat", files=[single], split_workers=workers))
+    return cases
+
+
+def report(result):
+    if "error" in result:
+        print(f"{result['name']:<32} failed with exit code {result['error']}")
+        return
+
+    seconds = result["seconds"] or 1e-9
+    stages = ", ".join(f"{stage} {stage_seconds}" for stage, stage_seconds in result["stages"].items())
+    print(f"{result['name']:<32} {round(seconds, 2):>8} s {round(result['articles'] / seconds):>9} articles/s "
+          f"{round(result['bytes_in'] / seconds / 1024 / 1024, 2):>8} MB/s {result['peak_rss_mb']:>8} MB peak   "
+          f"{stages}")
+
+
+def arguments(args):
+    parser = argparse.ArgumentParser(description="Benchmarks the engines and output modes on synthetic PubMed xml")
+    parser.add_argument("--articles", type=int, default=20000, help="articles per file")
+    parser.add_argument("--files", type=int, default=4, help="files of the pipeline runs")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--choices", nargs="+", default=["disk", "memory", "columnar"])
+    parser.add_argument("--formats", nargs="+", default=["csv", "parquet"])
+    parser.add_argument("--layouts", nargs="+", default=["flat", "nested"])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--scaling-choice", default="disk")
+    parser.add_argument("--xml-parser", default="stream")
+    parser.add_argument("--conversion", choices=["bigquery", "csv"], default="bigquery",
+                        help="bigquery loads into a local SQLite stand-in")
+    parser.add_argument("--data-dir", help="keeps the generated xml here instead of a temporary folder")
+    parser.add_argument("--work-dir", help="where every case gets its temporary working folder")
+    parser.add_argument("--results", help="appends every result to this JSON lines file")
+    parser.add_argument("--case", help=argparse.SUPPRESS)
+    return parser.parse_args(args)
+
+
+def main(args):
+    options = arguments(args)
+    if options.case:
+        print(json.dumps(run_case(json.loads(options.case))))
+        return
+
+    data_dir = options.data_dir or tempfile.mkdtemp(prefix="pubmed_benchmark_data_")
+    os.makedirs(data_dir, exist_ok=True)
+
+    files = []
+    for number in range(options.files):
+        path = os.path.join(data_dir, f"bench_{options.seed}_{options.articles}_{number + 1:04d}.xml")
+        if not os.path.exists(path):
+            generate(path, Settings(articles=options.articles, seed=options.seed + number,
+                                    start_pmid=1 + number * options.articles))
+        files.append(path)
+
+    print(f"{len(files)} file(s) of {options.articles} articles in {data_dir}, "
+          f"{round(os.path.getsize(files[0]) / 1024 / 1024, 1)} MB each, {os.cpu_count()} cpu(s)")
+
+    for case in create_cases(options, files[0], files):
+        result = measure(case)
+        report(result)
+        if options.results:
+            with open(options.results, "a", encoding="utf-8") as file:
+                file.write(json.dumps(dict(result, seed=options.seed, articles_per_file=options.articles)) + "\n")
+
+    if not options.data_dir:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,139 @@
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPOSITORY)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from generate import Settings, generate  # noqa: E402
+from intermediate import iter_articles  # noqa: E402
+from fields import extract_record, major_descriptor, author_list, create_date, check_article, create_date_revised, \
+    create_issn, create_year_month, create_title, create_affiliation  # noqa: E402
+
+
+def legacy_extract_record(value):
+    # threads.extract_record before fields.py, written out by hand with the helpers it called
+    PMID = int(value.get("MedlineCitation").get("PMID").get("#text"))
+    DescriptorUIDList = value.get("MedlineCitation").get("MeshHeadingList")
+
+    ArticleTitle = value.get("MedlineCitation").get("Article").get('ArticleTitle')
+
+    DateCreated = create_date(value.get("MedlineCitation").get("DateCompleted"))
+
+    AuthorList = value.get("MedlineCitation").get("Article").get("AuthorList")
+
+    Author = author_list(AuthorList)
+
+    DateRevised = create_date_revised(value.get("MedlineCitation").get("DateRevised"))
+
+    ISSN = value.get("MedlineCitation").get("Article").get('Journal').get("ISSN")
+
+    issn, issn_type = create_issn(ISSN)
+
+    CitedMedium = value.get("MedlineCitation").get("Article").get("Journal").get("JournalIssue").get(
+        "@CitedMedium")
+    Volume = value.get("MedlineCitation").get("Article").get("Journal").get("JournalIssue").get("Volume")
+    Issue = value.get("MedlineCitation").get("Article").get("Journal").get("JournalIssue").get("Issue")
+    year_month = value.get("MedlineCitation").get("Article").get("Journal").get("JournalIssue").get(
+        "PubDate")
+
+    Year, Month = create_year_month(year_month)
+
+    Title = value.get("MedlineCitation").get("Article").get('Journal').get("Title")
+    ISOAbbreviation = value.get("MedlineCitation").get("Article").get('Journal').get("ISOAbbreviation")
+    NlmUniqueId = value.get("MedlineCitation").get("MedlineJournalInfo").get("NlmUniqueID")
+    PublicationTypeList = value.get("MedlineCitation").get("Article").get("PublicationTypeList").get(
+        "PublicationType")
+
+    if type(PublicationTypeList) is not list:
+        PublicationTypeList = [PublicationTypeList]
+
+    if type(Author) is not list:
+        Author = [Author]
+
+    mesh_rows = []
+    if DescriptorUIDList is not None:
+        DescriptorUIDList = DescriptorUIDList.get("MeshHeading")
+
+        if type(DescriptorUIDList) is not list:
+            DescriptorUIDList = [DescriptorUIDList]
+
+        for description in DescriptorUIDList:
+            major = str(major_descriptor(description.get("DescriptorName").get("@MajorTopicYN")))
+            mesh_rows.append((PMID, description.get("DescriptorName").get("@UI"), major))
+
+    ArticleTitle = check_article(ArticleTitle)
+    Title = create_title(Title)
+    article_rows = [(PMID, ArticleTitle, DateCreated, DateRevised, issn, issn_type, CitedMedium, Volume, Issue,
+                     Year, Month, Title, ISOAbbreviation, NlmUniqueId)]
+
+    publication_rows = []
+    count = 1
+    for publication in PublicationTypeList:
+        publication_rows.append((PMID, publication.get("#text"), publication.get("@UI"), count))
+        count += 1
+
+    author_rows = []
+    count = 1  # For author's ordinality
+    for author in Author:
+        Affiliation = create_affiliation(author.get("AffiliationInfo"))
+        if Affiliation is not None:
+            count_1 = 1  # For affiliation's ordinality
+            for affiliation in Affiliation:
+                author_rows.append((PMID, count, author.get("Initials"), author.get("ForeName"),
+                                    author.get("LastName"), count_1, affiliation.get("Affiliation")))
+                count_1 += 1
+
+        else:
+            author_rows.append((PMID, count, author.get("Initials"), author.get("ForeName"), author.get("LastName"),
+                                0, None))
+        count += 1
+
+    return mesh_rows, article_rows, publication_rows, author_rows
+
+
+def per_record(functions, articles, rounds):
+    # Best round of every function in microseconds per record. The rounds take turns, so a busy moment of the machine
+    # doesn't land on one function only; the records are parsed beforehand so only extraction is timed
+    best = {}
+    for _ in range(rounds):
+        for name, function in functions.items():
+            begin = time.perf_counter()
+            for value in articles:
+                function(value)
+            seconds = time.perf_counter() - begin
+            best[name] = min(best.get(name, seconds), seconds)
+    return {name: seconds / len(articles) * 1e6 for name, seconds in best.items()}
+
+
+def arguments(args):
+    parser = argparse.ArgumentParser(description="Compares the compiled field extractor with the hand written one")
+    parser.add_argument("--articles", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--rounds", type=int, default=10)
+    return parser.parse_args(args)
+
+
+def main(args):
+    options = arguments(args)
+    with tempfile.TemporaryDirectory(prefix="pubmed_extract_") as folder:
+        generate(os.path.join(folder, "extract.xml"), Settings(articles=options.articles, seed=options.seed))
+        articles = list(iter_articles("extract.xml", folder))
+
+    mismatches = sum(legacy_extract_record(value) != extract_record(value) for value in articles)
+    if mismatches:
+        print(f"{mismatches} of {len(articles)} records come out differently")
+        sys.exit(1)
+
+    results = per_record({"legacy": legacy_extract_record, "compiled": extract_record}, articles, options.rounds)
+    legacy, compiled = results["legacy"], results["compiled"]
+    print(f"{len(articles)} records, best of {options.rounds} rounds")
+    print(f"hand written {round(legacy, 2):>8} us/record")
+    print(f"compiled     {round(compiled, 2):>8} us/record   {round(legacy / compiled, 2)}x")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
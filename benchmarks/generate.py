@@ -0,0 +1,210 @@
+import os
+import sys
+import gzip
+import random
+import argparse
+from xml.sax.saxutils import escape
+
+HEADER = '<?xml version="1.0" encoding="utf-8"?>\n' \
+         '<!DOCTYPE PubmedArticleSet PUBLIC "-//NLM//DTD PubMedArticle, 1st January 2019//EN" ' \
+         '"https://dtd.nlm.nih.gov/ncbi/pubmed/out/pubmed_190101.dtd">\n<PubmedArticleSet>\n'
+MONTHS = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+PUBLICATION_TYPES = [("D016428", "Journal Article"), ("D016454", "Review"), ("D013485", "Research Support, Non-U.S. "
+                     "Gov't"), ("D016449", "Randomized Controlled Trial"), ("D002363", "Case Reports"),
+                     ("D017418", "Meta-Analysis"), ("D016422", "Letter"), ("D016421", "Editorial")]
+WORDS = ["cell", "patients", "protein", "expression", "analysis", "clinical", "treatment", "study", "gene", "risk",
+         "cancer", "effect", "response", "model", "receptor", "associated", "disease", "signaling", "human", "acute",
+         "β-adrenergic", "naïve", "in vivo", "α-synuclein", "Ca2+", "&"]
+MARKUP = ["<i>in vitro</i>", "CO<sub>2</sub>", "<sup>18</sup>F", "<b>Results</b>"]
+COUNTRIES = ["USA", "China", "Germany", "Japan", "United Kingdom", "France", "Brazil", "India", "Canada", "Italy"]
+
+
+class Settings:
+    def __init__(self, articles=10000, seed=1, start_pmid=1, authors=(1, 8), affiliations=(0, 3), mesh=(0, 15),
+                 publication_types=(1, 3), abstract_words=(0, 250), medline_date_rate=0.1, missing_rate=0.05,
+                 collective_rate=0.02, delete_rate=0.0):
+        self.articles = articles
+        self.seed = seed
+        self.start_pmid = start_pmid
+        self.authors = authors
+        self.affiliations = affiliations
+        self.mesh = mesh
+        self.publication_types = publication_types
+        self.abstract_words = abstract_words
+        self.medline_date_rate = medline_date_rate
+        self.missing_rate = missing_rate
+        self.collective_rate = collective_rate
+        self.delete_rate = delete_rate
+
+
+def text(rng, low, high, markup=False):
+    # titles and abstracts get the inline tags PubMed has in them, which turn them into mixed content
+    words = [escape(rng.choice(WORDS)) for _ in range(rng.randint(low, high))]
+    if markup and words and rng.random() < 0.1:
+        words[rng.randrange(len(words))] = rng.choice(MARKUP)
+    return " ".join(words)
+
+
+def missing(rng, settings):
+    return rng.random() < settings.missing_rate
+
+
+def date(tag, year, rng):
+    return f"<{tag}><Year>{year}</Year><Month>{rng.randint(1, 12):02d}</Month><Day>{rng.randint(1, 28):02d}</Day>" \
+           f"</{tag}>"
+
+
+def author(rng, settings, number):
+    if rng.random() < settings.collective_rate:
+        return f'<Author ValidYN="Y"><CollectiveName>{text(rng, 2, 5)} Group</CollectiveName></Author>'
+
+    parts = [f'<Author ValidYN="Y"><LastName>Last{rng.randint(1, 5000)}</LastName>']
+    if not missing(rng, settings):
+        fore_name = f"Fore{rng.randint(1, 2000)}"
+        parts.append(f"<ForeName>{fore_name}</ForeName><Initials>{fore_name[0]}{chr(65 + number % 26)}</Initials>")
+
+    for _ in range(rng.randint(*settings.affiliations)):
+        parts.append(f"<AffiliationInfo><Affiliation>Department of {text(rng, 1, 3)}, University {rng.randint(1, 900)}"
+                     f", {rng.choice(COUNTRIES)}.</Affiliation></AffiliationInfo>")
+    parts.append("</Author>")
+    return "".join(parts)
+
+
+def pub_date(rng, settings, year):
+    if rng.random() < settings.medline_date_rate:
+        # the forms create_year_month has to deal with: "1998 Dec-1999 Jan", "2001 Spring", "2001"
+        medline = rng.choice([f"{year - 1} Dec-{year} Jan", f"{year} Spring", f"{year}", f"{year} Jan-Feb"])
+        return f"<PubDate><MedlineDate>{medline}</MedlineDate></PubDate>"
+
+    if missing(rng, settings):
+        return f"<PubDate><Year>{year}</Year></PubDate>"
+    return f"<PubDate><Year>{year}</Year><Month>{rng.choice(MONTHS)}</Month></PubDate>"
+
+
+def article(rng, settings, pmid):
+    year = rng.randint(1950, 2024)
+    journal = rng.randint(1, 5000)
+    parts = [f'<PubmedArticle><MedlineCitation Status="MEDLINE" Owner="NLM"><PMID Version="1">{pmid}</PMID>']
+
+    if not missing(rng, settings):
+        parts.append(date("DateCompleted", year, rng))
+    if not missing(rng, settings):
+        parts.append(date("DateRevised", min(year + rng.randint(0, 10), 2024), rng))
+
+    parts.append('<Article PubModel="Print-Electronic"><Journal>')
+    if not missing(rng, settings):
+        parts.append(f'<ISSN IssnType="{rng.choice(["Print", "Electronic"])}">{journal:04d}-{journal % 9999:04d}'
+                     f'</ISSN>')
+    parts.append(f'<JournalIssue CitedMedium="{rng.choice(["Print", "Internet"])}">')
+    if not missing(rng, settings):
+        parts.append(f"<Volume>{rng.randint(1, 300)}</Volume>")
+    if not missing(rng, settings):
+        parts.append(f"<Issue>{rng.randint(1, 12)}</Issue>")
+    parts.append(pub_date(rng, settings, year))
+    parts.append(f"</JournalIssue><Title>Journal of {text(rng, 1, 4)} {journal}</Title>")
+    if not missing(rng, settings):
+        parts.append(f"<ISOAbbreviation>J {journal}</ISOAbbreviation>")
+    parts.append("</Journal>")
+
+    title = text(rng, 5, 20, markup=True)
+    if rng.random() < 0.05:
+        title = f"[{title}]"  # translated titles come in brackets
+    parts.append(f"<ArticleTitle>{title}</ArticleTitle>")
+
+    words = rng.randint(*settings.abstract_words)
+    if words:
+        parts.append(f"<Abstract><AbstractText>{text(rng, words, words, markup=True)}</AbstractText></Abstract>")
+
+    if not missing(rng, settings):
+        parts.append('<AuthorList CompleteYN="Y">')
+        parts.extend(author(rng, settings, number) for number in range(rng.randint(*settings.authors)))
+        parts.append("</AuthorList>")
+
+    parts.append("<Language>eng</Language><PublicationTypeList>")
+    for ui, name in rng.sample(PUBLICATION_TYPES, rng.randint(*settings.publication_types)):
+        parts.append(f'<PublicationType UI="{ui}">{escape(name)}</PublicationType>')
+    parts.append("</PublicationTypeList></Article>")
+
+    parts.append(f"<MedlineJournalInfo><Country>{rng.choice(COUNTRIES)}</Country><MedlineTA>J {journal}</MedlineTA>"
+                 f"<NlmUniqueID>{journal:07d}</NlmUniqueID></MedlineJournalInfo>")
+
+    headings = rng.randint(*settings.mesh)
+    if headings and not missing(rng, settings):
+        parts.append("<MeshHeadingList>")
+        for descriptor in rng.sample(range(1, 30000), headings):
+            parts.append(f'<MeshHeading><DescriptorName UI="D{descriptor:06d}" MajorTopicYN="{rng.choice("YNN")}">'
+                         f'{text(rng, 1, 3)}</DescriptorName>')
+            if rng.random() < 0.3:
+                parts.append(f'<QualifierName UI="Q{rng.randint(1, 999):06d}" MajorTopicYN="N">metabolism'
+                             f'</QualifierName>')
+            parts.append("</MeshHeading>")
+        parts.append("</MeshHeadingList>")
+
+    parts.append(f'</MedlineCitation><PubmedData><PublicationStatus>ppublish</PublicationStatus><ArticleIdList>'
+                 f'<ArticleId IdType="pubmed">{pmid}</ArticleId><ArticleId IdType="doi">10.{journal}/{pmid}'
+                 f'</ArticleId></ArticleIdList></PubmedData></PubmedArticle>\n')
+    return "".join(parts)
+
+
+def generate(path, settings):
+    # Same seed, same settings, same file; articles are written one at a time so any size fits in memory
+    rng = random.Random(settings.seed)
+    deletes = random.Random(-settings.seed)  # its own stream, the articles don't change with delete_rate
+    opener = gzip.open if path.endswith(".gz") else open
+
+    deleted = []
+    with opener(path, "wt", encoding="utf-8") as file:
+        file.write(HEADER)
+        for number in range(settings.articles):
+            pmid = settings.start_pmid + number
+            file.write(article(rng, settings, pmid))
+            if deletes.random() < settings.delete_rate:
+                deleted.append(deletes.randint(1, pmid))
+
+        if deleted:
+            file.write("<DeleteCitation>" + "".join(f'<PMID Version="1">{pmid}</PMID>' for pmid in deleted) +
+                       "</DeleteCitation>\n")
+        file.write("</PubmedArticleSet>\n")
+
+    return path
+
+
+def pair(value):
+    low, _, high = value.partition(",")
+    return int(low), int(high or low)
+
+
+def arguments(args):
+    parser = argparse.ArgumentParser(description="Writes synthetic PubmedArticleSet xml files")
+    parser.add_argument("out_dir")
+    parser.add_argument("--files", type=int, default=1)
+    parser.add_argument("--articles", type=int, default=10000, help="articles per file")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--authors", type=pair, default=(1, 8), help="min,max authors per article")
+    parser.add_argument("--affiliations", type=pair, default=(0, 3), help="min,max affiliations per author")
+    parser.add_argument("--mesh", type=pair, default=(0, 15), help="min,max mesh headings per article")
+    parser.add_argument("--abstract-words", type=pair, default=(0, 250))
+    parser.add_argument("--medline-date-rate", type=float, default=0.1)
+    parser.add_argument("--missing-rate", type=float, default=0.05, help="chance of every optional field missing")
+    parser.add_argument("--delete-rate", type=float, default=0.0, help="DeleteCitation PMIDs per article")
+    parser.add_argument("--gzip", action="store_true")
+    return parser.parse_args(args)
+
+
+def main(args):
+    options = arguments(args)
+    os.makedirs(options.out_dir, exist_ok=True)
+
+    for number in range(options.files):
+        settings = Settings(articles=options.articles, seed=options.seed + number,
+                            start_pmid=1 + number * options.articles, authors=options.authors,
+                            affiliations=options.affiliations, mesh=options.mesh,
+                            abstract_words=options.abstract_words, medline_date_rate=options.medline_date_rate,
+                            missing_rate=options.missing_rate, delete_rate=options.delete_rate)
+        extension = ".xml.gz" if options.gzip else ".xml"
+        path = generate(os.path.join(options.out_dir, f"pubmed_synthetic_{number + 1:04d}{extension}"), settings)
+        print(path, os.path.getsize(path), "bytes")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,113 @@
+import logging
+import time
+import metrics
+from threads import extract_record, create_mesh_csv, create_csv, upload_frames, output_settings, upload_nested, \
+    staging_dir, write_table, upload_star, article_years
+from nested import export_nested
+from star import export_star
+from schema import TABLE_COLUMNS, TABLE_KEYS, CSV_COLUMNS
+from warehouse import hand_off
+
+logging.basicConfig(filename="logs.log", filemode='a', format='%(name)s - %(levelname)s - %(message)s')
+
+
+def collect_rows(data, changes=None):
+    tables = list(TABLE_COLUMNS)
+    rows = {table: [] for table in tables}
+
+    extract_time = 0
+    for value in data:
+        begin = time.perf_counter()
+        try:
+            record = extract_record(value)
+        except Exception as e:
+            logging.exception(f"Exception occurred! {e}")
+            continue
+        finally:
+            extract_time += time.perf_counter() - begin
+
+        if changes is not None and not changes.changed(record):
+            continue
+        metrics.count("records")
+
+        for table, table_rows in zip(tables, record):
+            rows[table].extend(table_rows)
+
+    metrics.add_time("extract", extract_time)
+    for table in tables:
+        metrics.count_rows(table, len(rows[table]))
+    return rows
+
+
+def build_tables(rows):
+    # First row wins on duplicate keys, like INSERT OR IGNORE does
+    import pandas as pd
+
+    tables = {}
+    for table, columns in TABLE_COLUMNS.items():
+        df = pd.DataFrame.from_records(rows[table], columns=columns)
+        tables[table] = df.drop_duplicates(subset=TABLE_KEYS[table], keep="first", ignore_index=True)
+
+    return tables
+
+
+def join_tables(tables):
+    # Sorted by key so the rows come out in the order SQLite walks its primary keys
+    articles = tables["pm_ext_articles_revised_journals"].sort_values("pmid", kind="stable")
+    authors = tables["pm_ext_authors_affiliations"].sort_values(TABLE_KEYS["pm_ext_authors_affiliations"],
+                                                                 kind="stable")
+    publications = tables["pm_ext_publication_types"].sort_values(TABLE_KEYS["pm_ext_publication_types"],
+                                                                  kind="stable")
+
+    df = articles.merge(authors, on="pmid", how="left").merge(publications, on="pmid", how="left")
+    return df[CSV_COLUMNS].reset_index(drop=True)
+
+
+def build_frames(data, changes=None):
+    tables = build_tables(collect_rows(data, changes))
+    return tables["pm_ext_mesh_headings"], join_tables(tables)
+
+
+def execute(data, filename, bigquery, bg_upload_type, bg_project_id, bg_data_set, bg_table_name, out_dir,
+            output=None, progress=None, changes=None, deleted=None):
+    output = output_settings(output)
+    rows = collect_rows(data, changes)
+    if progress:
+        progress("parsed")
+    if output.get("warehouse_spool"):
+        with metrics.stage("handoff"):
+            hand_off(output["warehouse_spool"], filename, deleted, rows=rows)
+
+    if output.get("layout") == "nested":
+        tables = {}
+        with metrics.stage("build"):
+            for table, df in build_tables(rows).items():
+                df = df.sort_values("pmid", kind="stable")
+                # missing values as None rather than NaN, so they come out as nulls
+                tables[table] = df.astype(object).where(df.notna(), None).itertuples(index=False, name=None)
+        with metrics.stage("write"):
+            path = export_nested(filename, tables, out_dir, output)
+        metrics.add_output(path)
+
+        return upload_nested(path, filename, bigquery, bg_upload_type, bg_project_id, bg_data_set, bg_table_name,
+                             staging_dir(output))
+
+    if output.get("layout") == "star":
+        with metrics.stage("build"):
+            tables = {table: df.astype(object).where(df.notna(), None) for table, df in build_tables(rows).items()}
+        paths = export_star(filename, lambda: {table: df.itertuples(index=False, name=None)
+                                               for table, df in tables.items()}, output,
+                            lambda columns, rows, name: write_table(columns, rows, name, filename, out_dir, output))
+
+        return upload_star(paths, filename, bigquery, bg_upload_type, bg_project_id, bg_data_set, bg_table_name,
+                           staging_dir(output))
+
+    with metrics.stage("build"):
+        tables = build_tables(rows)
+        mesh, joined = tables["pm_ext_mesh_headings"], join_tables(tables)
+
+    df1 = create_mesh_csv(filename, bigquery, out_dir, df=mesh, output=output, years=article_years(output, joined))
+    df2 = create_csv(filename, bigquery, out_dir, df=joined, output=output)
+
+    return upload_frames(df1, df2, filename, bigquery, bg_upload_type, bg_project_id, bg_data_set, bg_table_name,
+                         staging_dir(output), output)
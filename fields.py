@@ -0,0 +1,304 @@
+from schema import TABLE_COLUMNS
+
+
+def major_descriptor(yn):
+    if yn.lower() == 'y':
+        return True
+    return False
+
+
+def create_year_month(year_month):
+    if year_month.get("MedlineDate") is not None:
+        year_month = year_month.get("MedlineDate")
+        if year_month is None:
+            Year, Month = None, None
+        else:
+            if len(year_month.split()) <= 2:
+                if len(year_month.split()) == 2:
+                    Year, Month = list(year_month.split())
+                else:
+                    Year = year_month
+                    Month = None
+            else:
+                Year, Month = None, None
+    else:
+        Year = year_month.get("Year")
+        Month = year_month.get("Month")
+
+    return Year, Month
+
+
+def create_issn(iss):
+    if iss is not None:
+        issn = iss.get("#text")
+        issn_type = iss.get("@IssnType")
+    else:
+        issn = None
+        issn_type = None
+
+    return issn, issn_type
+
+
+def author_list(auth_l):
+    if auth_l is None:
+        author = [{"Initials": None, "ForeName": None, "LastName": None}]
+    else:
+        author = auth_l.get("Author")
+
+    return author
+
+
+def create_date(d_m_y):
+    if d_m_y is None:
+        date = None
+    else:
+        date = d_m_y.get("Day") + '/' + \
+               d_m_y.get("Month") + '/' + \
+               d_m_y.get("Year")
+
+    return date
+
+
+def check_article(article):
+    if type(article) is not str:
+        if type(article) is dict:
+            return article.get("#text")
+        else:
+            return None
+    else:
+        article = article.lstrip('[')
+        return article.rstrip(']')
+
+
+def create_date_revised(d_m_y):
+    if d_m_y is None:
+        date = None
+    else:
+        date = d_m_y.get("Day") + '/' + \
+               d_m_y.get("Month") + '/' + \
+               d_m_y.get("Year")
+
+    return date
+
+
+def create_title(title):
+    if title is None:
+        return None
+    else:
+        title = title.lstrip('[')
+        return title.rstrip(']')
+
+
+def create_affiliation(affiliation):
+    if affiliation is None:
+        return None
+    else:
+        if type(affiliation) is not list:
+            return [affiliation]
+        return affiliation
+
+
+def mesh_headings(heading_list):
+    if heading_list is None:
+        return []
+    headings = heading_list.get("MeshHeading")
+    return headings if type(headings) is list else [headings]
+
+
+def authors(auth_l):
+    author = author_list(auth_l)
+    return author if type(author) is list else [author]
+
+
+class Field:
+    # The value at path, "/" separated keys below the record (level 0) or below the current item of a Rows level,
+    # the innermost one unless level says otherwise. normalizer cleans it up, a function or an expression like
+    # "int({0})" that is written into the extractor as it is, which saves a call in the loops; index picks one of
+    # the values when the normalizer returns several, the normalizer still runs once for all of them.
+    def __init__(self, path, normalizer=None, index=None, level=None):
+        self.path = tuple(path.split("/")) if path else ()
+        self.normalizer = normalizer
+        self.index = index
+        self.level = level
+
+
+class Rows:
+    # One row per item of the list normalizer returns for the value at path. ordinal names the column that numbers the
+    # items from 1; when the normalizer returns None instead of a list, a single row gets the missing values.
+    def __init__(self, path, normalizer, ordinal=None, missing=None):
+        self.path = tuple(path.split("/")) if path else ()
+        self.normalizer = normalizer
+        self.ordinal = ordinal
+        self.missing = missing
+
+
+# xmltodict gives a single child as the value itself and several as a list
+AS_LIST = "{0} if type({0}) is list else [{0}]"
+PMID = Field("MedlineCitation/PMID/#text", "int({0})", level=0)
+JOURNAL = "MedlineCitation/Article/Journal"
+
+# Where every column comes from: the Rows levels of the table (none for one row per record) and a Field per column.
+# A new column only needs its Field here and its place in schema.TABLE_COLUMNS and the table definitions.
+TABLES = {
+    "pm_ext_mesh_headings": ([Rows("MedlineCitation/MeshHeadingList", mesh_headings)], {
+        "pmid": PMID,
+        "descriptor_uid": Field("DescriptorName/@UI"),
+        "major_descriptor": Field("DescriptorName/@MajorTopicYN", "'True' if {0}.lower() == 'y' else 'False'"),
+    }),
+    "pm_ext_articles_revised_journals": ([], {
+        "pmid": PMID,
+        "article_title": Field("MedlineCitation/Article/ArticleTitle", check_article),
+        "date_created": Field("MedlineCitation/DateCompleted", create_date),
+        "date_revised": Field("MedlineCitation/DateRevised", create_date_revised),
+        "issn": Field(f"{JOURNAL}/ISSN", create_issn, 0),
+        "issn_type": Field(f"{JOURNAL}/ISSN", create_issn, 1),
+        "cited_medium": Field(f"{JOURNAL}/JournalIssue/@CitedMedium"),
+        "volume": Field(f"{JOURNAL}/JournalIssue/Volume"),
+        "issue": Field(f"{JOURNAL}/JournalIssue/Issue"),
+        "year": Field(f"{JOURNAL}/JournalIssue/PubDate", create_year_month, 0),
+        "month": Field(f"{JOURNAL}/JournalIssue/PubDate", create_year_month, 1),
+        "title": Field(f"{JOURNAL}/Title", create_title),
+        "iso_abbreviation": Field(f"{JOURNAL}/ISOAbbreviation"),
+        "nlm_uid": Field("MedlineCitation/MedlineJournalInfo/NlmUniqueID"),
+    }),
+    "pm_ext_publication_types": ([Rows("MedlineCitation/Article/PublicationTypeList/PublicationType", AS_LIST,
+                                       ordinal="publication_type_ordinality")], {
+        "pmid": PMID,
+        "publication_type": Field("#text"),
+        "publication_type_ui": Field("@UI"),
+    }),
+    "pm_ext_authors_affiliations": ([Rows("MedlineCitation/Article/AuthorList", authors, ordinal="author_ordinality"),
+                                     Rows("AffiliationInfo", "None if {0} is None else " + AS_LIST,
+                                          ordinal="affiliation_ordinality",
+                                          missing={"affiliation_ordinality": 0, "affiliation": None})], {
+        "pmid": PMID,
+        "initials": Field("Initials", level=1),
+        "fore_name": Field("ForeName", level=1),
+        "last_name": Field("LastName", level=1),
+        "affiliation": Field("Affiliation"),
+    }),
+}
+
+
+class Compiler:
+    # Writes the source of one flat function: every path prefix and every normalizer call is a local variable that is
+    # computed once, record level values before any loop, item values once per item.
+    def __init__(self):
+        self.lines = []
+        self.names = {}
+        self.namespace = {}
+        self.count = 0
+
+    def variable(self, key, expression, indent):
+        if key not in self.names:
+            self.count += 1
+            self.names[key] = f"v{self.count}"
+            self.lines.append(f"{'    ' * indent}{self.names[key]} = {expression}")
+        return self.names[key]
+
+    def function(self, normalizer):
+        name, number = normalizer.__name__, 1
+        while self.namespace.get(name, normalizer) is not normalizer:
+            number += 1
+            name = f"{normalizer.__name__}_{number}"
+        self.namespace[name] = normalizer
+        return name
+
+    def resolve(self, scope, root, path, normalizer, index, indent):
+        name = root
+        for depth in range(len(path)):
+            name = self.variable((scope, path[:depth + 1]), f"{name}.get({path[depth]!r})", indent)
+        if type(normalizer) is str:
+            name = self.variable((scope, path, normalizer), normalizer.format(name), indent)
+        elif normalizer is not None:
+            name = self.variable((scope, path, normalizer), f"{self.function(normalizer)}({name})", indent)
+        if index is not None:
+            name = self.variable((scope, path, normalizer, index), f"{name}[{index}]", indent)
+        return name
+
+    def table(self, table, levels, fields, columns):
+        # a table of one row per record is written as a list of that row, the others are appended to
+        rows = self.variable((table, "rows"), "[]", 1) if levels else None
+        items = ["value"]  # the item every level walks from, the record itself at level 0
+        values = {}
+
+        ordinals = {rows_level.ordinal: level + 1 for level, rows_level in enumerate(levels) if rows_level.ordinal}
+        for column in columns:
+            if column not in fields and column not in ordinals:
+                raise ValueError(f"{table}: nothing says where {column} comes from")
+
+        def level_of(column):
+            if column in ordinals:
+                return ordinals[column]
+            return len(levels) if fields[column].level is None else fields[column].level
+
+        def resolve_level(level, indent):
+            scope = "record" if level == 0 else (table, level)
+            for column in columns:
+                if column in fields and level_of(column) == level:
+                    field = fields[column]
+                    values[column] = self.resolve(scope, items[level], field.path, field.normalizer, field.index,
+                                                  indent)
+
+        def append(indent, missing=None):
+            row = [repr(missing[column]) if missing and column in missing else values[column] for column in columns]
+            row = f"({', '.join(row)}{',' if len(row) == 1 else ''})"
+            if rows is None:
+                return self.variable((table, "rows"), f"[{row}]", indent)
+            self.lines.append(f"{'    ' * indent}{rows}.append({row})")
+            return rows
+
+        def walk(level, indent):
+            resolve_level(level, indent)
+            if level == len(levels):
+                return append(indent)
+
+            rows_level = levels[level]
+            scope = "record" if level == 0 else (table, level)
+            found = self.resolve(scope, items[level], rows_level.path, rows_level.normalizer, None, indent)
+            ordinal, item = f"ordinal{level + 1}", f"item{level + 1}"
+            if rows_level.ordinal:
+                values[rows_level.ordinal] = ordinal
+
+            if rows_level.missing is not None:
+                # only the innermost level can stand in for its missing items, every column of it needs a value
+                for column in columns:
+                    if level_of(column) > level and column not in rows_level.missing:
+                        raise ValueError(f"{table}: {column} has no missing value")
+                if level + 1 != len(levels):
+                    raise ValueError(f"{table}: only the innermost level can have missing values")
+                self.lines.append(f"{'    ' * indent}if {found} is None:")
+                append(indent + 1, rows_level.missing)
+                self.lines.append(f"{'    ' * indent}else:")
+                indent += 1
+
+            if rows_level.ordinal:
+                self.lines.append(f"{'    ' * indent}for {ordinal}, {item} in enumerate({found}, 1):")
+            else:
+                self.lines.append(f"{'    ' * indent}for {item} in {found}:")
+            items.append(item)
+            return walk(level + 1, indent + 1)
+
+        return walk(0, 1)
+
+    def compile(self, tables, table_columns):
+        self.lines.append("def extract_record(value):")
+        results = []
+        for table, columns in table_columns.items():
+            levels, fields = tables[table]
+            results.append(self.table(table, levels, fields, columns))
+        self.lines.append(f"    return {', '.join(results)}")
+
+        source = "\n".join(self.lines) + "\n"
+        exec(compile(source, "<fields>", "exec"), self.namespace)
+        function = self.namespace["extract_record"]
+        function.source = source
+        return function
+
+
+def compile_extractor(tables=None, table_columns=None):
+    # Returns extract_record(value) -> the rows of one PubmedArticle for every table, in the order of table_columns
+    return Compiler().compile(tables or TABLES, table_columns or TABLE_COLUMNS)
+
+
+extract_record = compile_extractor()
@@ -1,5 +1,13 @@
 import xmltodict
-from threads import execute
+from xml.etree import ElementTree
+from threads import execute, create_deleted_csv, upload_deleted_csv, output_settings, staging_dir
+import columnar
+import splitter
+import manifest
+import pmid_index
+import metrics
+import uploader
+from xml_files import open_xml, base_name, is_compressed
 import os
 import logging
 import csv
@@ -11,33 +19,186 @@ logging.basicConfig(filename="logs.log", filemode='a', format='%(name)s - %(leve
 
 
 def xml_to_dict(filename, in_dir):
-    with open(in_dir + f"/{filename}", 'r', encoding='utf-8') as file:
+    with open_xml(in_dir + f"/{filename}") as file:
         data = xmltodict.parse(file.read())
     return data
 
 
-def run(filename, choice, bigquery, bg_upload_type, bg_project_id, bg_data_set, bg_table_name, in_dir, out_dir):
+class ArticleBuilder:
+    # Parser target that builds the same dict xmltodict would give for every PubmedArticle, without an element tree.
+    # The PMIDs of DeleteCitation, which update files carry after their articles, are collected in deleted.
+    def __init__(self):
+        self.depth = 0
+        self.stack = []
+        self.articles = []
+        self.deleted = []
+
+    def start(self, tag, attrib):
+        self.depth += 1
+        if self.stack or (self.depth == 2 and tag in ("PubmedArticle", "DeleteCitation")):
+            self.stack.append((tag, {"@" + key: value for key, value in attrib.items()}, []))
+
+    def data(self, data):
+        if self.stack:
+            self.stack[-1][2].append(data)
+
+    def end(self, tag):
+        self.depth -= 1
+        if not self.stack:
+            return
+
+        tag, item, text = self.stack.pop()
+        text = "".join(text).strip()
+        if item:
+            if text:
+                item["#text"] = text
+            value = item
+        else:
+            value = text or None
+
+        if not self.stack:
+            if tag == "DeleteCitation":
+                self.deleted.extend(deleted_pmids(value))
+            else:
+                self.articles.append(value)
+            return
+
+        parent = self.stack[-1][1]
+        if tag in parent:
+            if type(parent[tag]) is not list:
+                parent[tag] = [parent[tag]]
+            parent[tag].append(value)
+        else:
+            parent[tag] = value
+
+    def close(self):
+        return None
+
+
+def deleted_pmids(value):
+    pmids = value.get("PMID") if type(value) is dict else None
+    if type(pmids) is not list:
+        pmids = [pmids]
+    return [int(pmid.get("#text") if type(pmid) is dict else pmid) for pmid in pmids if pmid is not None]
+
+
+def iter_articles(filename, in_dir, deleted=None, chunk_size=1 << 16):
+    # Yields one PubmedArticle at a time, so memory stays flat no matter how big the file is
+    builder = ArticleBuilder()
+    parser = ElementTree.XMLParser(target=builder)
+
+    with open_xml(in_dir + f"/{filename}") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            parser.feed(chunk)
+            yield from builder.articles
+            builder.articles.clear()
+
+    parser.close()
+    yield from builder.articles
+    if deleted is not None:
+        deleted.extend(builder.deleted)
+
+
+def read_articles(filename, in_dir, xml_parser, deleted=None):
+    if xml_parser == "xmltodict":
+        with metrics.stage("parse"):
+            data = xml_to_dict(filename, in_dir)
+        if deleted is not None:
+            deleted.extend(deleted_pmids(data.get("PubmedArticleSet").get("DeleteCitation")))
+        data = data.get("PubmedArticleSet").get("PubmedArticle")
+        if type(data) is not list:
+            data = [data]
+        return data
+
+    # the stream parser runs while the records are consumed, only the time spent inside it counts as parse
+    return metrics.timed(iter_articles(filename, in_dir, deleted), "parse")
+
+
+def run(filename, choice, bigquery, bg_upload_type, bg_project_id, bg_data_set, bg_table_name, in_dir, out_dir,
+        xml_parser="stream", batch_size=5000, cache_size_mb=64, output=None, split_workers=None, split_min_mb=64,
+        manifest_path=None, change_index=None, metrics_path=None, profile=(), trace_memory=()):
     start = time.time()
 
-    data = xml_to_dict(filename, in_dir)
-    data = data.get("PubmedArticleSet").get("PubmedArticle")
+    if bigquery:
+        conversion_type = "BigQuery"
+    else:
+        conversion_type = "csv"
+
+    path = in_dir + f"/{filename}"
+    progress = None
+    before_staged = None
+    if manifest_path:
+        file_hash = manifest.file_hash(manifest_path, path)
+        size = os.path.getsize(path)
 
+        def progress(stage, outputs=()):
+            manifest.set_stage(manifest_path, file_hash, conversion_type, filename, size, stage, outputs)
+
+        def before_staged(staged_path):
+            manifest.add_outputs(manifest_path, file_hash, [staged_path])
+
+    # compressed files can't be memory mapped, they are always read by one process
+    # a file bound for the warehouse is handed off as a whole, so it isn't split either
+    split = split_workers and split_workers > 1 and (output or {}).get("layout", "flat") == "flat" and \
+        not (output or {}).get("warehouse_spool") and not is_compressed(filename) and \
+        os.path.getsize(path) >= split_min_mb * 1024 * 1024
+
+    metrics.start(filename, os.path.getsize(path), filename in profile, filename in trace_memory)
+    status = "failed"
     upload_time = 0
+    uploader.staged.clear()
+    uploader.before_staged = before_staged
+    changes = pmid_index.ChangeIndex(change_index, filename) if change_index else None
+    deleted = []
     try:
-        upload_time = execute(data=data, filename=filename, choice=choice, bigquery=bigquery,
-                              bg_upload_type=bg_upload_type, out_dir=out_dir, bg_project_id=bg_project_id,
-                              bg_data_set=bg_data_set, bg_table_name=bg_table_name)
+        if split:
+            upload_time = splitter.execute_split(path, filename, choice, split_workers, bigquery, bg_upload_type,
+                                                 bg_project_id, bg_data_set, bg_table_name, out_dir, batch_size,
+                                                 cache_size_mb, output, progress, changes, deleted)
+        elif choice == "columnar":
+            upload_time = columnar.execute(data=read_articles(filename, in_dir, xml_parser, deleted),
+                                           filename=filename, bigquery=bigquery, bg_upload_type=bg_upload_type,
+                                           out_dir=out_dir, bg_project_id=bg_project_id, bg_data_set=bg_data_set,
+                                           bg_table_name=bg_table_name, output=output, progress=progress,
+                                           changes=changes, deleted=deleted)
+        else:
+            upload_time = execute(data=read_articles(filename, in_dir, xml_parser, deleted), filename=filename,
+                                  choice=choice, bigquery=bigquery, bg_upload_type=bg_upload_type, out_dir=out_dir,
+                                  bg_project_id=bg_project_id, bg_data_set=bg_data_set, bg_table_name=bg_table_name,
+                                  batch_size=batch_size, cache_size_mb=cache_size_mb, output=output,
+                                  progress=progress, changes=changes, deleted=deleted)
+
+        if changes is not None:
+            if deleted:
+                df = create_deleted_csv(deleted, filename, bigquery, out_dir, output)
+                if bigquery:
+                    upload_time = max(upload_time, upload_deleted_csv(df, filename, bg_upload_type, bg_project_id,
+                                                                      bg_data_set, bg_table_name,
+                                                                      staging_dir(output_settings(output))))
+
+            # only now that the outputs exist, the new versions count as seen
+            changes.delete(deleted)
+            print(f"{filename}: {len(changes.pending)} new or revised, {changes.unchanged} unchanged, "
+                  f"{len(deleted)} deleted")
+            changes.commit()
+
+        # staged files still have to be loaded by the upload stage, everything else is finished here
+        staged = list(uploader.staged)
+        uploader.staged.clear()
+        if progress:
+            progress("uploaded" if bigquery and not staged else "exported", staged)
+
         move(in_dir + f"/{filename}", in_dir + f"/converted_xml/{filename}")
+        status = "ok"
 
     except Exception as e:
         logging.exception(f"Exception occurred! {e}")
+    finally:
+        uploader.before_staged = None
+        if changes is not None:
+            changes.close()
 
-    if bigquery:
-        conversion_type = "BigQuery"
-    else:
-        conversion_type = "csv"
-
-    file_name = filename.rstrip(".xml") + "_mesh" + " " + filename.rstrip(".xml")
+    file_name = base_name(filename) + "_mesh" + " " + base_name(filename)
 
     details = [filename, conversion_type, choice, file_name, str(round(time.time() - start, 2)),
                str(upload_time), datetime.now().strftime("%m/%d/%Y, %H:%M:%S")]
@@ -46,4 +207,10 @@ def run(filename, choice, bigquery, bg_upload_type, bg_project_id, bg_data_set,
           f"{details[4]}           {details[5]}     {details[6]}")
     print()
 
+    metrics.add_time("upload", upload_time)
+    record = metrics.finish(event="file", conversion_type=conversion_type, choice=choice, status=status,
+                            time_taken=round(time.time() - start, 4), run_date=details[6])
+    if metrics_path:
+        metrics.write(metrics_path, record)
+
     return details
@@ -1,8 +1,16 @@
 import os
-from shutil import rmtree
+from shutil import rmtree, move
 from intermediate import run
-from sys import argv
-import concurrent.futures
+from uploader import Uploader, get_backend, pending_files
+from pipeline import run_pipeline, estimate_memory, physical_memory_mb, create_pool, warm_worker, estimate_seconds, \
+    schedule, worker_count
+from watcher import watch
+from warehouse import Warehouse, query
+from scan import scan, select_files
+from shards import table_spec
+from xml_files import is_xml_file
+import manifest
+from sys import argv, version_info
 import json
 import time
 import csv
@@ -45,6 +53,128 @@ def prepare_directory():
         pass
 
 
+def skip_finished(files, in_dir, manifest_path, bigquery):
+    # Files whose content was already taken through every stage are not converted again, and files that only
+    # wait for their upload are left to the upload stage, which picks their outputs up from the spool
+    conversion_type = "BigQuery" if bigquery else "csv"
+    remaining, skipped, resumed = [], [], []
+
+    for xml in files:
+        path = in_dir + f"/{xml}"
+        file_hash = manifest.file_hash(manifest_path, path)
+        stage = manifest.get_stage(manifest_path, file_hash, conversion_type)
+
+        if manifest.is_complete(stage, conversion_type):
+            skipped.append(xml)
+        elif stage == "exported" and bigquery and \
+                all(os.path.exists(output) for output in manifest.pending_outputs(manifest_path, file_hash)):
+            resumed.append(xml)
+        else:
+            remaining.append(xml)
+            continue
+
+        move(path, in_dir + f"/converted_xml/{xml}")
+
+    if skipped:
+        print(f"Skipped {len(skipped)} file(s) that were already {conversion_type} converted:", ", ".join(skipped))
+    if resumed:
+        print(f"Resuming {len(resumed)} file(s) from their staged outputs:", ", ".join(resumed))
+
+    return remaining
+
+
+def option_values(args, flag):
+    # "--profile sample.xml" can be given more than once, every pair is taken out of args
+    values = []
+    while flag in args[:-1]:
+        index = args.index(flag)
+        values.append(args[index + 1])
+        del args[index:index + 2]
+    return values
+
+
+def create_uploader(Configuration, options, bg_project_id, manifest_path, max_files):
+    backend = get_backend(Configuration.get("bg_backend", "bigquery"), bg_project_id,
+                          Configuration.get("bg_sqlite_path", "bigquery_stand_in.db"))
+    on_loaded = None
+    if manifest_path:
+        def on_loaded(paths):
+            manifest.mark_uploaded(manifest_path, paths)
+
+    return Uploader(backend, options["output"]["spool_dir"], max_files, Configuration.get("bg_batch_max_mb", 1024),
+                    on_loaded, Configuration.get("bg_retries", 5), Configuration.get("bg_backoff_seconds", 2),
+                    Configuration.get("bg_max_backoff_seconds", 120), Configuration.get("metrics", "metrics.jsonl"))
+
+
+def upload_pending(Configuration, options, bg_project_id, manifest_path):
+    # Drains the spool left behind by earlier runs, no xml is read
+    max_files = 1
+    if options["output"]["bg_load_mode"] == "batched":
+        max_files = Configuration.get("bg_batch_max_files", 50)
+
+    uploader = create_uploader(Configuration, options, bg_project_id, manifest_path, max_files)
+    pending = pending_files(uploader.spool_dir)
+    print(f"Files waiting in {uploader.spool_dir}:", sum(len(files) for files in pending.values()))
+
+    uploader.flush(force=True)
+
+    remaining = sum(len(files) for files in pending_files(uploader.spool_dir).values())
+    if remaining:
+        print(f"{remaining} file(s) could not be loaded and are still in {uploader.spool_dir}")
+
+
+def plan_files(Configuration, files, in_dir, parse_workers):
+    # Most expensive files first (by earlier timings from the metrics, or by size), and no more workers than the
+    # cores and the memory budget allow
+    order = Configuration.get("schedule", "cost")
+    costs, from_history = estimate_seconds(files, in_dir, Configuration.get("choice"), Configuration.get("metrics"))
+    files = schedule(files, costs, order)
+
+    estimates = estimate_memory(files, in_dir, Configuration.get("choice"), Configuration.get("memory_factor", 10))
+    budget = Configuration.get("memory_budget_mb") or physical_memory_mb()
+    workers = worker_count(parse_workers, files, estimates, budget)
+
+    if order != "name":
+        order = "earlier timings, largest first" if from_history else "size, largest first"
+    print(f"{len(files)} file(s) on {workers} worker(s), ordered by {order}")
+    return files, estimates, costs, workers, budget
+
+
+def watch_in_dir(Configuration, in_dir, run_kwargs, uploader, manifest_path, bigquery, warehouse=None):
+    # One warm pool and one uploader for as long as the daemon runs, every batch of new files goes through the
+    # pipeline as soon as it has settled in in_dir. The workers are never recycled, that would undo the warm start.
+    parse_workers = min(Configuration.get("parse_workers") or os.cpu_count() or 1, os.cpu_count() or 1)
+    pool = create_pool(parse_workers, None, warm_worker)
+
+    def process(files):
+        if manifest_path:
+            files = skip_finished(files, in_dir, manifest_path, bigquery)
+        if not files:
+            return
+
+        files, estimates, costs, workers, budget = plan_files(Configuration, files, in_dir, parse_workers)
+        details = run_pipeline(files, run_kwargs, uploader, workers, Configuration.get("upload_workers", 2),
+                               Configuration.get("pipeline_queue_size", 4), estimates, budget, parse_pool=pool,
+                               costs=costs, warehouse=warehouse)
+        if warehouse:
+            warehouse.finish()
+        write_history(details)
+
+    try:
+        watch(in_dir, process, Configuration.get("watch_poll_seconds", 5), Configuration.get("watch_settle_seconds", 2))
+        pool.shutdown(wait=True)
+    except KeyboardInterrupt:
+        # second signal: queued files are dropped (python 3.9+), the ones already running still finish
+        if version_info >= (3, 9):
+            pool.shutdown(wait=True, cancel_futures=True)
+        else:
+            pool.shutdown(wait=True)
+    finally:
+        if uploader:
+            uploader.flush(force=True)
+        print("Watch stopped")
+
+
 def upload(bigquery):
     if bigquery.lower() == 'y':
         return True
@@ -52,12 +182,17 @@ def upload(bigquery):
 
 
 def main():
-    args = argv
+    args = list(argv)
+    profile = option_values(args, "--profile")
+    trace_memory = option_values(args, "--tracemalloc")
     details = []
 
-    prepare_directory()  # This will prepare current directory for storing temporary files
     Configuration = get_configuration()  # This will get initials properties to be used
 
+    if args[1].lower() == "query":
+        query(Configuration.get("warehouse"), args[2:])
+        return
+
     dir_contents = os.listdir(Configuration.get(Configuration.get("execution_os") + "_in_dir"))
     dir_length = len(dir_contents)
 
@@ -70,27 +205,99 @@ def main():
     elif Configuration.get("conversion_type").lower() == "bigquery":
         bigquery = True
 
+    if args[1].lower() == "scan":
+        # counts what the files hold and estimates the run from the metrics of earlier ones, nothing is converted
+        scan(select_files(in_dir, args[2] if len(args) > 2 else None), in_dir, Configuration.get("choice"), bigquery,
+             Configuration.get("metrics", "metrics.jsonl"), Configuration.get("parse_workers"),
+             Configuration.get("upload_workers", 2), Configuration.get("memory_factor", 10),
+             Configuration.get("memory_budget_mb"), Configuration.get("scan_part_mb", 64))
+        return
+
     bg_upload_type = Configuration.get("bg_upload_type")
     bg_data_set = Configuration.get("bg_data_set")
     bg_project_id = Configuration.get("bg_project_id")
     bg_table_name = Configuration.get("bg_table_name")
+    options = {"xml_parser": Configuration.get("xml_parser", "stream"),
+               "batch_size": Configuration.get("sqlite_batch_size", 5000),
+               "cache_size_mb": Configuration.get("sqlite_cache_size_mb", 64),
+               "output": {"format": Configuration.get("output_format", "csv"),
+                          "compression": Configuration.get("parquet_compression", "zstd"),
+                          "row_group_size": Configuration.get("parquet_row_group_size", 100000),
+                          "bg_load_source": Configuration.get("bg_load_source", "dataframe"),
+                          "layout": Configuration.get("output_layout", "flat"),
+                          "bg_load_mode": Configuration.get("bg_load_mode", "per_file"),
+                          "spool_dir": Configuration.get("spool_dir", "spool"),
+                          "dimension_index": Configuration.get("dimension_index", "dimensions.db"),
+                          "shard_by": Configuration.get("shard_by"),
+                          "shard_size": Configuration.get("shard_size"),
+                          "shard_pmid_max": Configuration.get("shard_pmid_max"),
+                          "bg_clustering": Configuration.get("bg_clustering", {})},
+               "change_index": Configuration.get("change_index")}
+
+    manifest_path = Configuration.get("manifest")
+    options["manifest_path"] = manifest_path
+    options["metrics_path"] = Configuration.get("metrics", "metrics.jsonl")
+    options["profile"] = profile
+    options["trace_memory"] = trace_memory
+
+    if bigquery and options["output"]["shard_by"]:
+        # a partitioning BigQuery can't create is reported now, not after the first file was parsed
+        try:
+            table_spec(options["output"])
+        except ValueError as e:
+            print(e)
+            return
+
+    if args[1].lower() == "upload-pending":
+        upload_pending(Configuration, options, bg_project_id, manifest_path)
+        return
+
+    # only conversions touch temporary/, query, scan and upload-pending can run next to a watch or another run
+    prepare_directory()  # This will prepare current directory for storing temporary files
+
+    uploader = None
+    if bigquery and (Configuration.get("pipeline", False) or options["output"]["bg_load_mode"] == "batched" or
+                     Configuration.get("spool_uploads", False) or args[1].lower() == "watch"):
+        # workers only stage their files and the uploads run from this process, with retries; a failed load
+        # leaves its files in the spool instead of costing a reparse. per_file loads are batches of one file.
+        # watch always spools, so the daemon keeps one authenticated client instead of one per file
+        max_files = 1
+        if options["output"]["bg_load_mode"] == "batched":
+            max_files = Configuration.get("bg_batch_max_files", 50)
+
+        options["output"]["bg_load_mode"] = "batched"
+        if options["output"]["format"] == "csv":
+            options["output"]["format"] = "csv.gz"  # spooled files are kept compressed
+        uploader = create_uploader(Configuration, options, bg_project_id, manifest_path, max_files)
+
+    warehouse = None
+    if Configuration.get("warehouse"):
+        # the workers hand their rows off through this folder, this process merges them into the warehouse
+        options["output"]["warehouse_spool"] = Configuration.get("warehouse_spool", "warehouse_spool")
+        warehouse = Warehouse(Configuration.get("warehouse"), options["output"]["warehouse_spool"],
+                              Configuration.get("warehouse_fts", True))
 
     try:
         os.mkdir(in_dir + "/converted_xml")
     except FileExistsError:
         pass
 
-    if args[1].endswith(".xml"):
+    run_kwargs = dict(choice=Configuration.get("choice"), bigquery=bigquery, bg_upload_type=bg_upload_type,
+                      bg_project_id=bg_project_id, bg_data_set=bg_data_set, bg_table_name=bg_table_name,
+                      in_dir=in_dir, out_dir=out_dir, **options)
+
+    if args[1].lower() == "watch":
+        watch_in_dir(Configuration, in_dir, run_kwargs, uploader, manifest_path, bigquery, warehouse)
+        return
+
+    if is_xml_file(args[1]):
         filename = args[1]
 
         if filename not in dir_contents:
             print("File doesn't exists. ")
             exit(0)
 
-        print("xml_file_name    conversion_type   task_type     converted_file_name      time_secs    upload_time    "
-              "run_date")
-        details = [run(filename, Configuration.get("choice"), bigquery, bg_upload_type, bg_project_id,
-                       bg_data_set, bg_table_name, in_dir, out_dir)]
+        files = [filename]
 
     elif args[1].isnumeric():
         total_files = int(args[1])
@@ -99,65 +306,53 @@ def main():
             print("Entered number is greater than number of files in directory... Processing all files")
             total_files = dir_length
 
-        print("xml_file_name    conversion_type   task_type     converted_file_name      time_secs   "
-              "upload_time    run_date")
-
-        if Configuration.get("choice") == "memory":
-            details = []
-            for i in range(total_files):
-                details.append(
-                    run(dir_contents[i], Configuration.get('choice'), bigquery, bg_upload_type, bg_project_id,
-                        bg_data_set,
-                        bg_table_name, in_dir, out_dir))
-
-        else:
-            details = []
-            with concurrent.futures.ProcessPoolExecutor() as executor:
-                futures = []
-                for i in range(total_files):
-                    if dir_contents[i].endswith(".xml"):
-                        futures.append(executor.submit(run, filename=dir_contents[i],
-                                                       choice=Configuration.get("choice"),
-                                                       bigquery=bigquery, bg_upload_type=bg_upload_type,
-                                                       bg_project_id=bg_project_id, bg_data_set=bg_data_set,
-                                                       bg_table_name=bg_table_name, in_dir=in_dir, out_dir=out_dir))
-
-                for future in concurrent.futures.as_completed(futures):
-                    details.append(future.result())
+        # the first N xml files by name, not whatever order the file system lists them in
+        files = sorted(xml for xml in dir_contents if is_xml_file(xml))[:total_files]
 
     elif args[1].lower() == "all":
         print("Files in directory:", dir_length)
+        files = sorted(xml for xml in dir_contents if is_xml_file(xml))
 
-        print("xml_file_name    conversion_type   task_type     converted_file_name      time_secs   "
-              "upload_time    run_date")
+    else:
+        print("Pass a file name, a number of files or all")
+        exit(0)
 
-        if Configuration.get("choice") == "memory":
-            details = []
-            for xml in dir_contents:
-                if xml.endswith(".xml"):
-                    details.append(
-                        run(xml, Configuration.get("choice"), bigquery, bg_upload_type, bg_project_id=bg_project_id,
-                            bg_data_set=bg_data_set, bg_table_name=bg_table_name, in_dir=in_dir, out_dir=out_dir))
+    if manifest_path:
+        files = skip_finished(files, in_dir, manifest_path, bigquery)
 
-        else:
-            details = []
-            with concurrent.futures.ProcessPoolExecutor() as executor:
-                futures = []
-                for xml in dir_contents:
-                    if xml.endswith(".xml"):
-                        futures.append(executor.submit(run, filename=xml, choice=Configuration.get("choice"),
-                                                       bigquery=bigquery, bg_upload_type=bg_upload_type,
-                                                       bg_project_id=bg_project_id, bg_data_set=bg_data_set,
-                                                       bg_table_name=bg_table_name, in_dir=in_dir, out_dir=out_dir))
-
-                for future in concurrent.futures.as_completed(futures):
-                    details.append(future.result())
+    print("xml_file_name    conversion_type   task_type     converted_file_name      time_secs   "
+          "upload_time    run_date")
+
+    if not files:
+        details = []
+
+    elif len(files) == 1:
+        # a single file is cut at article boundaries and spread over the cores instead
+        details = [run(files[0], split_workers=Configuration.get("split_workers") or os.cpu_count(),
+                       split_min_mb=Configuration.get("split_min_mb", 64), **run_kwargs)]
+
+    else:
+        # "memory" runs in parallel as well, admission control keeps the in-memory databases within the budget
+        files, estimates, costs, workers, budget = plan_files(Configuration, files, in_dir,
+                                                              Configuration.get("parse_workers"))
+        details = run_pipeline(files, run_kwargs, uploader, workers, Configuration.get("upload_workers", 2),
+                               Configuration.get("pipeline_queue_size", 4), estimates, budget,
+                               Configuration.get("worker_max_tasks"), costs=costs, warehouse=warehouse)
+
+    if uploader:
+        uploader.flush(force=True)  # whatever is left over goes in one last load job per table
+    if warehouse:
+        warehouse.finish()
 
     try:
         rmtree(os.path.join("temporary"))
     except FileNotFoundError:
         pass
 
+    write_history(details)
+
+
+def write_history(details):
     with open(os.path.join("execution_history.csv"), "a") as csv_file:
         csv_writer = csv.writer(csv_file)
 
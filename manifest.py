@@ -0,0 +1,118 @@
+import os
+import sqlite3
+import hashlib
+from datetime import datetime
+
+# Stages a file goes through, in order. csv conversions are done once "exported", BigQuery ones once "uploaded".
+STAGES = ["parsed", "exported", "uploaded"]
+
+
+def connect(manifest_path):
+    connection = sqlite3.connect(manifest_path, timeout=60)
+    connection.execute("PRAGMA journal_mode = WAL")
+    with connection:
+        connection.execute("CREATE TABLE IF NOT EXISTS hashes(path TEXT PRIMARY KEY, size INTEGER, mtime REAL, "
+                           "file_hash TEXT)")
+        connection.execute("CREATE TABLE IF NOT EXISTS files(file_hash TEXT, conversion_type TEXT, filename TEXT, "
+                           "size INTEGER, stage TEXT, updated TEXT, PRIMARY KEY(file_hash, conversion_type))")
+        connection.execute("CREATE TABLE IF NOT EXISTS outputs(path TEXT PRIMARY KEY, file_hash TEXT, "
+                           "uploaded INTEGER DEFAULT 0)")
+    return connection
+
+
+def file_hash(manifest_path, path):
+    # The sha256 is only computed again when size or mtime of the file changed since it was last hashed
+    stat = os.stat(path)
+    connection = connect(manifest_path)
+    try:
+        row = connection.execute("SELECT file_hash FROM hashes WHERE path = ? AND size = ? AND mtime = ?",
+                                 (os.path.abspath(path), stat.st_size, stat.st_mtime)).fetchone()
+        if row:
+            return row[0]
+
+        digest = hashlib.sha256()
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(1 << 20), b""):
+                digest.update(chunk)
+
+        with connection:
+            connection.execute("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?)",
+                               (os.path.abspath(path), stat.st_size, stat.st_mtime, digest.hexdigest()))
+        return digest.hexdigest()
+    finally:
+        connection.close()
+
+
+def get_stage(manifest_path, file_hash, conversion_type):
+    connection = connect(manifest_path)
+    try:
+        row = connection.execute("SELECT stage FROM files WHERE file_hash = ? AND conversion_type = ?",
+                                 (file_hash, conversion_type)).fetchone()
+    finally:
+        connection.close()
+
+    return row[0] if row else None
+
+
+def set_stage(manifest_path, file_hash, conversion_type, filename, size, stage, outputs=()):
+    connection = connect(manifest_path)
+    try:
+        with connection:
+            connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                               (file_hash, conversion_type, filename, size, stage,
+                                datetime.now().strftime("%m/%d/%Y, %H:%M:%S")))
+            # the outputs were added before they reached the spool and may be loaded already, that is kept
+            connection.executemany("INSERT INTO outputs(path, file_hash) VALUES (?, ?) "
+                                   "ON CONFLICT(path) DO UPDATE SET file_hash = excluded.file_hash",
+                                   [(os.path.abspath(path), file_hash) for path in outputs])
+            promote(connection)
+    finally:
+        connection.close()
+
+
+def add_outputs(manifest_path, file_hash, outputs):
+    # Called before the outputs show up in the spool, so an upload that takes them right away finds them here
+    connection = connect(manifest_path)
+    try:
+        with connection:
+            connection.executemany("INSERT OR REPLACE INTO outputs(path, file_hash, uploaded) VALUES (?, ?, 0)",
+                                   [(os.path.abspath(path), file_hash) for path in outputs])
+    finally:
+        connection.close()
+
+
+def pending_outputs(manifest_path, file_hash):
+    connection = connect(manifest_path)
+    try:
+        rows = connection.execute("SELECT path FROM outputs WHERE file_hash = ? AND uploaded = 0",
+                                  (file_hash,)).fetchall()
+    finally:
+        connection.close()
+
+    return [row[0] for row in rows]
+
+
+def mark_uploaded(manifest_path, paths):
+    # Called with the staged files of every finished load job; a file is "uploaded" once all its outputs are
+    connection = connect(manifest_path)
+    try:
+        with connection:
+            connection.executemany("UPDATE outputs SET uploaded = 1 WHERE path = ?",
+                                   [(os.path.abspath(path),) for path in paths])
+            promote(connection)
+    finally:
+        connection.close()
+
+
+def promote(connection):
+    # An exported BigQuery file is uploaded once all of its outputs are, whichever of the two comes last
+    connection.execute("UPDATE files SET stage = 'uploaded', updated = ? WHERE stage = 'exported' AND "
+                       "conversion_type = 'BigQuery' AND file_hash IN (SELECT file_hash FROM outputs "
+                       "GROUP BY file_hash HAVING MIN(uploaded) = 1)",
+                       (datetime.now().strftime("%m/%d/%Y, %H:%M:%S"),))
+
+
+def is_complete(stage, conversion_type):
+    if stage is None:
+        return False
+    return STAGES.index(stage) >= STAGES.index("uploaded" if conversion_type == "BigQuery" else "exported")
@@ -0,0 +1,127 @@
+import os
+import json
+import time
+import cProfile
+import tracemalloc
+from contextlib import contextmanager
+from xml_files import base_name
+
+PROFILE_DIR = "profiles"
+current = {}  # measurements of the file this process is working on
+hooks = {}
+
+
+def peak_rss_mb():
+    try:
+        with open("/proc/self/status", "r") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+
+    try:
+        import resource
+    except ImportError:
+        return None
+    # kilobytes on linux, peak of the whole process life
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def reset_peak_rss():
+    # Linux sets VmHWM back to the current RSS, so a reused pool worker reports the peak of this file only
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+    except OSError:
+        pass
+
+
+def start(filename, bytes_in, profile=False, trace_memory=False):
+    current.clear()
+    current.update({"filename": filename, "pid": os.getpid(), "stages": {}, "records": 0, "rows": {},
+                    "outputs": {}, "bytes_in": bytes_in, "bytes_out": 0})
+    reset_peak_rss()
+
+    hooks.clear()
+    if trace_memory:
+        tracemalloc.start()
+        hooks["tracemalloc"] = True
+    if profile:
+        hooks["profiler"] = cProfile.Profile()
+        hooks["profiler"].enable()
+
+
+def add_time(name, seconds):
+    stages = current.setdefault("stages", {})
+    stages[name] = stages.get(name, 0) + seconds
+
+
+@contextmanager
+def stage(name):
+    begin = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(name, time.perf_counter() - begin)
+
+
+def timed(data, name):
+    # Time spent inside the iterator only, the consumer's work between two records isn't counted
+    iterator = iter(data)
+    while True:
+        begin = time.perf_counter()
+        try:
+            value = next(iterator)
+        except StopIteration:
+            add_time(name, time.perf_counter() - begin)
+            return
+        add_time(name, time.perf_counter() - begin)
+        yield value
+
+
+def count(key, value=1):
+    current[key] = current.get(key, 0) + value
+
+
+def count_rows(table, rows):
+    table_rows = current.setdefault("rows", {})
+    table_rows[table] = table_rows.get(table, 0) + rows
+
+
+def add_output(path, rows=None):
+    current.setdefault("outputs", {})[os.path.basename(path)] = rows
+    count("bytes_out", os.path.getsize(path))
+
+
+def finish(**fields):
+    record = dict(current, **fields)
+    record["stages"] = {name: round(seconds, 4) for name, seconds in record.get("stages", {}).items()}
+    record["peak_rss_mb"] = peak_rss_mb()
+
+    name = base_name(current.get("filename", "unknown"))
+    if "profiler" in hooks:
+        hooks["profiler"].disable()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        record["profile"] = os.path.join(PROFILE_DIR, f"{name}.prof")
+        hooks["profiler"].dump_stats(record["profile"])
+
+    if "tracemalloc" in hooks:
+        snapshot = tracemalloc.take_snapshot()
+        record["traced_peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 1024 / 1024, 1)
+        tracemalloc.stop()
+
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        record["memory_profile"] = os.path.join(PROFILE_DIR, f"{name}_memory.txt")
+        with open(record["memory_profile"], "w", encoding="utf-8") as file:
+            for statistic in snapshot.statistics("lineno")[:25]:
+                file.write(f"{statistic}\n")
+
+    hooks.clear()
+    return record
+
+
+def write(path, record):
+    # one short append per line, so several workers can share the file
+    with open(path, "a", encoding="utf-8") as file:
+        file.write(json.dumps(record) + "\n")
@@ -0,0 +1,138 @@
+import os
+import json
+import gzip
+from itertools import groupby
+from operator import itemgetter
+from schema import TABLE_COLUMNS, NESTED_SCHEMA
+from xml_files import base_name
+
+ARTICLES = "pm_ext_articles_revised_journals"
+CHILD_TABLES = ["pm_ext_authors_affiliations", "pm_ext_publication_types", "pm_ext_mesh_headings"]
+
+
+def arrow_type(field):
+    import pyarrow as pa
+
+    if field["type"] == "RECORD":
+        data_type = pa.struct([arrow_field(child) for child in field["fields"]])
+    elif field["type"] == "INTEGER":
+        data_type = pa.int64()
+    elif field["type"] == "BOOLEAN":
+        data_type = pa.bool_()
+    else:
+        data_type = pa.string()
+
+    if field.get("mode") == "REPEATED":
+        return pa.list_(data_type)
+    return data_type
+
+
+def arrow_field(field):
+    import pyarrow as pa
+
+    return pa.field(field["name"], arrow_type(field), nullable=field.get("mode") != "REQUIRED")
+
+
+def create_authors(rows):
+    # affiliation_ordinality 0 marks an author without any affiliation
+    authors = []
+    for _, author_ordinality, initials, fore_name, last_name, affiliation_ordinality, affiliation in rows:
+        if not authors or authors[-1]["author_ordinality"] != author_ordinality:
+            authors.append({"author_ordinality": author_ordinality, "initials": initials, "fore_name": fore_name,
+                            "last_name": last_name, "affiliations": []})
+
+        if affiliation_ordinality:
+            authors[-1]["affiliations"].append({"affiliation_ordinality": affiliation_ordinality,
+                                                "affiliation": affiliation})
+    return authors
+
+
+def create_record(filename, article, children):
+    record = dict(zip(TABLE_COLUMNS[ARTICLES], article))
+    record["filename"] = filename
+    record["authors"] = create_authors(children["pm_ext_authors_affiliations"])
+    record["publication_types"] = [{"publication_type_ordinality": ordinality, "publication_type": publication_type,
+                                    "publication_type_ui": publication_type_ui}
+                                   for _, publication_type, publication_type_ui, ordinality
+                                   in children["pm_ext_publication_types"]]
+    record["mesh_headings"] = [{"descriptor_uid": descriptor_uid, "major_descriptor": major == "True"}
+                               for _, descriptor_uid, major in children["pm_ext_mesh_headings"]]
+    return record
+
+
+def nested_records(filename, tables):
+    # Every table has to come sorted by pmid, the child rows are then picked up with one pass over each table
+    groups = {table: groupby(tables[table], key=itemgetter(0)) for table in CHILD_TABLES}
+    heads = {table: next(groups[table], None) for table in CHILD_TABLES}
+
+    for article in tables[ARTICLES]:
+        pmid = article[0]
+        children = {}
+        for table in CHILD_TABLES:
+            head = heads[table]
+            while head is not None and head[0] < pmid:
+                head = next(groups[table], None)
+
+            if head is not None and head[0] == pmid:
+                children[table] = list(head[1])
+                head = next(groups[table], None)
+            else:
+                children[table] = []
+            heads[table] = head
+
+        yield create_record(filename, article, children)
+
+
+def write_parquet(records, path, output):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    fields = [arrow_field(field) for field in NESTED_SCHEMA]
+    schema = pa.schema(fields)
+    row_group_size = output.get("row_group_size")
+
+    with pq.ParquetWriter(path, schema, compression=output.get("compression"), use_dictionary=True) as writer:
+        batch = []
+        for record in records:
+            batch.append(record)
+            if len(batch) >= row_group_size:
+                writer.write_table(pa.Table.from_arrays(pa.array(batch, type=pa.struct(fields)).flatten(),
+                                                        schema=schema))
+                batch = []
+
+        if batch:
+            writer.write_table(pa.Table.from_arrays(pa.array(batch, type=pa.struct(fields)).flatten(), schema=schema))
+
+
+def write_json(records, path):
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "wt", encoding="utf-8") as file:
+        for record in records:
+            # numpy scalars coming from the columnar engine are turned into plain python values
+            file.write(json.dumps(record, default=lambda value: value.item()) + "\n")
+
+
+def export_nested(filename, tables, out_dir, output):
+    name = base_name(filename) + "_nested"
+    if output.get("format") == "parquet":
+        folder, extension = "PARQUET", ".parquet"
+    else:
+        folder, extension = "JSON", ".json.gz" if output.get("format", "").endswith(".gz") else ".json"
+
+    try:
+        os.mkdir(out_dir + f"/{folder}")
+    except FileExistsError:
+        pass
+
+    # Schema file can be passed to "bq load --schema" as it is
+    with open(out_dir + f"/{folder}/{name}_schema.json", "w", encoding="utf-8") as file:
+        json.dump(NESTED_SCHEMA, file, indent=2)
+
+    path = out_dir + f"/{folder}/{name}{extension}"
+    records = nested_records(filename, tables)
+    if extension == ".parquet":
+        write_parquet(records, path, output)
+    else:
+        write_json(records, path)
+
+    return path
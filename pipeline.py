@@ -0,0 +1,207 @@
+import os
+import sys
+import json
+import time
+import signal
+import logging
+import concurrent.futures
+from contextlib import nullcontext
+from collections import deque
+from intermediate import run
+from xml_files import is_compressed
+
+logging.basicConfig(filename="logs.log", filemode='a', format='%(name)s - %(levelname)s - %(message)s')
+
+COMPRESSION_RATIO = 8  # PubMed xml shrinks about this much with gzip
+
+
+def physical_memory_mb():
+    try:
+        return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") // (1024 * 1024)
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def estimate_memory(files, in_dir, choice, memory_factor):
+    # Rough peak memory of one worker: the in-memory database plus the frames built from it grow with the xml size
+    estimates = {}
+    for filename in files:
+        size = os.path.getsize(os.path.join(in_dir, filename))
+        if is_compressed(filename):
+            size *= COMPRESSION_RATIO
+        if choice == "memory":
+            estimates[filename] = size * memory_factor
+        else:
+            estimates[filename] = size * memory_factor / 2  # database pages live on disk, only the frames count
+    return estimates
+
+
+def fit_history(metrics_path, choice):
+    # seconds = fixed + per_byte * size, fitted by least squares over earlier files of the same choice, separately
+    # for plain and compressed input
+    points = {False: [], True: []}
+    try:
+        with open(metrics_path, "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get("event") == "file" and record.get("status") == "ok" and record.get("choice") == choice:
+                    points[is_compressed(record["filename"])].append((record["bytes_in"], record["time_taken"]))
+    except (OSError, TypeError):
+        pass
+
+    models = {}
+    for compressed, pairs in points.items():
+        if not pairs:
+            continue
+        count = len(pairs)
+        mean_size = sum(size for size, _ in pairs) / count
+        mean_seconds = sum(seconds for _, seconds in pairs) / count
+        variance = sum((size - mean_size) ** 2 for size, _ in pairs)
+        if variance > 0:
+            per_byte = sum((size - mean_size) * (seconds - mean_seconds) for size, seconds in pairs) / variance
+        else:
+            per_byte = 0
+        if per_byte <= 0:
+            # every file about the same size, or too noisy to tell: all of the time goes with the size
+            models[compressed] = (0, mean_seconds / mean_size if mean_size else 0)
+        else:
+            models[compressed] = (max(mean_seconds - per_byte * mean_size, 0), per_byte)
+    return models
+
+
+def estimate_seconds(files, in_dir, choice, metrics_path=None):
+    # Without any history the cost is the size, compressed files counted at their uncompressed size
+    models = fit_history(metrics_path, choice) if metrics_path else {}
+    costs = {}
+    for filename in files:
+        size = os.path.getsize(os.path.join(in_dir, filename))
+        compressed = is_compressed(filename)
+        if compressed in models:
+            fixed, per_byte = models[compressed]
+            costs[filename] = fixed + per_byte * size
+        elif compressed and False in models:
+            fixed, per_byte = models[False]
+            costs[filename] = fixed + per_byte * size * COMPRESSION_RATIO
+        else:
+            costs[filename] = None
+
+    if any(cost is None for cost in costs.values()):
+        # one file without a model makes the others incomparable, they all go back to sizes
+        costs = {filename: os.path.getsize(os.path.join(in_dir, filename)) *
+                 (COMPRESSION_RATIO if is_compressed(filename) else 1) for filename in files}
+        return costs, False
+    return costs, True
+
+
+def schedule(files, costs, order="cost"):
+    # Most expensive first, so no big file starts last and runs alone while the other cores sit idle.
+    # Ties and "name" go by file name, the same files always come in the same order.
+    if order == "name":
+        return sorted(files)
+    return sorted(files, key=lambda filename: (-costs[filename], filename))
+
+
+def worker_count(parse_workers, files, estimates, memory_budget_mb):
+    # No more workers than cores, files, or median sized files that fit into the memory budget together
+    workers = min(parse_workers or os.cpu_count() or 1, os.cpu_count() or 1, max(len(files), 1))
+    sizes = sorted(estimates.get(filename, 0) for filename in files)
+    if memory_budget_mb and sizes and sizes[len(sizes) // 2] > 0:
+        workers = min(workers, max(1, int(memory_budget_mb * 1024 * 1024 // sizes[len(sizes) // 2])))
+    return workers
+
+
+def format_seconds(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+
+def warm_worker():
+    # The libraries are imported once when the worker starts instead of with its first file. Ctrl-C reaches the
+    # whole process group, the workers leave it to the parent, which lets them finish their files.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    import pandas  # noqa: F401
+    import threads  # noqa: F401
+    import columnar  # noqa: F401
+
+
+def create_pool(parse_workers, max_tasks_per_child, initializer=None):
+    # max_tasks_per_child only exists from python 3.11, older versions keep their workers for the whole run
+    if max_tasks_per_child and sys.version_info >= (3, 11):
+        return concurrent.futures.ProcessPoolExecutor(max_workers=parse_workers, initializer=initializer,
+                                                      max_tasks_per_child=max_tasks_per_child)
+    return concurrent.futures.ProcessPoolExecutor(max_workers=parse_workers, initializer=initializer)
+
+
+def run_pipeline(files, run_kwargs, uploader=None, parse_workers=None, upload_workers=2, queue_size=4,
+                 estimates=None, memory_budget_mb=None, max_tasks_per_child=None, parse_pool=None, costs=None,
+                 warehouse=None):
+    # Parsing runs in processes, uploads in threads of this process. New files are only handed to the parse
+    # pool while the upload stage keeps up and while the estimated memory of the running files fits the budget,
+    # so neither finished outputs nor worker memory can grow without bound.
+    details = []
+    queued = deque(files)
+    parse_workers = parse_workers or os.cpu_count() or 1
+    estimates = estimates or {}
+    budget = memory_budget_mb * 1024 * 1024 if memory_budget_mb else None
+
+    # progress is counted in estimated cost, the ETA assumes the rest goes as fast as what is done so far
+    costs = costs or {filename: 1 for filename in files}
+    total_cost = sum(costs.values()) or 1
+    done_cost = 0
+    start = time.time()
+
+    # a pool that is passed in stays up for the next call (watch mode), one of our own is shut down at the end
+    pool = nullcontext(parse_pool) if parse_pool else create_pool(parse_workers, max_tasks_per_child)
+    with pool as parse_pool, concurrent.futures.ThreadPoolExecutor(max_workers=upload_workers) as upload_pool:
+
+        parse_limit = parse_workers + queue_size
+        parsing, uploading = {}, set()
+
+        while True:
+            while queued and len(parsing) < parse_limit and len(uploading) < queue_size:
+                estimate = estimates.get(queued[0], 0)
+                # one file is always admitted, even when it alone is over the budget
+                if budget and parsing and sum(parsing.values()) + estimate > budget:
+                    break
+
+                filename = queued.popleft()
+                future = parse_pool.submit(run, filename=filename, **run_kwargs)
+                future.filename = filename
+                parsing[future] = estimate
+
+            if not parsing and not uploading:
+                break
+
+            done, _ = concurrent.futures.wait(set(parsing) | uploading,
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                if future in parsing:
+                    del parsing[future]
+                    details.append(future.result())
+
+                    done_cost += costs.get(future.filename, 0)
+                    elapsed = time.time() - start
+                    eta = elapsed * (total_cost - done_cost) / done_cost if done_cost else 0
+                    print(f"[{len(details)}/{len(files)}] {round(100 * done_cost / total_cost)}% done in "
+                          f"{format_seconds(elapsed)}, ETA {format_seconds(eta)}")
+                    if uploader:
+                        uploading.add(upload_pool.submit(uploader.flush))
+                    if warehouse:
+                        uploading.add(upload_pool.submit(warehouse.flush))
+                else:
+                    uploading.remove(future)
+                    try:
+                        future.result()
+                    except Exception as e:
+                        logging.exception(f"Exception occurred! {e}")
+
+    if uploader:
+        uploader.flush(force=True)
+    if warehouse:
+        warehouse.flush()
+
+    return details
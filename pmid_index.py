@@ -0,0 +1,72 @@
+import sqlite3
+import hashlib
+from datetime import datetime
+
+
+def connect(index_path):
+    connection = sqlite3.connect(index_path, timeout=60)
+    connection.execute("PRAGMA journal_mode = WAL")
+    with connection:
+        connection.execute("CREATE TABLE IF NOT EXISTS pmids(pmid INTEGER PRIMARY KEY, date_revised TEXT, "
+                           "fingerprint TEXT, filename TEXT, deleted INTEGER DEFAULT 0, updated TEXT)")
+    return connection
+
+
+def fingerprint(record):
+    # record is what threads.extract_record returns, so only fields that end up in the tables count as a change
+    return hashlib.sha1(repr(record).encode("utf-8")).hexdigest()
+
+
+class ChangeIndex:
+    # PMID -> DateRevised and fingerprint of the last version that was exported. Lookups go to the index while a file
+    # is parsed, the new versions are only written by commit(), once the outputs of the file exist.
+    def __init__(self, index_path, filename):
+        self.index_path = index_path
+        self.filename = filename
+        self.connection = connect(index_path)
+        self.pending = {}
+        self.deleted = {}
+        self.unchanged = 0
+
+    def changed(self, record):
+        article = record[1][0]
+        pmid, date_revised = article[0], article[3]
+        if pmid in self.pending:
+            # the first copy of a PMID is the one that is kept, like INSERT OR IGNORE does
+            return False
+
+        digest = fingerprint(record)
+        row = self.connection.execute("SELECT fingerprint, deleted, filename FROM pmids WHERE pmid = ?",
+                                      (pmid,)).fetchone()
+        # a later file (by name, as PubMed numbers its updates) already brought a newer version or deleted it
+        if row is not None and (row[:2] == (digest, 0) or (row[2] or "") > self.filename):
+            self.unchanged += 1
+            return False
+
+        self.pending[pmid] = (date_revised, digest)
+        return True
+
+    def delete(self, pmids):
+        for pmid in pmids:
+            self.deleted[int(pmid)] = None
+
+    def commit(self):
+        updated = datetime.now().strftime("%m/%d/%Y, %H:%M:%S")
+        with self.connection:
+            # files finish in any order, a row is only replaced by the version of a file that isn't older
+            self.connection.executemany("INSERT INTO pmids VALUES (?, ?, ?, ?, 0, ?) ON CONFLICT(pmid) DO UPDATE SET "
+                                        "date_revised = excluded.date_revised, fingerprint = excluded.fingerprint, "
+                                        "filename = excluded.filename, deleted = 0, updated = excluded.updated "
+                                        "WHERE ifnull(pmids.filename, '') <= excluded.filename",
+                                        [(pmid, date_revised, digest, self.filename, updated)
+                                         for pmid, (date_revised, digest) in self.pending.items()])
+            self.connection.executemany("INSERT INTO pmids(pmid, filename, deleted, updated) VALUES (?, ?, 1, ?) "
+                                        "ON CONFLICT(pmid) DO UPDATE SET filename = excluded.filename, deleted = 1, "
+                                        "updated = excluded.updated WHERE ifnull(pmids.filename, '') <= "
+                                        "excluded.filename",
+                                        [(pmid, self.filename, updated) for pmid in self.deleted])
+        self.pending.clear()
+        self.deleted.clear()
+
+    def close(self):
+        self.connection.close()
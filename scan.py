@@ -0,0 +1,228 @@
+import os
+import re
+import json
+import heapq
+import time
+import concurrent.futures
+from xml_files import open_xml, is_compressed, is_xml_file
+from pipeline import format_seconds, worker_count, estimate_memory, physical_memory_mb
+
+# Only the start tags are looked at, the xml is never parsed. "[\s>/]" keeps AuthorList and MeshHeadingList out.
+TAGS = re.compile(rb"<(PubmedArticle|Author|AffiliationInfo|PublicationType|MeshHeading|/AuthorList)[\s>/]")
+COUNTS = ["articles", "authors", "affiliations", "publication_types", "mesh_headings", "author_rows", "joined_rows",
+          "bytes"]
+
+# Stages whose time goes with the articles and with the rows of the four tables, every other stage goes with the
+# rows that are written out
+DRIVERS = {"parse": "articles", "extract": "articles", "insert": "table_rows", "build": "table_rows"}
+
+
+def close_article(counts, article):
+    # article = [author rows so far, affiliations of the open author or None, publication types].
+    # An author is one row per affiliation or one without any, an article without authors still gets one row, and
+    # the create_csv join repeats the author rows for every publication type.
+    author_rows = article[0] + (max(article[1], 1) if article[1] is not None else 0)
+    author_rows = max(author_rows, 1)
+    counts["author_rows"] += author_rows
+    counts["joined_rows"] += author_rows * max(article[2], 1)
+
+
+def count_range(path, start=0, end=None, chunk_size=1 << 20):
+    # Counts the articles that start in [start, end) of the file, the last one is read past end to its own end
+    counts = dict.fromkeys(COUNTS, 0)
+    article = None
+    position, carry = start, b""
+
+    with open_xml(path) as file:
+        if start:
+            file.seek(start)
+        while True:
+            chunk = file.read(chunk_size)
+            data = carry + chunk
+            # a tag cut in two by the chunk is left for the next round
+            cut = data.rfind(b"<") if chunk else len(data)
+            if cut < 0:
+                cut = len(data)
+
+            for match in TAGS.finditer(data, 0, cut):
+                tag = match.group(1)
+                if tag == b"PubmedArticle":
+                    if article is not None:
+                        close_article(counts, article)
+                    if end is not None and position + match.start() >= end:
+                        counts["bytes"] = end - start
+                        return counts
+                    counts["articles"] += 1
+                    article = [0, None, 0]
+                elif article is None:
+                    continue  # the end of an article that belongs to the range before
+                elif tag == b"Author":
+                    counts["authors"] += 1
+                    if article[1] is not None:
+                        article[0] += max(article[1], 1)
+                    article[1] = 0
+                elif tag == b"AffiliationInfo":
+                    # investigators have affiliations as well, they come after the AuthorList
+                    if article[1] is not None:
+                        counts["affiliations"] += 1
+                        article[1] += 1
+                elif tag == b"/AuthorList":
+                    if article[1] is not None:
+                        article[0] += max(article[1], 1)
+                        article[1] = None
+                elif tag == b"PublicationType":
+                    counts["publication_types"] += 1
+                    article[2] += 1
+                else:
+                    counts["mesh_headings"] += 1
+
+            position += cut
+            carry = data[cut:]
+            if not chunk:
+                break
+
+    if article is not None:
+        close_article(counts, article)
+    counts["bytes"] = (position if end is None else min(position, end)) - start
+    return counts
+
+
+def file_ranges(path, part_bytes):
+    # Plain files are cut into byte ranges that are counted in parallel, compressed ones are read as a whole
+    size = os.path.getsize(path)
+    if is_compressed(path) or size <= part_bytes:
+        return [(0, None)]
+    return [(start, min(start + part_bytes, size)) for start in range(0, size, part_bytes)]
+
+
+def scan_files(files, in_dir, workers=None, part_mb=64):
+    totals = {filename: dict.fromkeys(COUNTS, 0) for filename in files}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1) as pool:
+        futures = {}
+        for filename in files:
+            path = os.path.join(in_dir, filename)
+            for start, end in file_ranges(path, part_mb * 1024 * 1024):
+                futures[pool.submit(count_range, path, start, end)] = filename
+
+        for future in concurrent.futures.as_completed(futures):
+            counts = future.result()
+            for key in COUNTS:
+                totals[futures[future]][key] += counts[key]
+
+    for counts in totals.values():
+        counts["table_rows"] = counts["articles"] + counts["mesh_headings"] + counts["publication_types"] + \
+            counts["author_rows"]
+        counts["output_rows"] = counts["joined_rows"] + counts["mesh_headings"]
+    return totals
+
+
+def history(metrics_path, choice, conversion_type):
+    # Seconds per article, per table row and per output row of every stage, output bytes per output row and load
+    # seconds per byte, from the earlier files of the same choice and conversion (or of any, if there are none)
+    files, loads = [], []
+    try:
+        with open(metrics_path, "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get("event") == "file" and record.get("status") == "ok" and record.get("records"):
+                    files.append(record)
+                elif record.get("event") == "load" and record.get("bytes"):
+                    loads.append(record)
+    except (OSError, TypeError):
+        pass
+
+    same = [record for record in files
+            if record.get("choice") == choice and record.get("conversion_type") == conversion_type]
+    files = same or files
+    if not files:
+        return None
+
+    totals = {"articles": 0, "table_rows": 0, "output_rows": 0, "bytes_out": 0, "other": 0}
+    stages = {}
+    for record in files:
+        table_rows = sum(record.get("rows", {}).values())
+        output_rows = sum(rows for rows in record.get("outputs", {}).values() if rows) or table_rows
+        totals["articles"] += record["records"]
+        totals["table_rows"] += table_rows
+        totals["output_rows"] += output_rows
+        totals["bytes_out"] += record.get("bytes_out", 0)
+        totals["other"] += max(record.get("time_taken", 0) - sum(record["stages"].values()), 0)
+        for stage, seconds in record["stages"].items():
+            stages[stage] = stages.get(stage, 0) + seconds
+
+    rates = {stage: (DRIVERS.get(stage, "output_rows"), seconds / (totals[DRIVERS.get(stage, "output_rows")] or 1))
+             for stage, seconds in stages.items()}
+    load_bytes = sum(record["bytes"] for record in loads)
+    return {"files": len(files), "same": bool(same), "stages": rates,
+            "bytes_per_row": totals["bytes_out"] / (totals["output_rows"] or 1),
+            "seconds_per_file": totals["other"] / len(files),
+            "load_seconds_per_byte": sum(record["seconds"] for record in loads) / load_bytes if load_bytes else 0}
+
+
+def predict(counts, rates):
+    seconds = rates["seconds_per_file"] + sum(rate * counts[driver] for driver, rate in rates["stages"].values())
+    return seconds, counts["output_rows"] * rates["bytes_per_row"]
+
+
+def makespan(seconds, workers):
+    # Largest first onto whichever worker is free first, the way the pipeline hands the files out
+    finish = [0] * max(workers, 1)
+    for file_seconds in sorted(seconds, reverse=True):
+        heapq.heappush(finish, heapq.heappop(finish) + file_seconds)
+    return max(finish)
+
+
+def scan(files, in_dir, choice, bigquery, metrics_path=None, parse_workers=None, upload_workers=2, memory_factor=10,
+         memory_budget_mb=None, part_mb=64):
+    start = time.time()
+    totals = scan_files(files, in_dir, None, part_mb)
+    scan_seconds = time.time() - start
+
+    rates = history(metrics_path, choice, "BigQuery" if bigquery else "csv") if metrics_path else None
+    estimates = {}
+    print(f"{'file':<32} {'articles':>10} {'csv rows':>12} {'mesh rows':>12} {'MB out':>10} {'secs':>10}")
+    for filename in files:
+        counts = totals[filename]
+        seconds, bytes_out = predict(counts, rates) if rates else (None, None)
+        estimates[filename] = (seconds, bytes_out)
+        print(f"{filename[:32]:<32} {counts['articles']:>10} {counts['joined_rows']:>12} "
+              f"{counts['mesh_headings']:>12} {'-' if rates is None else round(bytes_out / 1024 / 1024, 1):>10} "
+              f"{'-' if rates is None else round(seconds, 1):>10}")
+
+    articles = sum(counts["articles"] for counts in totals.values())
+    scanned = sum(counts["bytes"] for counts in totals.values())
+    print(f"{len(files)} file(s), {articles} articles, {sum(c['joined_rows'] for c in totals.values())} csv rows, "
+          f"{sum(c['mesh_headings'] for c in totals.values())} mesh rows, "
+          f"{sum(c['author_rows'] for c in totals.values())} author rows, "
+          f"{sum(c['publication_types'] for c in totals.values())} publication types")
+    print(f"Scanned {round(scanned / 1024 / 1024, 1)} MB of xml in {round(scan_seconds, 2)} secs")
+
+    if rates is None:
+        print("No earlier runs in the metrics file, convert a few files first to get byte and time estimates")
+        return totals
+
+    budget = memory_budget_mb or physical_memory_mb()
+    workers = worker_count(parse_workers, files, estimate_memory(files, in_dir, choice, memory_factor), budget)
+    seconds = {filename: estimates[filename][0] for filename in files}
+    wall = makespan(seconds.values(), workers)
+    bytes_out = sum(bytes_out for _, bytes_out in estimates.values())
+    if bigquery:
+        # the uploads overlap with the parsing, only when they are slower do they add to the run
+        wall = max(wall, bytes_out * rates["load_seconds_per_byte"] / max(upload_workers, 1))
+
+    basis = f"{choice} {'BigQuery' if bigquery else 'csv'}" if rates["same"] else "other choices or conversions"
+    print(f"Estimated {round(bytes_out / 1024 / 1024, 1)} MB out, {format_seconds(wall)} on {workers} worker(s) "
+          f"({format_seconds(sum(seconds.values()))} of work), from {rates['files']} earlier file(s) of {basis}")
+    return totals
+
+
+def select_files(in_dir, selection=None):
+    files = sorted(xml for xml in os.listdir(in_dir) if is_xml_file(xml))
+    if selection and selection.isnumeric():
+        return files[:int(selection)]
+    if selection and selection.lower() != "all":
+        return [selection] if selection in files else []
+    return files
@@ -0,0 +1,95 @@
+# Columns of the tables created in threads.database_setup, in the order extract_record returns them
+TABLE_COLUMNS = {
+    "pm_ext_mesh_headings": ["pmid", "descriptor_uid", "major_descriptor"],
+    "pm_ext_articles_revised_journals": ["pmid", "article_title", "date_created", "date_revised", "issn", "issn_type",
+                                         "cited_medium", "volume", "issue", "year", "month", "title",
+                                         "iso_abbreviation", "nlm_uid"],
+    "pm_ext_publication_types": ["pmid", "publication_type", "publication_type_ui", "publication_type_ordinality"],
+    "pm_ext_authors_affiliations": ["pmid", "author_ordinality", "initials", "fore_name", "last_name",
+                                    "affiliation_ordinality", "affiliation"]
+}
+
+TABLE_KEYS = {
+    "pm_ext_mesh_headings": ["pmid", "descriptor_uid"],
+    "pm_ext_articles_revised_journals": ["pmid"],
+    "pm_ext_publication_types": ["pmid", "publication_type_ordinality"],
+    "pm_ext_authors_affiliations": ["pmid", "author_ordinality", "affiliation_ordinality"]
+}
+
+# Tables of the temporary databases, the warehouse handoffs and the warehouse itself
+CREATE_TABLES = {
+    "pm_ext_authors_affiliations": "CREATE TABLE pm_ext_authors_affiliations(pmid INTEGER, "
+                                   "author_ordinality INTEGER, initials TEXT, fore_name TEXT, last_name TEXT, "
+                                   "affiliation_ordinality INTEGER, affiliation TEXT, PRIMARY KEY(pmid, "
+                                   "author_ordinality, affiliation_ordinality), UNIQUE(pmid, author_ordinality, "
+                                   "affiliation_ordinality))",
+    "pm_ext_articles_revised_journals": "CREATE TABLE pm_ext_articles_revised_journals(pmid INTEGER PRIMARY KEY "
+                                        "UNIQUE, article_title TEXT, date_created TEXT, date_revised TEXT, issn TEXT, "
+                                        "issn_type TEXT, cited_medium TEXT, volume TEXT, issue TEXT, "
+                                        "year TEXT, month TEXT,title TEXT, iso_abbreviation TEXT, nlm_uid TEXT)",
+    "pm_ext_mesh_headings": "CREATE TABLE pm_ext_mesh_headings(pmid INTEGER, descriptor_uid TEXT, "
+                            "major_descriptor TEXT,PRIMARY KEY(pmid, descriptor_uid), UNIQUE(pmid, descriptor_uid))",
+    "pm_ext_publication_types": "CREATE TABLE pm_ext_publication_types(pmid INTEGER, publication_type TEXT, "
+                                "publication_type_ui TEXT, publication_type_ordinality INTEGER, "
+                                "PRIMARY KEY(pmid, publication_type_ordinality), UNIQUE(pmid, "
+                                "publication_type_ordinality))"
+}
+
+INSERT_QUERIES = {table: f"INSERT OR IGNORE INTO {table}({', '.join(columns)}) "
+                         f"VALUES ({', '.join('?' for _ in columns)})" for table, columns in TABLE_COLUMNS.items()}
+
+# BigQuery types of the csv outputs, the ones pandas_gbq and the parquet loads give the same outputs: integers for
+# the ids and ordinalities, text for everything else. Star keys are integers.
+CSV_TYPES = {"row_id": "INTEGER", "pmid": "INTEGER", "publication_year": "INTEGER",
+             "author_ordinality": "INTEGER", "affiliation_ordinality": "INTEGER",
+             "publication_type_ordinality": "INTEGER"}
+
+
+def csv_schema(columns):
+    # every csv output starts with row_id and filename
+    return [{"name": column, "type": CSV_TYPES.get(column, "INTEGER" if column.endswith("_key") else "STRING"),
+             "mode": "NULLABLE"} for column in ["row_id", "filename"] + list(columns)]
+
+
+CSV_COLUMNS = ["pmid", "article_title", "date_created", "affiliation", "affiliation_ordinality", "author_ordinality",
+               "initials", "fore_name", "last_name", "date_revised", "issn", "issn_type", "cited_medium", "volume",
+               "issue", "year", "month", "title", "iso_abbreviation", "nlm_uid", "publication_type",
+               "publication_type_ui", "publication_type_ordinality"]
+
+# BigQuery schema of the nested layout: one row per PMID with the child tables as REPEATED records
+NESTED_SCHEMA = [
+    {"name": "pmid", "type": "INTEGER", "mode": "REQUIRED"},
+    {"name": "filename", "type": "STRING", "mode": "NULLABLE"},
+    {"name": "article_title", "type": "STRING", "mode": "NULLABLE"},
+    {"name": "date_created", "type": "STRING", "mode": "NULLABLE"},
+    {"name": "date_revised", "type": "STRING", "mode": "NULLABLE"},
+    {"name": "issn", "type": "STRING", "mode": "NULLABLE"},
+    {"name": "issn_type", "type": "STRING", "mode": "NULLABLE"},
+    {"name": "cited_medium", "type": "STRING", "mode": "NULLABLE"},
+    {"name": "volume", "type": "STRING", "mode": "NULLABLE"},
+    {"name": "issue", "type": "STRING", "mode": "NULLABLE"},
+    {"name": "year", "type": "STRING", "mode": "NULLABLE"},
+    {"name": "month", "type": "STRING", "mode": "NULLABLE"},
+    {"name": "title", "type": "STRING", "mode": "NULLABLE"},
+    {"name": "iso_abbreviation", "type": "STRING", "mode": "NULLABLE"},
+    {"name": "nlm_uid", "type": "STRING", "mode": "NULLABLE"},
+    {"name": "authors", "type": "RECORD", "mode": "REPEATED", "fields": [
+        {"name": "author_ordinality", "type": "INTEGER", "mode": "NULLABLE"},
+        {"name": "initials", "type": "STRING", "mode": "NULLABLE"},
+        {"name": "fore_name", "type": "STRING", "mode": "NULLABLE"},
+        {"name": "last_name", "type": "STRING", "mode": "NULLABLE"},
+        {"name": "affiliations", "type": "RECORD", "mode": "REPEATED", "fields": [
+            {"name": "affiliation_ordinality", "type": "INTEGER", "mode": "NULLABLE"},
+            {"name": "affiliation", "type": "STRING", "mode": "NULLABLE"}
+        ]}
+    ]},
+    {"name": "publication_types", "type": "RECORD", "mode": "REPEATED", "fields": [
+        {"name": "publication_type_ordinality", "type": "INTEGER", "mode": "NULLABLE"},
+        {"name": "publication_type", "type": "STRING", "mode": "NULLABLE"},
+        {"name": "publication_type_ui", "type": "STRING", "mode": "NULLABLE"}
+    ]},
+    {"name": "mesh_headings", "type": "RECORD", "mode": "REPEATED", "fields": [
+        {"name": "descriptor_uid", "type": "STRING", "mode": "NULLABLE"},
+        {"name": "major_descriptor", "type": "BOOLEAN", "mode": "NULLABLE"}
+    ]}
+]
@@ -0,0 +1,72 @@
+import re
+
+YEAR_COLUMN = "publication_year"
+DEFAULT_SIZES = {"year": 1, "pmid": 1000000}
+YEARS = (1800, 2200)
+PMID_MAX = 50000000  # PubMed is somewhere after 39 million, "shard_pmid_max" moves it
+MAX_PARTITIONS = 10000  # BigQuery's limit per table
+
+
+def shard_size(output):
+    return int(output.get("shard_size") or DEFAULT_SIZES[output["shard_by"]])
+
+
+def publication_year(year):
+    # "1998", "1998-1999" and "2001 Spring" all count as the first year they name
+    match = re.match(r"\d{4}", str(year or ""))
+    return int(match.group()) if match else None
+
+
+def shard_start(value, size):
+    if value is None:
+        return None
+    return value - value % size
+
+
+def shard_name(shard_by, start):
+    return f"{shard_by}_{'unknown' if start is None else start}"
+
+
+def shard_columns(output):
+    return [YEAR_COLUMN] if output["shard_by"] == "year" else []
+
+
+def shard_key(output, columns, years=None):
+    # key(row) -> (start of the shard the row belongs to, values of the shard_columns); years maps pmid -> year
+    # for outputs without a year column of their own, like mesh
+    size = shard_size(output)
+    pmid = columns.index("pmid")
+    if output["shard_by"] == "pmid":
+        return lambda row: (shard_start(row[pmid], size), ())
+
+    year = columns.index("year") if "year" in columns else None
+
+    def key(row):
+        value = publication_year(row[year] if year is not None else years.get(row[pmid]))
+        return shard_start(value, size), (value,)
+    return key
+
+
+def table_spec(output, clustering=None):
+    # Integer range partitioning on the shard column, clustering only comes along with it: BigQuery can't change
+    # the spec of an existing table, so the tables of unsharded runs are loaded as they always were
+    if not output.get("shard_by"):
+        return None
+
+    size = shard_size(output)
+    if output["shard_by"] == "year":
+        start, end, field = YEARS[0], YEARS[1], YEAR_COLUMN
+    else:
+        # the whole PMID space, rows past the end would all land in one __UNPARTITIONED__ partition
+        start, end, field = 0, int(output.get("shard_pmid_max") or PMID_MAX), "pmid"
+
+    partitions = -(-(end - start) // size)
+    if partitions > MAX_PARTITIONS:
+        raise ValueError(f"shard_size {size} needs {partitions} partitions for {field} {start} to {end}, BigQuery "
+                         f"allows {MAX_PARTITIONS}: use a shard_size of at least {-(-(end - start) // MAX_PARTITIONS)}")
+
+    spec = {"range_partitioning": {"field": field, "start": start, "end": start + partitions * size,
+                                   "interval": size}}
+    if clustering:
+        spec["clustering_fields"] = list(clustering)
+    return spec
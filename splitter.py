@@ -0,0 +1,158 @@
+import os
+import re
+import mmap
+import logging
+import concurrent.futures
+from bisect import bisect_left
+from xml.etree import ElementTree
+import columnar
+import threads
+from threads import create_mesh_csv, create_csv, upload_frames, staging_dir, output_settings, article_years
+from pmid_index import ChangeIndex
+import metrics
+
+logging.basicConfig(filename="logs.log", filemode='a', format='%(name)s - %(levelname)s - %(message)s')
+
+ARTICLE_START = re.compile(rb"<PubmedArticle[\s>]")
+
+
+def article_offsets(path):
+    # Byte offset of every <PubmedArticle>, and where the closing </PubmedArticleSet> starts
+    if os.path.getsize(path) == 0:
+        return [], 0
+
+    with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        offsets = [match.start() for match in ARTICLE_START.finditer(data)]
+        end = data.rfind(b"</PubmedArticleSet>")
+        if end < 0:
+            end = len(data)
+
+    return offsets, end
+
+
+def split_ranges(path, parts):
+    # Cuts the file into about equally sized byte ranges that only ever start on an article boundary
+    offsets, end = article_offsets(path)
+    if not offsets:
+        return []
+
+    bounds = [offsets[0]]
+    size = end - offsets[0]
+    for part in range(1, parts):
+        index = bisect_left(offsets, offsets[0] + size * part // parts)
+        if index < len(offsets) and offsets[index] > bounds[-1]:
+            bounds.append(offsets[index])
+    bounds.append(end)
+
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def iter_range(path, start, end, deleted=None, chunk_size=1 << 16):
+    from intermediate import ArticleBuilder
+
+    builder = ArticleBuilder()
+    parser = ElementTree.XMLParser(target=builder)
+
+    # the range is only a run of articles, wrapping it makes it a document of its own
+    parser.feed(b"<PubmedArticleSet>")
+    with open(path, "rb") as file:
+        file.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = file.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+
+            parser.feed(chunk)
+            yield from builder.articles
+            builder.articles.clear()
+
+    parser.feed(b"</PubmedArticleSet>")
+    parser.close()
+    yield from builder.articles
+    if deleted is not None:
+        deleted.extend(builder.deleted)
+
+
+def parse_range(path, index, start, end, choice, batch_size, cache_size_mb, filename=None, change_index=None):
+    # Every range looks its records up in the change index on its own, the parent commits what they found
+    deleted = []
+    data = iter_range(path, start, end, deleted)
+    changes = ChangeIndex(change_index, filename) if change_index else None
+
+    if choice == "columnar":
+        frames = columnar.build_frames(data, changes)
+    else:
+        threads.connection_opener(choice, f"{os.path.basename(path)}.part{index}", cache_size_mb)
+        threads.database_setup(path)
+        threads.fed_database(data, path, batch_size, changes)
+
+        frames = threads.mesh_frame(), threads.joined_frame()
+        threads.connection.close()
+
+    if changes is None:
+        return frames, {}, deleted, 0
+
+    changes.close()
+    return frames, changes.pending, deleted, changes.unchanged
+
+
+def merge_frames(parts):
+    # A PMID that shows up in more than one range is kept from the first one, like INSERT OR IGNORE would
+    import pandas as pd
+
+    mesh = pd.concat([part[0] for part in parts], ignore_index=True)
+    mesh = mesh.drop_duplicates(subset=["pmid", "descriptor_uid"], keep="first", ignore_index=True)
+
+    seen = set()
+    joined = []
+    for _, part in parts:
+        joined.append(part[~part["pmid"].isin(seen)])
+        seen.update(part["pmid"].unique())
+
+    # sorted by pmid, the order a single SQLite database returns the join in
+    joined = pd.concat(joined, ignore_index=True).sort_values("pmid", kind="stable", ignore_index=True)
+    return mesh, joined
+
+
+def execute_split(path, filename, choice, workers, bigquery, bg_upload_type, bg_project_id, bg_data_set,
+                  bg_table_name, out_dir, batch_size=5000, cache_size_mb=64, output=None, progress=None, changes=None,
+                  deleted=None):
+    ranges = split_ranges(path, workers)
+    change_index = changes.index_path if changes is not None else None
+
+    # the ranges are measured as one stage, their own stages happen in the other processes
+    with metrics.stage("split_parse"), concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(parse_range, path, index, start, end, choice, batch_size, cache_size_mb,
+                                   filename, change_index)
+                   for index, (start, end) in enumerate(ranges)]
+        results = [future.result() for future in futures]
+
+    parts = []
+    for frames, pending, range_deleted, unchanged in results:
+        parts.append(frames)
+        if changes is not None:
+            for pmid, version in pending.items():
+                changes.pending.setdefault(pmid, version)
+            changes.unchanged += unchanged
+        if deleted is not None:
+            deleted.extend(range_deleted)
+
+    if progress:
+        progress("parsed")
+
+    with metrics.stage("merge"):
+        if parts:
+            mesh, joined = merge_frames(parts)
+        else:
+            mesh, joined = columnar.build_frames([])
+    metrics.count("records", int(joined["pmid"].nunique()))
+
+    # row_id is numbered here, after the merge, so it runs over the whole file
+    output = output_settings(output)
+    df1 = create_mesh_csv(filename, bigquery, out_dir, df=mesh, output=output, years=article_years(output, joined))
+    df2 = create_csv(filename, bigquery, out_dir, df=joined, output=output)
+
+    return upload_frames(df1, df2, filename, bigquery, bg_upload_type, bg_project_id, bg_data_set, bg_table_name,
+                         staging_dir(output), output)
@@ -0,0 +1,126 @@
+import json
+import sqlite3
+from schema import TABLE_COLUMNS
+from xml_files import base_name
+
+# Dimension tables and the columns of their natural key
+DIMENSIONS = {
+    "journals": ["issn", "issn_type", "title", "iso_abbreviation", "nlm_uid"],
+    "affiliations": ["affiliation"],
+    "publication_types": ["publication_type", "publication_type_ui"],
+}
+
+# Source table of every fact table, the columns it keeps and which dimension replaces the rest
+FACTS = {
+    "articles": ("pm_ext_articles_revised_journals", ["pmid", "article_title", "date_created", "date_revised",
+                                                      "cited_medium", "volume", "issue", "year", "month"], "journals"),
+    "authors": ("pm_ext_authors_affiliations", ["pmid", "author_ordinality", "initials", "fore_name", "last_name",
+                                                "affiliation_ordinality"], "affiliations"),
+    "publication_types": ("pm_ext_publication_types", ["pmid", "publication_type_ordinality"], "publication_types"),
+    "mesh": ("pm_ext_mesh_headings", ["pmid", "descriptor_uid", "major_descriptor"], None),
+}
+
+
+def key_column(dimension):
+    return dimension.rstrip("s") + "_key"
+
+
+def output_columns(table):
+    # columns of a fact table or of a "dim_<dimension>" output, after row_id and filename
+    if table.startswith("dim_"):
+        return [key_column(table[4:])] + DIMENSIONS[table[4:]]
+    source, columns, dimension = FACTS[table]
+    return columns + ([key_column(dimension)] if dimension else [])
+
+
+def connect(index_path):
+    connection = sqlite3.connect(index_path, timeout=60, isolation_level=None)
+    connection.execute("PRAGMA journal_mode = WAL")
+    for dimension, columns in DIMENSIONS.items():
+        connection.execute(f"CREATE TABLE IF NOT EXISTS {dimension}({key_column(dimension)} INTEGER PRIMARY KEY, "
+                           f"natural_key TEXT UNIQUE, {', '.join(column + ' TEXT' for column in columns)}, "
+                           f"claimed_by TEXT)")
+    return connection
+
+
+def getter(table, columns):
+    indexes = [TABLE_COLUMNS[table].index(column) for column in columns]
+    return lambda row: tuple(row[index] for index in indexes)
+
+
+def natural_key(values):
+    if all(value is None for value in values):
+        return None
+    return json.dumps(values)
+
+
+def assign_keys(index_path, filename, values):
+    # Surrogate keys stay the same across files and runs. Every dimension row is written out once, by the first
+    # file that uses it; a file that fails keeps its claim and writes the rows again when it is run again.
+    connection = connect(index_path)
+    try:
+        connection.execute("BEGIN IMMEDIATE")
+        keys, new_rows = {}, {}
+        for dimension, columns in DIMENSIONS.items():
+            natural = {natural_key(value): value for value in values[dimension]}
+            natural.pop(None, None)
+
+            connection.executemany(f"INSERT OR IGNORE INTO {dimension}(natural_key, {', '.join(columns)}) "
+                                   f"VALUES (?, {', '.join('?' for _ in columns)})",
+                                   [(key,) + value for key, value in sorted(natural.items())])
+
+            # sorted, so the same files get the same keys on every run
+            keys[dimension], new_rows[dimension] = {}, []
+            for key in sorted(natural):
+                row = connection.execute(f"SELECT {key_column(dimension)}, claimed_by, {', '.join(columns)} "
+                                         f"FROM {dimension} WHERE natural_key = ?", (key,)).fetchone()
+                keys[dimension][natural[key]] = row[0]
+                if row[1] is None or row[1] == filename:
+                    new_rows[dimension].append((row[0],) + row[2:])
+
+            connection.executemany(f"UPDATE {dimension} SET claimed_by = ? WHERE {key_column(dimension)} = ?",
+                                   [(filename, row[0]) for row in new_rows[dimension]])
+        connection.execute("COMMIT")
+    except Exception:
+        connection.execute("ROLLBACK")
+        raise
+    finally:
+        connection.close()
+
+    return keys, new_rows
+
+
+def fact_rows(rows, columns, source, dimension, keys):
+    keep = getter(source, columns)
+    if dimension is None:
+        return (keep(row) for row in rows)
+
+    lookup = getter(source, DIMENSIONS[dimension])
+    return (keep(row) + (keys[dimension].get(lookup(row)),) for row in rows)
+
+
+def export_star(filename, tables, output, write):
+    # tables() gives a fresh iterable of rows for every source table, it is walked twice: once for the distinct
+    # dimension values, once to write the facts. write(columns, rows, name) writes one output and returns its path.
+    values = {dimension: set() for dimension in DIMENSIONS}
+    sources = tables()
+    for fact, (source, columns, dimension) in FACTS.items():
+        if dimension is None:
+            continue
+        lookup = getter(source, DIMENSIONS[dimension])
+        values[dimension].update(lookup(row) for row in sources[source])
+
+    keys, new_rows = assign_keys(output.get("dimension_index"), filename, values)
+
+    name = base_name(filename)
+    paths = {}
+    sources = tables()
+    for fact, (source, columns, dimension) in FACTS.items():
+        paths[fact] = write(output_columns(fact), fact_rows(sources[source], columns, source, dimension, keys),
+                            f"{name}_{fact}")
+
+    for dimension, rows in new_rows.items():
+        if rows:
+            paths[f"dim_{dimension}"] = write(output_columns(f"dim_{dimension}"), rows, f"{name}_dim_{dimension}")
+
+    return paths
@@ -0,0 +1,23 @@
+import os
+import sys
+import pytest
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPOSITORY)
+sys.path.insert(0, os.path.join(REPOSITORY, "benchmarks"))
+
+from generate import Settings, generate  # noqa: E402
+
+
+@pytest.fixture
+def work_dir(tmp_path, monkeypatch):
+    # the modules write logs.log and temporary/ into the current directory
+    monkeypatch.chdir(tmp_path)
+    for folder in ("temporary", "in/converted_xml", "out"):
+        os.makedirs(folder)
+    return tmp_path
+
+
+def write_xml(path, articles=20, seed=1, start_pmid=1, delete_rate=0.0):
+    generate(str(path), Settings(articles=articles, seed=seed, start_pmid=start_pmid, delete_rate=delete_rate))
+    return str(path)
@@ -0,0 +1,105 @@
+import os
+import re
+import csv
+import shutil
+import sqlite3
+import pytest
+import intermediate
+from pmid_index import ChangeIndex
+from conftest import write_xml
+
+
+def convert(work_dir, filename, choice, out_dir, change_index):
+    os.makedirs(out_dir)
+    intermediate.run(filename, choice=choice, bigquery=False, bg_upload_type="append", bg_project_id=None,
+                     bg_data_set=None, bg_table_name=None, in_dir=str(work_dir / "in"), out_dir=out_dir,
+                     change_index=change_index)
+    found = {}
+    for name in os.listdir(os.path.join(out_dir, "CSV")):
+        with open(os.path.join(out_dir, "CSV", name), newline="", encoding="utf-8") as file:
+            found[name] = {int(row["pmid"]) for row in csv.DictReader(file)}
+    return found
+
+
+@pytest.mark.parametrize("choice", ["memory", "columnar"])
+def test_unchanged_pmids_are_skipped(work_dir, choice):
+    index = str(work_dir / "pmids.db")
+    write_xml(work_dir / "in" / "a.xml", articles=30)
+    first = convert(work_dir, "a.xml", choice, str(work_dir / "first"), index)
+    assert first["a.csv"] == set(range(1, 31))
+
+    # the same articles again, and ten new ones that follow them
+    shutil.copy(str(work_dir / "in" / "converted_xml" / "a.xml"), str(work_dir / "in" / "b.xml"))
+    write_xml(work_dir / "in" / "c.xml", articles=10, seed=2, start_pmid=31)
+    assert convert(work_dir, "b.xml", choice, str(work_dir / "second"), index)["b.csv"] == set()
+    assert convert(work_dir, "c.xml", choice, str(work_dir / "third"), index)["c.csv"] == set(range(31, 41))
+
+    # the same PMIDs with other content are exported again
+    write_xml(work_dir / "in" / "d.xml", articles=30, seed=3)
+    assert convert(work_dir, "d.xml", choice, str(work_dir / "fourth"), index)["d.csv"] == set(range(1, 31))
+
+
+@pytest.mark.parametrize("choice", ["memory", "columnar"])
+def test_deleted_pmids_get_tombstones(work_dir, choice):
+    index = str(work_dir / "pmids.db")
+    path = write_xml(work_dir / "in" / "a.xml", articles=40, delete_rate=0.2)
+    with open(path, encoding="utf-8") as file:
+        deletes = re.search(r"<DeleteCitation>.*</DeleteCitation>", file.read(), re.S).group()
+    deleted = {int(pmid) for pmid in re.findall(r">(\d+)</PMID>", deletes)}
+    assert deleted
+
+    found = convert(work_dir, "a.xml", choice, str(work_dir / "out_a"), index)
+    assert found["a_deleted.csv"] == deleted
+
+    connection = sqlite3.connect(index)
+    try:
+        marked = {pmid for (pmid,) in connection.execute("SELECT pmid FROM pmids WHERE deleted = 1")}
+    finally:
+        connection.close()
+    assert marked == deleted
+
+    # a file without DeleteCitation writes no tombstones
+    write_xml(work_dir / "in" / "b.xml", articles=5, seed=2, start_pmid=100)
+    assert "b_deleted.csv" not in convert(work_dir, "b.xml", choice, str(work_dir / "out_b"), index)
+
+
+@pytest.mark.parametrize("choice", ["memory", "columnar"])
+def test_older_file_finishing_late(work_dir, choice):
+    index = str(work_dir / "pmids.db")
+    write_xml(work_dir / "in" / "b.xml", articles=20, seed=2)
+    write_xml(work_dir / "in" / "a.xml", articles=20, seed=1)
+
+    # b is the newer update, a finishes after it and must neither be exported nor replace b's versions
+    assert convert(work_dir, "b.xml", choice, str(work_dir / "b"), index)["b.csv"] == set(range(1, 21))
+    assert convert(work_dir, "a.xml", choice, str(work_dir / "a"), index)["a.csv"] == set()
+
+    connection = sqlite3.connect(index)
+    try:
+        assert {filename for (filename,) in connection.execute("SELECT filename FROM pmids")} == {"b.xml"}
+    finally:
+        connection.close()
+
+    shutil.copy(str(work_dir / "in" / "converted_xml" / "b.xml"), str(work_dir / "in" / "b.xml"))
+    assert convert(work_dir, "b.xml", choice, str(work_dir / "b_again"), index)["b.csv"] == set()
+
+
+def test_tombstone_of_a_later_file_stays(work_dir):
+    index = str(work_dir / "pmids.db")
+    record = (None, [(5, "title", None, "2020-01-01")])
+
+    later = ChangeIndex(index, "b.xml")
+    later.delete([5])
+    later.commit()
+    later.close()
+
+    earlier = ChangeIndex(index, "a.xml")
+    assert not earlier.changed(record)
+    earlier.pending[5] = ("2020-01-01", "digest")
+    earlier.commit()
+    earlier.close()
+
+    connection = sqlite3.connect(index)
+    try:
+        assert connection.execute("SELECT filename, deleted FROM pmids WHERE pmid = 5").fetchone() == ("b.xml", 1)
+    finally:
+        connection.close()
@@ -0,0 +1,88 @@
+import os
+import threading
+import manifest
+import intermediate
+from main import skip_finished
+from uploader import Uploader, SQLiteBackend, pending_files
+from conftest import write_xml
+
+
+def test_stages_and_uploads(tmp_path):
+    path = str(tmp_path / "manifest.db")
+    outputs = [str(tmp_path / "a.csv.gz"), str(tmp_path / "a_mesh.csv.gz")]
+
+    manifest.set_stage(path, "hash", "BigQuery", "a.xml", 10, "parsed")
+    assert manifest.get_stage(path, "hash", "BigQuery") == "parsed"
+
+    manifest.add_outputs(path, "hash", outputs)
+    manifest.set_stage(path, "hash", "BigQuery", "a.xml", 10, "exported", outputs)
+    assert sorted(manifest.pending_outputs(path, "hash")) == sorted(outputs)
+
+    manifest.mark_uploaded(path, outputs[:1])
+    assert manifest.get_stage(path, "hash", "BigQuery") == "exported"
+    manifest.mark_uploaded(path, outputs[1:])
+    assert manifest.get_stage(path, "hash", "BigQuery") == "uploaded"
+    assert manifest.pending_outputs(path, "hash") == []
+    assert manifest.is_complete("uploaded", "BigQuery") and not manifest.is_complete("exported", "BigQuery")
+    assert manifest.is_complete("exported", "csv")
+
+
+def test_uploaded_before_exported(tmp_path):
+    # the upload stage can load the outputs before the worker gets to mark its file exported
+    path = str(tmp_path / "manifest.db")
+    outputs = [str(tmp_path / "a.csv.gz")]
+
+    manifest.add_outputs(path, "hash", outputs)
+    manifest.mark_uploaded(path, outputs)
+    manifest.set_stage(path, "hash", "BigQuery", "a.xml", 10, "exported", outputs)
+    assert manifest.get_stage(path, "hash", "BigQuery") == "uploaded"
+
+
+def test_skip_finished(work_dir):
+    manifest_path = str(work_dir / "manifest.db")
+    in_dir = str(work_dir / "in")
+    for name, seed in (("done.xml", 1), ("resumed.xml", 2), ("new.xml", 3)):
+        write_xml(work_dir / "in" / name, articles=3, seed=seed)
+
+    def mark(name, stage, outputs=()):
+        file_hash = manifest.file_hash(manifest_path, os.path.join(in_dir, name))
+        manifest.add_outputs(manifest_path, file_hash, outputs)
+        manifest.set_stage(manifest_path, file_hash, "BigQuery", name, 0, stage, outputs)
+
+    staged = work_dir / "staged.csv.gz"
+    staged.write_bytes(b"")
+    mark("done.xml", "uploaded")
+    mark("resumed.xml", "exported", [str(staged)])
+
+    remaining = skip_finished(["done.xml", "resumed.xml", "new.xml"], in_dir, manifest_path, True)
+    assert remaining == ["new.xml"]
+    assert sorted(os.listdir(os.path.join(in_dir, "converted_xml"))) == ["done.xml", "resumed.xml"]
+
+
+def test_flush_during_run(work_dir, monkeypatch):
+    # A flush from the upload stage that runs between staging and the "exported" progress must not leave the
+    # file exported forever with an empty spool
+    write_xml(work_dir / "in" / "a.xml", articles=30)
+    manifest_path = str(work_dir / "manifest.db")
+    uploader = Uploader(SQLiteBackend(str(work_dir / "stand_in.db")), "spool", max_files=1,
+                        on_loaded=lambda paths: manifest.mark_uploaded(manifest_path, paths))
+
+    set_stage = manifest.set_stage
+
+    def flush_first(*args):
+        if args[5] == "exported":
+            thread = threading.Thread(target=uploader.flush, kwargs={"force": True})
+            thread.start()
+            thread.join()
+            assert pending_files("spool") == {}
+        set_stage(*args)
+
+    monkeypatch.setattr(manifest, "set_stage", flush_first)
+    intermediate.run("a.xml", choice="memory", bigquery=True, bg_upload_type="append", bg_project_id="test",
+                     bg_data_set="test", bg_table_name="pubmed", in_dir=str(work_dir / "in"),
+                     out_dir=str(work_dir / "out"), manifest_path=manifest_path,
+                     output={"format": "csv.gz", "bg_load_mode": "batched", "spool_dir": "spool"})
+
+    file_hash = manifest.file_hash(manifest_path, str(work_dir / "in" / "converted_xml" / "a.xml"))
+    assert manifest.get_stage(manifest_path, file_hash, "BigQuery") == "uploaded"
+    assert manifest.pending_outputs(manifest_path, file_hash) == []
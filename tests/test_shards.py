@@ -0,0 +1,77 @@
+import os
+import csv
+import pytest
+import intermediate
+from shards import table_spec, shard_key, shard_name, publication_year
+from conftest import write_xml
+
+
+def test_pmid_partitions_cover_pubmed():
+    spec = table_spec({"shard_by": "pmid", "shard_size": None}, ["pmid"])
+    partitioning = spec["range_partitioning"]
+    assert partitioning["start"] == 0 and partitioning["end"] >= 40000000
+    assert partitioning["interval"] == 1000000
+    assert spec["clustering_fields"] == ["pmid"]
+
+    partitioning = table_spec({"shard_by": "pmid", "shard_size": 7000})["range_partitioning"]
+    assert partitioning["end"] >= 50000000 and partitioning["end"] % 7000 == 0
+
+
+def test_too_many_partitions_are_refused():
+    with pytest.raises(ValueError):
+        table_spec({"shard_by": "pmid", "shard_size": 1000})
+    assert table_spec({"shard_by": "pmid", "shard_size": 1000, "shard_pmid_max": 5000000}) is not None
+    assert table_spec({"shard_by": None}) is None
+
+
+def test_shard_keys():
+    assert publication_year("1998-1999") == 1998 and publication_year("Spring") is None
+    key = shard_key({"shard_by": "year", "shard_size": 10}, ["pmid", "year"])
+    assert key((1, "1998 Spring")) == (1990, (1998,))
+    assert key((2, None)) == (None, (None,))
+    assert shard_name("year", None) == "year_unknown"
+
+    key = shard_key({"shard_by": "pmid", "shard_size": 1000}, ["pmid", "descriptor_uid"])
+    assert key((12345, "D1")) == (12000, ())
+
+    key = shard_key({"shard_by": "year", "shard_size": 1}, ["pmid", "descriptor_uid"], {7: "2001"})
+    assert key((7, "D1")) == (2001, (2001,))
+
+
+@pytest.mark.parametrize("choice", ["memory", "columnar"])
+def test_csv_shards_add_up(work_dir, choice):
+    write_xml(work_dir / "in" / "a.xml", articles=60)
+    kwargs = dict(choice=choice, bigquery=False, bg_upload_type="append", bg_project_id=None, bg_data_set=None,
+                  bg_table_name=None, in_dir=str(work_dir / "in"))
+
+    def rows(out_dir, output):
+        os.makedirs(out_dir)
+        intermediate.run("a.xml", out_dir=out_dir, output=output, **kwargs)
+        os.replace(str(work_dir / "in" / "converted_xml" / "a.xml"), str(work_dir / "in" / "a.xml"))
+        found = {}
+        for name in os.listdir(os.path.join(out_dir, "CSV")):
+            with open(os.path.join(out_dir, "CSV", name), newline="", encoding="utf-8") as file:
+                found[name] = list(csv.DictReader(file))
+        return found
+
+    whole = rows(str(work_dir / "whole"), {})
+    shards = rows(str(work_dir / "shards"), {"shard_by": "year", "shard_size": 10})
+
+    assert len(shards) > 2
+    for output in ("a", "a_mesh"):
+        parts = [row for name, part in shards.items() if name.startswith(output + "_year_") for row in part]
+        assert sorted(int(row["row_id"]) for row in parts) == [int(row["row_id"]) for row in whole[output + ".csv"]]
+        for row in parts:
+            year = publication_year(row["year"]) if "year" in row else None
+            assert year is None or row["publication_year"] == str(year)
+
+
+def test_bigquery_gets_every_shard(work_dir):
+    import pandas as pd
+    from threads import export_frame_shards
+
+    df = pd.DataFrame({"row_id": [1, 2, 3], "filename": "a.xml", "pmid": [1, 2, 3],
+                       "year": ["1990", "2005", None]})
+    path = export_frame_shards(df, "a", True, str(work_dir / "out"), {"shard_by": "year", "shard_size": 10,
+                                                                       "format": "csv", "compression": None})
+    assert list(pd.read_csv(path)["row_id"]) == [1, 2, 3]
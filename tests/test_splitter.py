@@ -0,0 +1,38 @@
+import os
+import shutil
+import pytest
+import intermediate
+import splitter
+from conftest import write_xml
+
+
+@pytest.mark.parametrize("choice", ["disk", "memory", "columnar"])
+def test_split_run_matches_one_process(work_dir, monkeypatch, choice):
+    write_xml(work_dir / "in" / "a.xml", articles=300, delete_rate=0.05)
+    splits = []
+    execute_split = splitter.execute_split
+
+    def counted(*args, **kwargs):
+        splits.append(args[3])
+        return execute_split(*args, **kwargs)
+    monkeypatch.setattr(splitter, "execute_split", counted)
+
+    # each run has its own change index, so both export every record and write the tombstones
+    def outputs(out_dir, **split):
+        os.makedirs(out_dir)
+        intermediate.run("a.xml", choice=choice, bigquery=False, bg_upload_type="append", bg_project_id=None,
+                         bg_data_set=None, bg_table_name=None, in_dir=str(work_dir / "in"), out_dir=out_dir,
+                         change_index=out_dir + ".db", **split)
+        shutil.move(str(work_dir / "in" / "converted_xml" / "a.xml"), str(work_dir / "in" / "a.xml"))
+        found = {}
+        for name in sorted(os.listdir(os.path.join(out_dir, "CSV"))):
+            with open(os.path.join(out_dir, "CSV", name), "rb") as file:
+                found[name] = file.read()
+        return found
+
+    single = outputs(str(work_dir / "single"))
+    split = outputs(str(work_dir / "split"), split_workers=2, split_min_mb=0)
+
+    assert splits == [2]
+    assert sorted(single) == ["a.csv", "a_deleted.csv", "a_mesh.csv"]
+    assert split == single
@@ -0,0 +1,153 @@
+import os
+import gzip
+import sqlite3
+import pytest
+from types import SimpleNamespace
+from google.api_core import exceptions
+import uploader
+from uploader import Uploader, SQLiteBackend, BigQueryBackend, stage_file, pending_files, batch_job_id
+from schema import csv_schema, CSV_COLUMNS
+
+
+class FakeJob:
+    # error is what result() raises; error_result says whether the job itself failed or only its answer got lost
+    def __init__(self, job_id, error=None, failed=False):
+        self.job_id = job_id
+        self.state = "DONE"
+        self.error = error
+        self.error_result = {"reason": "invalid"} if failed else None
+
+    def result(self):
+        if self.error:
+            raise self.error
+        return self
+
+
+class FakeClient:
+    # Keeps every load job instead of sending it; outcomes are (error, failed) for the next jobs started
+    def __init__(self, outcomes=()):
+        self.configs = []
+        self.jobs = {}
+        self.outcomes = list(outcomes)
+
+    def get_dataset(self, name):
+        return SimpleNamespace(location="EU")
+
+    def get_job(self, job_id, location=None):
+        if job_id not in self.jobs:
+            raise exceptions.NotFound(f"no job {job_id}")
+        return self.jobs[job_id]
+
+    def load_table_from_file(self, file, destination, job_id=None, job_config=None):
+        self.configs.append(job_config)
+        error, failed = self.outcomes.pop(0) if self.outcomes else (None, False)
+        self.jobs[job_id] = FakeJob(job_id, error, failed)
+        return self.jobs[job_id]
+
+
+def write_csv(path, rows):
+    with gzip.open(path, "wt") as file:
+        file.write("row_id,filename,pmid\n")
+        for number in range(rows):
+            file.write(f"{number + 1},a.xml,{number}\n")
+    return str(path)
+
+
+def spooled(tmp_path, files, rows=2):
+    spool_dir = str(tmp_path / "spool")
+    for number in range(files):
+        stage_file(write_csv(tmp_path / f"a{number}.csv.gz", rows), "data_set.pubmed_deleted", "append",
+                   csv_schema(["pmid"]), spool_dir)
+    uploader.staged.clear()
+    return spool_dir
+
+
+def bigquery_uploader(spool_dir, client, retries=3):
+    backend = BigQueryBackend("project")
+    backend.client = client
+    return Uploader(backend, spool_dir, max_files=10, retries=retries, backoff_seconds=0)
+
+
+def test_csv_loads_have_a_schema(tmp_path):
+    path = str(tmp_path / "a.csv.gz")
+    with gzip.open(path, "wt") as file:
+        file.write(",".join(["row_id", "filename"] + CSV_COLUMNS) + "\n")
+
+    client = FakeClient()
+    uploader.load_file(path, "data_set.pubmed", "project", "append", csv_schema(CSV_COLUMNS), client)
+    config = client.configs[0]
+    assert not config.autodetect
+    types = {field.name: field.field_type for field in config.schema}
+    assert types["pmid"] == "INTEGER" and types["row_id"] == "INTEGER"
+    assert types["author_ordinality"] == types["affiliation_ordinality"] == "INTEGER"
+    assert types["publication_type_ordinality"] == "INTEGER"
+    assert types["volume"] == types["issue"] == types["year"] == "STRING"
+    assert [field.name for field in config.schema] == ["row_id", "filename"] + CSV_COLUMNS
+    assert os.path.exists(path)
+
+
+def test_flush_batches(tmp_path):
+    spool_dir = spooled(tmp_path, 5)
+    stand_in = str(tmp_path / "stand_in.db")
+    spool = Uploader(SQLiteBackend(stand_in), spool_dir, max_files=2)
+
+    # without force only full batches go, the last file waits for more
+    assert [len(batch) for _, batch, _ in spool.flush()] == [2, 2]
+    assert sum(len(files) for files in pending_files(spool_dir).values()) == 1
+    assert [len(batch) for _, batch, _ in spool.flush(force=True)] == [1]
+    assert pending_files(spool_dir) == {}
+
+    connection = sqlite3.connect(stand_in)
+    assert connection.execute('SELECT count(*) FROM "data_set.pubmed_deleted"').fetchone()[0] == 10
+    connection.close()
+
+
+def test_job_id_is_stable(tmp_path):
+    spool_dir = spooled(tmp_path, 2)
+    files = pending_files(spool_dir)["data_set.pubmed_deleted"]
+    assert batch_job_id("data_set.pubmed_deleted", files) == batch_job_id("data_set.pubmed_deleted", files[::-1])
+    assert batch_job_id("data_set.pubmed_deleted", files) != batch_job_id("data_set.pubmed_deleted", files[:1])
+
+
+def test_lost_answer_is_not_loaded_twice(tmp_path):
+    # the job committed, only its result() timed out: the retry finds it instead of appending the rows again
+    client = FakeClient([(exceptions.ServiceUnavailable("timed out"), False)])
+    spool_dir = spooled(tmp_path, 2)
+    assert len(bigquery_uploader(spool_dir, client).flush(force=True)) == 1
+    assert len(client.configs) == 1
+    assert pending_files(spool_dir) == {}
+
+
+def test_failed_job_gets_a_new_id(tmp_path):
+    client = FakeClient([(exceptions.InternalServerError("backend error"), True)])
+    spool_dir = spooled(tmp_path, 1)
+    assert len(bigquery_uploader(spool_dir, client).flush(force=True)) == 1
+    first, second = client.jobs
+    assert second == f"{first}_1"
+
+
+def test_bad_request_is_not_retried(tmp_path):
+    client = FakeClient([(exceptions.BadRequest("no such field"), True)])
+    spool_dir = spooled(tmp_path, 1)
+    assert bigquery_uploader(spool_dir, client).flush(force=True) == []
+    assert len(client.configs) == 1
+    assert len(pending_files(spool_dir)["data_set.pubmed_deleted"]) == 1
+
+
+def test_only_a_busy_stand_in_is_retried():
+    calls = []
+
+    def load(error):
+        calls.append(error)
+        if len(calls) == 1:
+            raise error
+        return "loaded"
+
+    assert uploader.retry(lambda: load(sqlite3.OperationalError("database is locked")), 3, 0, 0) == "loaded"
+    assert len(calls) == 2
+
+    calls.clear()
+    with pytest.raises(sqlite3.OperationalError):
+        uploader.retry(lambda: load(sqlite3.OperationalError("no such table: pubmed")), 3, 0, 0)
+    assert len(calls) == 1
+    assert not uploader.transient(sqlite3.OperationalError("table pubmed has no column named year"))
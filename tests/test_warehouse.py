@@ -0,0 +1,76 @@
+import sqlite3
+import pytest
+from warehouse import Warehouse, hand_off, ARTICLES, AUTHORS, MESH
+from schema import TABLE_COLUMNS
+
+
+def file_rows(titles, affiliations=()):
+    # titles: pmid -> article_title, affiliations: (pmid, affiliation)
+    rows = {table: [] for table in TABLE_COLUMNS}
+    for pmid, title in titles.items():
+        rows[ARTICLES].append((pmid, title) + (None,) * (len(TABLE_COLUMNS[ARTICLES]) - 2))
+        rows[MESH].append((pmid, f"D{pmid}", "N"))
+    for number, (pmid, affiliation) in enumerate(affiliations, 1):
+        rows[AUTHORS].append((pmid, number, "A", "Ann", "Author", 1, affiliation))
+    return rows
+
+
+def has_fts5():
+    connection = sqlite3.connect(":memory:")
+    try:
+        connection.execute("CREATE VIRTUAL TABLE t USING fts5(x)")
+        return True
+    except sqlite3.OperationalError:
+        return False
+    finally:
+        connection.close()
+
+
+@pytest.mark.skipif(not has_fts5(), reason="this SQLite has no FTS5")
+def test_full_text_follows_the_merges(tmp_path):
+    spool = str(tmp_path / "spool")
+    warehouse = Warehouse(str(tmp_path / "warehouse.db"), spool)
+    hand_off(spool, "a.xml", [], rows=file_rows({1: "alpha trial", 2: "delta study"}, [(1, "Harvard")]))
+    warehouse.finish()
+
+    # later files are only merged, the full text tables aren't built again
+    hand_off(spool, "b.xml", [2], rows=file_rows({1: "beta trial", 3: "gamma study"}, [(1, "Oxford")]))
+    assert warehouse.flush() == 1
+
+    connection = sqlite3.connect(str(tmp_path / "warehouse.db"))
+    try:
+        def titles(text):
+            return [pmid for (pmid,) in connection.execute("SELECT rowid FROM articles_fts WHERE articles_fts MATCH ? "
+                                                           "ORDER BY rowid", (text,))]
+        assert titles("alpha") == [] and titles("beta") == [1] and titles("study") == [3]
+        assert connection.execute("SELECT count(*) FROM affiliations_fts WHERE affiliations_fts MATCH 'harvard'"
+                                  ).fetchone()[0] == 0
+        assert connection.execute("SELECT count(*) FROM affiliations_fts WHERE affiliations_fts MATCH 'oxford'"
+                                  ).fetchone()[0] == 1
+        for name in ("articles_fts", "affiliations_fts"):
+            connection.execute(f"INSERT INTO {name}({name}, rank) VALUES ('integrity-check', 1)")
+    finally:
+        connection.close()
+
+
+@pytest.mark.parametrize("order", [("b.xml", "a.xml"), ("a.xml", "b.xml")])
+def test_latest_file_by_name_wins(tmp_path, order):
+    # b.xml is the later update: it revises pmid 1 and deletes pmid 3, which the older a.xml still has
+    files = {"a.xml": ([], file_rows({1: "old title", 2: "two", 3: "three"})),
+             "b.xml": ([3], file_rows({1: "new title"}))}
+    spool = str(tmp_path / "spool")
+    warehouse = Warehouse(str(tmp_path / "warehouse.db"), spool, full_text=False)
+    for filename in order:
+        deleted, rows = files[filename]
+        hand_off(spool, filename, deleted, rows=rows)
+        assert warehouse.flush() == 1
+
+    connection = sqlite3.connect(str(tmp_path / "warehouse.db"))
+    try:
+        assert connection.execute(f"SELECT pmid, article_title FROM {ARTICLES} ORDER BY pmid").fetchall() == \
+            [(1, "new title"), (2, "two")]
+        assert connection.execute(f"SELECT pmid FROM {MESH} ORDER BY pmid").fetchall() == [(1,), (2,)]
+        assert connection.execute("SELECT pmid, filename, deleted FROM sources ORDER BY pmid").fetchall() == \
+            [(1, "b.xml", 0), (2, "a.xml", 0), (3, "b.xml", 1)]
+    finally:
+        connection.close()
@@ -1,365 +1,562 @@
 import sqlite3
-import pandas as pd
-import pandas_gbq
 import logging
 import time
 import os
+import csv
+import gzip
 import concurrent.futures
 import json
+from nested import export_nested, CHILD_TABLES, ARTICLES
+from star import export_star, output_columns
+from fields import extract_record
+from shards import shard_key, shard_name, shard_columns, table_spec
+from schema import TABLE_COLUMNS, NESTED_SCHEMA, CREATE_TABLES, INSERT_QUERIES, CSV_COLUMNS, csv_schema
+from uploader import load_file, stage_file
+from warehouse import hand_off
+from xml_files import base_name
+import metrics
 
 logging.basicConfig(filename="logs.log", filemode='a', format='%(name)s - %(levelname)s - %(message)s')
 connection = None
 
 
-def connection_opener(choice, filename):
+def connection_opener(choice, filename, cache_size_mb=64):
     global connection
     if choice.lower() == "memory":
         connection = sqlite3.connect(':memory:')
     else:
         connection = sqlite3.connect(os.path.join(f"temporary/{filename}.db"))
 
-
-def major_descriptor(yn):
-    if yn.lower() == 'y':
-        return True
-    return False
-
-
-def create_year_month(year_month):
-    if year_month.get("MedlineDate") is not None:
-        year_month = year_month.get("MedlineDate")
-        if year_month is None:
-            Year, Month = None, None
-        else:
-            if len(year_month.split()) <= 2:
-                if len(year_month.split()) == 2:
-                    Year, Month = list(year_month.split())
-                else:
-                    Year = year_month
-                    Month = None
-            else:
-                Year, Month = None, None
-    else:
-        Year = year_month.get("Year")
-        Month = year_month.get("Month")
-
-    return Year, Month
-
-
-def create_issn(iss):
-    if iss is not None:
-        issn = iss.get("#text")
-        issn_type = iss.get("@IssnType")
-    else:
-        issn = None
-        issn_type = None
-
-    return issn, issn_type
-
-
-def author_list(auth_l):
-    if auth_l is None:
-        author = [{"Initials": None, "ForeName": None, "LastName": None}]
-    else:
-        author = auth_l.get("Author")
-
-    return author
-
-
-def create_date(d_m_y):
-    if d_m_y is None:
-        date = None
-    else:
-        date = d_m_y.get("Day") + '/' + \
-               d_m_y.get("Month") + '/' + \
-               d_m_y.get("Year")
-
-    return date
-
-
-def check_article(article):
-    if type(article) is not str:
-        if type(article) is dict:
-            return article.get("#text")
-        else:
-            return None
-    else:
-        article = article.lstrip('[')
-        return article.rstrip(']')
-
-
-def create_date_revised(d_m_y):
-    if d_m_y is None:
-        date = None
-    else:
-        date = d_m_y.get("Day") + '/' + \
-               d_m_y.get("Month") + '/' + \
-               d_m_y.get("Year")
-
-    return date
-
-
-def create_title(title):
-    if title is None:
-        return None
-    else:
-        title = title.lstrip('[')
-        return title.rstrip(']')
-
-
-def create_affiliation(affiliation):
-    if affiliation is None:
-        return None
-    else:
-        if type(affiliation) is not list:
-            return [affiliation]
-        return affiliation
+    # temporary databases are thrown away after the run, so there is nothing to protect with a journal or fsync
+    connection.execute("PRAGMA journal_mode = OFF")
+    connection.execute("PRAGMA synchronous = OFF")
+    connection.execute(f"PRAGMA cache_size = -{cache_size_mb * 1024}")
+    connection.execute("PRAGMA temp_store = MEMORY")
 
 
 def database_setup(filename):
     # connection = sqlite3.connect(f"{filename}.db")
     cursor = connection.cursor()
     with connection:
-        cursor.execute("CREATE TABLE pm_ext_authors_affiliations(pmid INTEGER, author_ordinality INTEGER, "
-                       "initials TEXT, fore_name TEXT, last_name TEXT, "
-                       "affiliation_ordinality INTEGER, affiliation TEXT, PRIMARY KEY(pmid, author_ordinality, "
-                       "affiliation_ordinality), UNIQUE(pmid, author_ordinality, affiliation_ordinality))")
-
-        cursor.execute("CREATE TABLE pm_ext_articles_revised_journals(pmid INTEGER PRIMARY KEY UNIQUE, "
-                       "article_title TEXT, date_created TEXT, date_revised TEXT, issn TEXT, issn_type TEXT, "
-                       "cited_medium TEXT, volume TEXT, issue TEXT, "
-                       "year TEXT, month TEXT,title TEXT, iso_abbreviation TEXT, nlm_uid TEXT)")
-
-        cursor.execute("CREATE TABLE pm_ext_mesh_headings(pmid INTEGER, descriptor_uid TEXT, major_descriptor TEXT,"
-                       "PRIMARY KEY(pmid, descriptor_uid), UNIQUE(pmid, descriptor_uid))")
-
-        cursor.execute("CREATE TABLE pm_ext_publication_types(pmid INTEGER, publication_type TEXT, "
-                       "publication_type_ui TEXT, publication_type_ordinality INTEGER, "
-                       "PRIMARY KEY(pmid, publication_type_ordinality), UNIQUE(pmid, publication_type_ordinality))")
+        for statement in CREATE_TABLES.values():
+            cursor.execute(statement)
 
     connection.commit()
     # connection.close()
 
 
-def fed_database(data, filename):
+def flush_buffers(cursor, buffers):
+    with metrics.stage("insert"):
+        for table, rows in buffers.items():
+            if rows:
+                cursor.executemany(INSERT_QUERIES[table], rows)
+                metrics.count_rows(table, len(rows))
+                rows.clear()
+
+
+def fed_database(data, filename, batch_size=5000, changes=None):
     # connection = sqlite3.connect(f'{filename}.db')
     cursor = connection.cursor()
+    buffers = {table: [] for table in INSERT_QUERIES}
+    tables = list(INSERT_QUERIES)
 
     with connection:
+        buffered = 0
+        extract_time = 0
         for value in data:
+            begin = time.perf_counter()
             try:
-                PMID = int(value.get("MedlineCitation").get("PMID").get("#text"))
-                DescriptorUIDList = value.get("MedlineCitation").get("MeshHeadingList")
-
-                ArticleTitle = value.get("MedlineCitation").get("Article").get('ArticleTitle')
-
-                DateCreated = create_date(value.get("MedlineCitation").get("DateCompleted"))
-
-                AuthorList = value.get("MedlineCitation").get("Article").get("AuthorList")
-
-                Author = author_list(AuthorList)
-
-                DateRevised = create_date_revised(value.get("MedlineCitation").get("DateRevised"))
-
-                ISSN = value.get("MedlineCitation").get("Article").get('Journal').get("ISSN")
-
-                issn, issn_type = create_issn(ISSN)
-
-                CitedMedium = value.get("MedlineCitation").get("Article").get("Journal").get("JournalIssue").get(
-                    "@CitedMedium")
-                Volume = value.get("MedlineCitation").get("Article").get("Journal").get("JournalIssue").get("Volume")
-                Issue = value.get("MedlineCitation").get("Article").get("Journal").get("JournalIssue").get("Issue")
-                year_month = value.get("MedlineCitation").get("Article").get("Journal").get("JournalIssue").get(
-                    "PubDate")
-
-                Year, Month = create_year_month(year_month)
-
-                Title = value.get("MedlineCitation").get("Article").get('Journal').get("Title")
-                ISOAbbreviation = value.get("MedlineCitation").get("Article").get('Journal').get("ISOAbbreviation")
-                NlmUniqueId = value.get("MedlineCitation").get("MedlineJournalInfo").get("NlmUniqueID")
-                PublicationTypeList = value.get("MedlineCitation").get("Article").get("PublicationTypeList").get(
-                    "PublicationType")
-
-                if type(PublicationTypeList) is not list:
-                    PublicationTypeList = [PublicationTypeList]
-
-                if type(Author) is not list:
-                    Author = [Author]
-
-                if DescriptorUIDList is not None:
-                    DescriptorUIDList = DescriptorUIDList.get("MeshHeading")
-
-                    if type(DescriptorUIDList) is not list:
-                        DescriptorUIDList = [DescriptorUIDList]
-
-                    for description in DescriptorUIDList:
-                        major = str(major_descriptor(description.get("DescriptorName").get("@MajorTopicYN")))
-                        try:
-                            cursor.execute("INSERT INTO pm_ext_mesh_headings(pmid, descriptor_uid, major_descriptor) "
-                                           "VALUES (?, ?, ?)", (PMID, description.get("DescriptorName").get("@UI"),
-                                                                str(major)))
-                        except (sqlite3.IntegrityError, sqlite3.OperationalError):
-                            continue
-
-                ArticleTitle = check_article(ArticleTitle)
-                Title = create_title(Title)
-                cursor.execute(
-                    "INSERT INTO pm_ext_articles_revised_journals(pmid, article_title, date_created, date_revised, "
-                    "issn, issn_type, cited_medium, volume, issue, year, "
-                    "month, title, iso_abbreviation, nlm_uid) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, "
-                    "?, ?)", (
-                        PMID, ArticleTitle, DateCreated, DateRevised, issn, issn_type, CitedMedium, Volume, Issue,
-                        Year, Month, Title, ISOAbbreviation,
-                        NlmUniqueId))
-
-                count = 1
-                for publication in PublicationTypeList:
-                    try:
-                        cursor.execute("INSERT INTO pm_ext_publication_types(pmid, publication_type, "
-                                       "publication_type_ui, publication_type_ordinality) VALUES"
-                                       "(?, ?, ?, ?)", (PMID, publication.get("#text"), publication.get("@UI"), count))
-                        count += 1
-                    except (sqlite3.IntegrityError, sqlite3.OperationalError):
-                        continue
-
-                count = 1  # For author's ordinality
-                for author in Author:
-                    Affiliation = create_affiliation(author.get("AffiliationInfo"))
-                    if Affiliation is not None:
-                        count_1 = 1  # For affiliation's ordinality
-                        for affiliation in Affiliation:
-                            try:
-                                cursor.execute("INSERT INTO pm_ext_authors_affiliations VALUES (?, ?, ?, ?, ?, ?, ?)", (
-                                    PMID, count, author.get("Initials"), author.get("ForeName"), author.get("LastName"),
-                                    count_1, affiliation.get("Affiliation")))
-                                count_1 += 1
-                            except (sqlite3.IntegrityError, sqlite3.OperationalError):
-                                continue
-
-                    else:
-                        try:
-                            cursor.execute("INSERT INTO pm_ext_authors_affiliations(pmid, author_ordinality, initials, "
-                                           "fore_name, last_name, affiliation_ordinality, affiliation) "
-                                           "VALUES (?, ?, ?, ?, ?, ?, ?)",
-                                           (PMID, count, author.get("Initials"), author.get("ForeName"),
-                                            author.get("LastName"), 0, None))
-                        except (sqlite3.IntegrityError, sqlite3.OperationalError):
-                            continue
-                    count += 1
-
+                record = extract_record(value)
             except Exception as e:
                 logging.exception(f"Exception occurred! {e}")
                 continue
+            finally:
+                extract_time += time.perf_counter() - begin
+
+            # records the change index has already seen in this version are not written again
+            if changes is not None and not changes.changed(record):
+                continue
+            metrics.count("records")
+
+            for table, rows in zip(tables, record):
+                buffers[table].extend(rows)
+                buffered += len(rows)
+
+            if buffered >= batch_size:
+                flush_buffers(cursor, buffers)
+                buffered = 0
+
+        flush_buffers(cursor, buffers)
+        metrics.add_time("extract", extract_time)
 
     connection.commit()
     # connection.close()
 
 
-def execute(data, filename, choice, bigquery, bg_upload_type, bg_project_id, bg_data_set, bg_table_name, out_dir):
-    connection_opener(choice, filename)
+def execute(data, filename, choice, bigquery, bg_upload_type, bg_project_id, bg_data_set, bg_table_name, out_dir,
+            batch_size=5000, cache_size_mb=64, output=None, progress=None, changes=None, deleted=None):
+    connection_opener(choice, filename, cache_size_mb)
     database_setup(filename)
-    fed_database(data, filename)
+    fed_database(data, filename, batch_size, changes)
+    if progress:
+        progress("parsed")
+
+    output = output_settings(output)
+    if output.get("warehouse_spool"):
+        with metrics.stage("handoff"):
+            hand_off(output["warehouse_spool"], filename, deleted, connection=connection)
+
+    if output.get("layout") == "nested":
+        tables = {table: connection.execute(f"SELECT {', '.join(TABLE_COLUMNS[table])} FROM {table} "
+                                            f"ORDER BY pmid, rowid") for table in [ARTICLES] + CHILD_TABLES}
+        with metrics.stage("write"):
+            path = export_nested(filename, tables, out_dir, output)
+        metrics.add_output(path)
+        connection.close()
+
+        return upload_nested(path, filename, bigquery, bg_upload_type, bg_project_id, bg_data_set, bg_table_name,
+                             staging_dir(output))
+
+    if output.get("layout") == "star":
+        paths = export_star(filename, lambda: {table: connection.execute(f"SELECT {', '.join(columns)} FROM {table}")
+                                               for table, columns in TABLE_COLUMNS.items()}, output,
+                            lambda columns, rows, name: write_table(columns, rows, name, filename, out_dir, output))
+        connection.close()
+
+        return upload_star(paths, filename, bigquery, bg_upload_type, bg_project_id, bg_data_set, bg_table_name,
+                           staging_dir(output))
 
     # connection = sqlite3.connect(f"{filename}.db")
-    answer = []
+    df1 = create_mesh_csv(filename, bigquery, out_dir, output=output)
+    df2 = create_csv(filename, bigquery, out_dir, output=output)
+
+    connection.close()
+
+    return upload_frames(df1, df2, filename, bigquery, bg_upload_type, bg_project_id, bg_data_set, bg_table_name,
+                         staging_dir(output), output)
+
 
-    df1 = create_mesh_csv(filename, bigquery, out_dir)
-    df2 = create_csv(filename, bigquery, out_dir)
+def upload_frames(df1, df2, filename, bigquery, bg_upload_type, bg_project_id, bg_data_set, bg_table_name,
+                  spool_dir=None, output=None):
+    answer = []
     if bigquery:
+        output = output_settings(output)
+        clustering = output.get("bg_clustering") or {}
+        mesh_columns = TABLE_COLUMNS["pm_ext_mesh_headings"] + shard_columns(output)
         with concurrent.futures.ThreadPoolExecutor() as executor:
 
             futures = [executor.submit(upload_mesh_csv, df=df1, filename=filename, bg_upload_type=bg_upload_type,
-                                       bg_project_id=bg_project_id, bg_data_set=bg_data_set, bg_table_name=bg_table_name),
+                                       bg_project_id=bg_project_id, bg_data_set=bg_data_set,
+                                       bg_table_name=bg_table_name, spool_dir=spool_dir,
+                                       table_spec=table_spec(output, clustering.get("mesh")),
+                                       schema=file_schema(df1, mesh_columns)),
                        executor.submit(upload_csv, df=df2, filename=filename, bg_upload_type=bg_upload_type,
-                                       bg_project_id=bg_project_id, bg_data_set=bg_data_set, bg_table_name=bg_table_name)]
+                                       bg_project_id=bg_project_id, bg_data_set=bg_data_set,
+                                       bg_table_name=bg_table_name, spool_dir=spool_dir,
+                                       table_spec=table_spec(output, clustering.get("main")),
+                                       schema=file_schema(df2, CSV_COLUMNS + shard_columns(output)))]
 
             for future in concurrent.futures.as_completed(futures):
                 answer.append(future.result())
 
-    connection.close()
-
-    if bigquery:
         return answer[0] if answer[0] > answer[1] else answer[1]
     return 0
 
 
-def create_mesh_csv(filename, bigquery, out_dir):
-    query = "SELECT pmid, descriptor_uid, major_descriptor FROM pm_ext_mesh_headings"
+def file_schema(path, columns):
+    # csv files carry no types, parquet files and DataFrames bring their own
+    if type(path) is str and path.endswith((".csv", ".csv.gz")):
+        return csv_schema(columns)
+    return None
 
-    sql_query = pd.read_sql_query(query, connection)
-    df = pd.DataFrame(sql_query)
 
-    df.insert(0, "filename", [filename for _ in range(len(df))])
-    df.insert(0, "row_id", [i for i in range(1, len(df) + 1)])
+def output_settings(output):
+    settings = {"format": "csv", "compression": "zstd", "row_group_size": 100000, "bg_load_source": "dataframe",
+                "layout": "flat", "bg_load_mode": "per_file", "spool_dir": "spool", "dimension_index": "dimensions.db",
+                "shard_by": None, "shard_size": None, "shard_pmid_max": None, "bg_clustering": {}}
+    settings.update(output or {})
 
-    if bigquery:
-        print("Uploading to BQ...")
-        return df
+    # batched loads collect files from every worker, so there has to be a file to collect; pandas_gbq can't
+    # create a partitioned table either
+    if settings["bg_load_mode"] == "batched" or settings["shard_by"]:
+        settings["bg_load_source"] = "file"
+    return settings
+
+
+def staging_dir(output):
+    if output.get("bg_load_mode") == "batched":
+        return output.get("spool_dir")
+    return None
+
+
+def output_path(out_dir, name, output):
+    output_format = output.get("format")
+
+    if output_format == "parquet":
+        folder, extension = "PARQUET", ".parquet"
+    elif output_format == "csv.gz":
+        folder, extension = "CSV", ".csv.gz"
+    else:
+        folder, extension = "CSV", ".csv"
 
     try:
-        os.mkdir(out_dir + "/CSV")
+        os.mkdir(out_dir + f"/{folder}")
     except FileExistsError:
         pass
 
-    filename = filename.rstrip(".xml")
-    df.to_csv(out_dir + f"/CSV/{filename}_mesh.csv", index=False)
+    return out_dir + f"/{folder}/{name}{extension}"
 
-    return True
 
+def write_frame(df, out_dir, name, output):
+    path = output_path(out_dir, name, output)
 
-def create_csv(filename, bigquery, out_dir):
-    query = "SELECT pmid, article_title, date_created, affiliation, " \
-            "affiliation_ordinality, author_ordinality, initials, fore_name, " \
-            "last_name, date_revised, issn, issn_type, cited_medium, volume, issue, year, month, title, " \
-            "iso_abbreviation, nlm_uid, publication_type, publication_type_ui, publication_type_ordinality " \
-            "FROM pm_ext_articles_revised_journals LEFT JOIN pm_ext_authors_affiliations USING(pmid) " \
-            "LEFT JOIN pm_ext_publication_types pet USING(pmid)"
+    start = time.time()
+    if path.endswith(".parquet"):
+        df.to_parquet(path, engine="pyarrow", index=False, compression=output.get("compression"),
+                      row_group_size=output.get("row_group_size"), use_dictionary=True)
+    elif path.endswith(".gz"):
+        df.to_csv(path, index=False, compression="gzip")
+    else:
+        df.to_csv(path, index=False)
 
-    # query = "SELECT * FROM pm_ext_articles_revised_journals NATURAL JOIN pm_ext_mesh_headings"
-    sql_query = pd.read_sql_query(query, connection)
-    df = pd.DataFrame(sql_query)
+    metrics.add_time("write", time.time() - start)
+    metrics.add_output(path, len(df))
+    return path
+
+
+def write_rows(columns, rows, filename, path):
+    # Same text DataFrame.to_csv writes, one row at a time, so memory stays flat however many rows there are
+    opener = gzip.open if path.endswith(".gz") else open
+    count = 0
+    with opener(path, "wt", encoding="utf-8", newline="") as file:
+        writer = csv.writer(file, lineterminator="\n")
+        writer.writerow(["row_id", "filename"] + list(columns))
+        for count, row in enumerate(rows, 1):
+            writer.writerow((count, filename) + tuple(row))
+
+    return count
+
+
+def streams_csv(bigquery, output):
+    # rows can go straight to disk unless a DataFrame is needed, for parquet or a pandas_gbq upload
+    return output.get("format") in ("csv", "csv.gz") and not (bigquery and output.get("bg_load_source") != "file")
 
-    df.insert(0, "filename", [filename for _ in range(len(df))])
-    df.insert(0, "row_id", [i for i in range(1, len(df) + 1)])
+
+def export_rows(columns, rows, name, filename, bigquery, out_dir, output):
+    path = output_path(out_dir, name, output)
+
+    start = time.time()
+    count = write_rows(columns, rows, filename, path)
+    metrics.add_time("write", time.time() - start)
+    metrics.add_output(path, count)
 
     if bigquery:
+        print("Uploading to BQ...")
+        return path
+    return True
+
+
+def write_table(columns, rows, name, filename, out_dir, output):
+    # Always a file, whatever bg_load_source says; csv is streamed, parquet needs the rows in a DataFrame first
+    path = output_path(out_dir, name, output)
+    if path.endswith(".parquet"):
+        import pandas as pd
+
+        df = pd.DataFrame.from_records(list(rows), columns=columns)
+        df.insert(0, "filename", filename)
+        df.insert(0, "row_id", range(1, len(df) + 1))
+        return write_frame(df, out_dir, name, output)
+
+    start = time.time()
+    count = write_rows(columns, rows, filename, path)
+    metrics.add_time("write", time.time() - start)
+    metrics.add_output(path, count)
+    return path
+
+
+def export_frame(df, name, bigquery, out_dir, output):
+    # With bg_load_source "file" the output is written once and the same file is used as the load job source
+    if bigquery and output.get("bg_load_source") != "file":
         print("Uploading to BQ...")
         return df
 
+    path = write_frame(df, out_dir, name, output)
+    if bigquery:
+        print("Uploading to BQ...")
+        return path
+
+    return True
+
+
+MESH_QUERY = "SELECT pmid, descriptor_uid, major_descriptor FROM pm_ext_mesh_headings"
+
+JOINED_QUERY = "SELECT pmid, article_title, date_created, affiliation, " \
+               "affiliation_ordinality, author_ordinality, initials, fore_name, " \
+               "last_name, date_revised, issn, issn_type, cited_medium, volume, issue, year, month, title, " \
+               "iso_abbreviation, nlm_uid, publication_type, publication_type_ui, publication_type_ordinality " \
+               "FROM pm_ext_articles_revised_journals LEFT JOIN pm_ext_authors_affiliations USING(pmid) " \
+               "LEFT JOIN pm_ext_publication_types pet USING(pmid)"
+
+
+def mesh_frame():
+    import pandas as pd
+
+    with metrics.stage("query"):
+        sql_query = pd.read_sql_query(MESH_QUERY, connection)
+    return pd.DataFrame(sql_query)
+
+
+def joined_frame():
+    import pandas as pd
+
+    # query = "SELECT * FROM pm_ext_articles_revised_journals NATURAL JOIN pm_ext_mesh_headings"
+    with metrics.stage("query"):
+        sql_query = pd.read_sql_query(JOINED_QUERY, connection)
+    return pd.DataFrame(sql_query)
+
+
+def export_query(query, name, filename, bigquery, out_dir, output, years=None):
+    # The query is walked by the csv writer itself, so its time shows up as "write"
+    cursor = connection.execute(query)
+    columns = [column[0] for column in cursor.description]
+    if output.get("shard_by"):
+        return export_shards(columns, cursor, name, filename, bigquery, out_dir, output, years)
+    return export_rows(columns, cursor, name, filename, bigquery, out_dir, output)
+
+
+def article_years(output, df=None):
+    # pmid -> year, for the outputs that are sharded by year without a year column of their own
+    if output.get("shard_by") != "year":
+        return None
+    if df is not None:
+        return dict(zip(df["pmid"], df["year"]))
+    return dict(connection.execute("SELECT pmid, year FROM pm_ext_articles_revised_journals"))
+
+
+def shard_output_name(name, bigquery, output):
+    # BigQuery gets one file per output, its partitions are the shards; csv conversion gets a file per shard
+    if bigquery:
+        return lambda start: name
+    return lambda start: f"{name}_{shard_name(output['shard_by'], start)}"
+
+
+def export_shards(columns, rows, name, filename, bigquery, out_dir, output, years=None):
+    # row_id keeps counting over the shards of one output, together they are the unsharded output
+    key = shard_key(output, columns, years)
+    output_name = shard_output_name(name, bigquery, output)
+    header = ["row_id", "filename"] + list(columns) + shard_columns(output)
+
+    start_time = time.time()
+    files, writers, counts = {}, {}, {}
     try:
-        os.mkdir(out_dir + "/CSV")
-    except FileExistsError:
-        pass
+        for count, row in enumerate(rows, 1):
+            start, values = key(row)
+            path = output_path(out_dir, output_name(start), output)
+            if path not in writers:
+                opener = gzip.open if path.endswith(".gz") else open
+                files[path] = opener(path, "wt", encoding="utf-8", newline="")
+                writers[path] = csv.writer(files[path], lineterminator="\n")
+                writers[path].writerow(header)
+                counts[path] = 0
+            writers[path].writerow((count, filename) + tuple(row) + values)
+            counts[path] += 1
+    finally:
+        for file in files.values():
+            file.close()
+
+    if bigquery and not files:
+        # nothing to shard, BigQuery still gets its (empty) file
+        return export_rows(columns, [], name, filename, bigquery, out_dir, output)
+
+    metrics.add_time("write", time.time() - start_time)
+    for path, count in counts.items():
+        metrics.add_output(path, count)
+
+    if bigquery:
+        print("Uploading to BQ...")
+        return path
+    return True
 
-    filename = filename.rstrip(".xml")
-    df.to_csv(out_dir + f"/CSV/{filename}.csv", index=False)
 
+def export_frame_shards(df, name, bigquery, out_dir, output, years=None):
+    import pandas as pd
+
+    key = shard_key(output, list(df.columns), years)
+    keys = [key(row) for row in df.itertuples(index=False, name=None)]
+    for number, column in enumerate(shard_columns(output)):
+        df[column] = pd.array([values[number] for _, values in keys], dtype="Int64")
+
+    if bigquery:
+        # one file with every shard, the shards all have the same name and would overwrite each other
+        path = write_frame(df, out_dir, name, output)
+        print("Uploading to BQ...")
+        return path
+
+    output_name = shard_output_name(name, bigquery, output)
+    starts = pd.Series([start for start, _ in keys], index=df.index, dtype="Int64")
+    for start, shard in df.groupby(starts, dropna=False, sort=True):
+        write_frame(shard, out_dir, output_name(None if pd.isna(start) else int(start)), output)
     return True
 
 
-def upload_mesh_csv(df, filename, bg_upload_type, bg_project_id, bg_data_set, bg_table_name):
+def create_mesh_csv(filename, bigquery, out_dir, df=None, output=None, years=None):
+    output = output_settings(output)
+    if years is None and df is None:
+        years = article_years(output)
+    if df is None and streams_csv(bigquery, output):
+        return export_query(MESH_QUERY, f"{base_name(filename)}_mesh", filename, bigquery, out_dir, output, years)
+
+    if df is None:
+        df = mesh_frame()
+
+    df.insert(0, "filename", filename)
+    df.insert(0, "row_id", range(1, len(df) + 1))
+
+    filename = base_name(filename)
+    if output.get("shard_by"):
+        return export_frame_shards(df, f"{filename}_mesh", bigquery, out_dir, output, years)
+    return export_frame(df, f"{filename}_mesh", bigquery, out_dir, output)
+
+
+def create_csv(filename, bigquery, out_dir, df=None, output=None):
+    output = output_settings(output)
+    if df is None and streams_csv(bigquery, output):
+        return export_query(JOINED_QUERY, base_name(filename), filename, bigquery, out_dir, output)
+
+    if df is None:
+        df = joined_frame()
+
+    df.insert(0, "filename", filename)
+    df.insert(0, "row_id", range(1, len(df) + 1))
+
+    filename = base_name(filename)
+    if output.get("shard_by"):
+        return export_frame_shards(df, filename, bigquery, out_dir, output)
+    return export_frame(df, filename, bigquery, out_dir, output)
+
+
+def create_deleted_csv(pmids, filename, bigquery, out_dir, output=None):
+    # Tombstones for the DeleteCitation PMIDs of an update file, so downstream tables can drop them on merge
+    output = output_settings(output)
+    if streams_csv(bigquery, output):
+        return export_rows(["pmid"], [(pmid,) for pmid in pmids], f"{base_name(filename)}_deleted", filename,
+                           bigquery, out_dir, output)
+
+    import pandas as pd
+
+    df = pd.DataFrame({"pmid": pmids})
+    df.insert(0, "filename", filename)
+    df.insert(0, "row_id", range(1, len(df) + 1))
+
+    filename = base_name(filename)
+    return export_frame(df, f"{filename}_deleted", bigquery, out_dir, output)
+
+
+def upload_deleted_csv(df, filename, bg_upload_type, bg_project_id, bg_data_set, bg_table_name, spool_dir=None):
+
+    if bg_table_name:
+        filename = bg_table_name
+        bg_upload_type = "append"
+
+    start = time.time()
+    filename = base_name(filename)
+    if type(df) is str and spool_dir:
+        stage_file(df, f'{bg_data_set}.{filename}_deleted', bg_upload_type, file_schema(df, ["pmid"]), spool_dir)
+    elif type(df) is str:
+        load_file(df, f'{bg_data_set}.{filename}_deleted', bg_project_id, bg_upload_type,
+                  schema=file_schema(df, ["pmid"]))
+    else:
+        import pandas_gbq
+
+        pandas_gbq.to_gbq(dataframe=df, destination_table=f'{bg_data_set}.{filename}_deleted',
+                          project_id=bg_project_id, if_exists=bg_upload_type)
+
+    return time.time() - start
+
+
+def upload_mesh_csv(df, filename, bg_upload_type, bg_project_id, bg_data_set, bg_table_name, spool_dir=None,
+                    table_spec=None, schema=None):
 
     if bg_table_name:
         filename = bg_table_name
         bg_upload_type = 'append'
 
     start = time.time()
-    filename = filename.rstrip(".xml")
-    pandas_gbq.to_gbq(dataframe=df, destination_table=f'{bg_data_set}.{filename}_mesh',
-                      project_id=bg_project_id, if_exists=bg_upload_type)
+    filename = base_name(filename)
+    if type(df) is str and spool_dir:
+        stage_file(df, f'{bg_data_set}.{filename}_mesh', bg_upload_type, schema, spool_dir, table_spec)
+    elif type(df) is str:
+        load_file(df, f'{bg_data_set}.{filename}_mesh', bg_project_id, bg_upload_type, schema,
+                  table_spec=table_spec)
+    else:
+        import pandas_gbq
+
+        pandas_gbq.to_gbq(dataframe=df, destination_table=f'{bg_data_set}.{filename}_mesh',
+                          project_id=bg_project_id, if_exists=bg_upload_type)
 
     return time.time() - start
 
 
-def upload_csv(df, filename, bg_upload_type, bg_project_id, bg_data_set, bg_table_name):
+def upload_csv(df, filename, bg_upload_type, bg_project_id, bg_data_set, bg_table_name, spool_dir=None,
+               table_spec=None, schema=None):
 
     if bg_table_name:
         filename = bg_table_name
         bg_upload_type = "append"
 
     start = time.time()
-    filename = filename.rstrip(".xml")
-    pandas_gbq.to_gbq(dataframe=df, destination_table=f'{bg_data_set}.{filename}',
-                      project_id=bg_project_id, if_exists=bg_upload_type)
+    filename = base_name(filename)
+    if type(df) is str and spool_dir:
+        stage_file(df, f'{bg_data_set}.{filename}', bg_upload_type, schema, spool_dir, table_spec)
+    elif type(df) is str:
+        load_file(df, f'{bg_data_set}.{filename}', bg_project_id, bg_upload_type, schema,
+                  table_spec=table_spec)
+    else:
+        import pandas_gbq
+
+        pandas_gbq.to_gbq(dataframe=df, destination_table=f'{bg_data_set}.{filename}',
+                          project_id=bg_project_id, if_exists=bg_upload_type)
+
+    return time.time() - start
+
+
+def upload_nested(path, filename, bigquery, bg_upload_type, bg_project_id, bg_data_set, bg_table_name,
+                  spool_dir=None):
+    if not bigquery:
+        return 0
+
+    if bg_table_name:
+        filename = bg_table_name
+        bg_upload_type = "append"
+
+    print("Uploading to BQ...")
+    start = time.time()
+    filename = base_name(filename)
+    if spool_dir:
+        stage_file(path, f'{bg_data_set}.{filename}_nested', bg_upload_type, NESTED_SCHEMA, spool_dir)
+    else:
+        load_file(path, f'{bg_data_set}.{filename}_nested', bg_project_id, bg_upload_type, schema=NESTED_SCHEMA)
+
+    return time.time() - start
+
+
+def upload_star(paths, filename, bigquery, bg_upload_type, bg_project_id, bg_data_set, bg_table_name, spool_dir=None):
+    # <table>_articles, <table>_authors, ... and <table>_dim_journals, ... get one load job per output
+    if not bigquery:
+        return 0
+
+    if bg_table_name:
+        filename = bg_table_name
+        bg_upload_type = "append"
+
+    print("Uploading to BQ...")
+    start = time.time()
+    filename = base_name(filename)
+    for table, path in paths.items():
+        schema = file_schema(path, output_columns(table))
+        if spool_dir:
+            stage_file(path, f'{bg_data_set}.{filename}_{table}', bg_upload_type, schema, spool_dir)
+        else:
+            load_file(path, f'{bg_data_set}.{filename}_{table}', bg_project_id, bg_upload_type, schema)
 
     return time.time() - start
@@ -0,0 +1,375 @@
+import os
+import json
+import gzip
+import time
+import random
+import hashlib
+import sqlite3
+import itertools
+import logging
+import threading
+from shutil import move
+from datetime import datetime
+import metrics
+
+logging.basicConfig(filename="logs.log", filemode='a', format='%(name)s - %(levelname)s - %(message)s')
+
+SETTINGS_FILE = "_load.json"
+staged = []  # files staged by this process, run() hands them to the manifest
+before_staged = None  # set by run(), called with the spool path of a file before the uploads can see it
+
+
+def dataset_location(client, destination):
+    # jobs live in the location of their dataset, they can only be looked up there
+    from google.api_core.exceptions import NotFound
+
+    try:
+        return client.get_dataset(destination.rsplit(".", 1)[0]).location
+    except NotFound:
+        return None
+
+
+def run_load_job(client, job_id, location, start):
+    # A job with this id may have been started by an earlier try whose answer got lost, so it is looked up first:
+    # one that is still running is waited for, one that finished without errors has loaded the rows already, and
+    # one that failed loaded nothing, the next id is tried. Only an id that was never used starts a new job.
+    from google.api_core.exceptions import NotFound
+
+    for number in itertools.count():
+        attempt_id = job_id if number == 0 else f"{job_id}_{number}"
+        try:
+            job = client.get_job(attempt_id, location=location)
+        except NotFound:
+            return start(attempt_id).result()
+
+        if job.state != "DONE":
+            return job.result()
+        if job.error_result is None:
+            return job
+
+
+def load_file(path, destination_table, bg_project_id, bg_upload_type, schema=None, client=None, table_spec=None,
+              job_id=None):
+    from google.cloud import bigquery as bq
+
+    client = client or bq.Client(project=bg_project_id)
+    dispositions = {"append": bq.WriteDisposition.WRITE_APPEND, "replace": bq.WriteDisposition.WRITE_TRUNCATE,
+                    "fail": bq.WriteDisposition.WRITE_EMPTY}
+
+    job_config = bq.LoadJobConfig(write_disposition=dispositions.get(bg_upload_type, bq.WriteDisposition.WRITE_EMPTY))
+    if path.endswith(".parquet"):
+        job_config.source_format = bq.SourceFormat.PARQUET
+        if hasattr(bq, "ParquetOptions"):
+            job_config.parquet_options = bq.ParquetOptions()
+            job_config.parquet_options.enable_list_inference = True
+    elif path.endswith((".json", ".json.gz")):
+        job_config.source_format = bq.SourceFormat.NEWLINE_DELIMITED_JSON
+    else:
+        # gzip compressed csv is detected by BigQuery itself. The types come from the schema the caller passes,
+        # guessing them from every batch would give a table different ones than pandas_gbq does
+        job_config.source_format = bq.SourceFormat.CSV
+        job_config.skip_leading_rows = 1
+
+    if schema is not None:
+        job_config.schema = [bq.SchemaField.from_api_repr(field) for field in schema]
+
+    # a new table is created partitioned and clustered, an existing one has to have the same spec already
+    if table_spec and table_spec.get("range_partitioning"):
+        spec = table_spec["range_partitioning"]
+        job_config.range_partitioning = bq.RangePartitioning(
+            field=spec["field"], range_=bq.PartitionRange(start=spec["start"], end=spec["end"],
+                                                          interval=spec["interval"]))
+    if table_spec and table_spec.get("clustering_fields"):
+        job_config.clustering_fields = table_spec["clustering_fields"]
+
+    destination = f"{bg_project_id}.{destination_table}"
+
+    def start(attempt_id=None):
+        with open(path, "rb") as file:
+            return client.load_table_from_file(file, destination, job_id=attempt_id, job_config=job_config)
+
+    if job_id:
+        run_load_job(client, job_id, dataset_location(client, destination), start)
+    else:
+        start().result()
+
+
+class BigQueryBackend:
+    # One client for every load job, so credentials are only looked up and refreshed once per process
+    def __init__(self, bg_project_id):
+        self.bg_project_id = bg_project_id
+        self.client = None
+        self.lock = threading.Lock()
+
+    def get_client(self):
+        from google.cloud import bigquery as bq
+
+        with self.lock:
+            if self.client is None:
+                self.client = bq.Client(project=self.bg_project_id)
+            return self.client
+
+    def load(self, destination_table, path, bg_upload_type, schema=None, table_spec=None, job_id=None):
+        load_file(path, destination_table, self.bg_project_id, bg_upload_type, schema, self.get_client(), table_spec,
+                  job_id)
+
+
+class SQLiteBackend:
+    # Local stand-in for BigQuery: every destination table becomes a table of one SQLite database
+    def __init__(self, path):
+        self.path = path
+
+    def load(self, destination_table, path, bg_upload_type, schema=None, table_spec=None, job_id=None):
+        # SQLite has no partitions or clustering and its loads are transactions, table_spec and job_id only matter
+        # to BigQuery
+        df = read_file(path)
+
+        # REPEATED fields of the nested layout are kept as json text
+        for column in df.columns:
+            if df[column].map(lambda value: isinstance(value, (list, dict))).any():
+                df[column] = df[column].map(json.dumps)
+
+        connection = sqlite3.connect(self.path)
+        try:
+            if_exists = bg_upload_type if bg_upload_type in ("append", "replace") else "fail"
+            df.to_sql(destination_table, connection, if_exists=if_exists, index=False)
+        finally:
+            connection.close()
+
+
+def get_backend(name, bg_project_id, sqlite_path):
+    if name == "sqlite":
+        return SQLiteBackend(sqlite_path)
+    return BigQueryBackend(bg_project_id)
+
+
+def read_file(path):
+    import pandas as pd
+
+    if path.endswith(".parquet"):
+        return pd.read_parquet(path)
+    if path.endswith((".json", ".json.gz")):
+        return pd.read_json(path, lines=True, dtype=False)
+    return pd.read_csv(path, dtype=str, keep_default_na=False)
+
+
+def file_extension(path):
+    for extension in (".csv.gz", ".json.gz", ".parquet", ".csv", ".json"):
+        if path.endswith(extension):
+            return extension
+    return os.path.splitext(path)[1]
+
+
+def transient(error):
+    # Server errors, rate limits and lost connections are worth another try. A bad schema, a missing table or
+    # anything else wrong with the request itself fails the same way every time.
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    if isinstance(error, sqlite3.OperationalError):
+        # the stand-in is only busy for a while, "no such table" or a column mismatch stay
+        return "locked" in str(error) or "busy" in str(error)
+
+    try:
+        import requests
+        if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+            return True
+    except ImportError:
+        pass
+
+    try:
+        from google.api_core import exceptions
+    except ImportError:
+        return False
+    if isinstance(error, (exceptions.RetryError, exceptions.TooManyRequests, exceptions.ServerError)):
+        return True
+    # failed jobs report their rate limits as 403
+    reasons = {item.get("reason") for item in getattr(error, "errors", None) or [] if isinstance(item, dict)}
+    return isinstance(error, exceptions.Forbidden) and bool(reasons & {"rateLimitExceeded", "backendError"})
+
+
+def retry(function, retries, backoff_seconds, max_backoff_seconds):
+    # Exponential backoff with full jitter, so upload threads that failed together don't retry together
+    for attempt in range(retries + 1):
+        try:
+            return function()
+        except Exception as e:
+            if attempt == retries or not transient(e):
+                raise
+
+            delay = random.uniform(0, min(max_backoff_seconds, backoff_seconds * 2 ** attempt))
+            logging.warning(f"Load failed, retry {attempt + 1} of {retries} in {round(delay, 2)} secs: {e}")
+            time.sleep(delay)
+
+
+def batch_job_id(destination_table, files):
+    # The same staged files get the same id on every try and in every later run, files staged again get a new one
+    digest = hashlib.sha256(destination_table.encode("utf-8"))
+    for path in sorted(files):
+        stat = os.stat(path)
+        digest.update(f"{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns}".encode("utf-8"))
+    return f"pubmed_load_{digest.hexdigest()[:40]}"
+
+
+def stage_file(path, destination_table, bg_upload_type, schema, spool_dir, table_spec=None):
+    # Moves a finished output into spool_dir/<dataset.table>/, where Uploader picks it up
+    folder = os.path.join(spool_dir, destination_table)
+    os.makedirs(folder, exist_ok=True)
+
+    settings = os.path.join(folder, SETTINGS_FILE)
+    temporary = f"{settings}.{os.getpid()}"
+    with open(temporary, "w", encoding="utf-8") as file:
+        json.dump({"destination_table": destination_table, "bg_upload_type": bg_upload_type, "schema": schema,
+                   "table_spec": table_spec}, file)
+    os.replace(temporary, settings)
+
+    # moved under a hidden name first, so a half copied file is never picked up by pending_files
+    staged_path = os.path.join(folder, os.path.basename(path))
+    hidden = os.path.join(folder, "." + os.path.basename(path))
+    move(path, hidden)
+    if before_staged:
+        before_staged(staged_path)
+    os.replace(hidden, staged_path)
+    staged.append(staged_path)
+    return staged_path
+
+
+def pending_files(spool_dir):
+    pending = {}
+    if not os.path.isdir(spool_dir):
+        return pending
+
+    for destination_table in sorted(os.listdir(spool_dir)):
+        folder = os.path.join(spool_dir, destination_table)
+        if not os.path.isdir(folder):
+            continue
+
+        files = [os.path.join(folder, name) for name in sorted(os.listdir(folder))
+                 if not name.startswith(("_", "."))]
+        if files:
+            pending[destination_table] = files
+
+    return pending
+
+
+def combine_files(paths, combined):
+    # One load job per batch: the staged files are merged into a single file of the same format
+    extension = file_extension(paths[0])
+
+    if extension == ".parquet":
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        tables = [pq.read_table(path) for path in paths]
+        try:
+            table = pa.concat_tables(tables, promote_options="default")
+        except TypeError:
+            table = pa.concat_tables(tables, promote=True)
+        pq.write_table(table, combined, compression="zstd")
+        return combined
+
+    opener = gzip.open if extension.endswith(".gz") else open
+    with opener(combined, "wt", encoding="utf-8", newline="") as out:
+        for number, path in enumerate(paths):
+            with opener(path, "rt", encoding="utf-8", newline="") as file:
+                if extension.startswith(".csv") and number > 0:
+                    file.readline()  # header is only kept from the first file
+                for line in file:
+                    out.write(line)
+
+    return combined
+
+
+class Uploader:
+    def __init__(self, backend, spool_dir, max_files=50, max_mb=1024, on_loaded=None, retries=5, backoff_seconds=2,
+                 max_backoff_seconds=120, metrics_path=None):
+        self.backend = backend
+        self.on_loaded = on_loaded
+        self.spool_dir = spool_dir
+        self.max_files = max_files
+        self.max_bytes = max_mb * 1024 * 1024
+        self.retries = retries
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.metrics_path = metrics_path
+
+        # files already taken by a flush running in another upload thread
+        self.lock = threading.Lock()
+        self.claimed = set()
+
+    def batches(self, files, force):
+        batch, size = [], 0
+        for path in files:
+            batch.append(path)
+            size += os.path.getsize(path)
+            if len(batch) >= self.max_files or size >= self.max_bytes:
+                yield batch
+                batch, size = [], 0
+
+        if batch and force:
+            yield batch
+
+    def load_batch(self, destination_table, files):
+        folder = os.path.join(self.spool_dir, destination_table)
+        with open(os.path.join(folder, SETTINGS_FILE), "r", encoding="utf-8") as file:
+            settings = json.load(file)
+
+        start = time.time()
+        job_id = batch_job_id(destination_table, files)
+        if len(files) == 1:
+            path = files[0]
+        else:
+            path = combine_files(files, os.path.join(folder, f"_combined_{threading.get_ident()}"
+                                                             f"{file_extension(files[0])}"))
+
+        try:
+            retry(lambda: self.backend.load(destination_table, path, settings.get("bg_upload_type"),
+                                            settings.get("schema"), settings.get("table_spec"), job_id),
+                  self.retries, self.backoff_seconds, self.max_backoff_seconds)
+        finally:
+            if path not in files:
+                os.remove(path)
+
+        for path in files:
+            os.remove(path)
+
+        return time.time() - start
+
+    def claim(self, force):
+        with self.lock:
+            claimed = []
+            for destination_table, files in pending_files(self.spool_dir).items():
+                files = [path for path in files if path not in self.claimed]
+                for batch in self.batches(files, force):
+                    self.claimed.update(batch)
+                    claimed.append((destination_table, batch))
+
+            return claimed
+
+    def flush(self, force=False):
+        # Without force only full batches are loaded, the rest waits for more files
+        loaded = []
+        for destination_table, batch in self.claim(force):
+            sizes = [os.path.getsize(path) for path in batch]
+            try:
+                seconds = self.load_batch(destination_table, batch)
+            except Exception as e:
+                # the files stay in the spool, the next flush or "main.py upload-pending" loads them
+                logging.exception(f"Exception occurred! {e}")
+                print(f"Loading {len(batch)} file(s) into {destination_table} failed, they are kept in the spool")
+                continue
+            finally:
+                with self.lock:
+                    self.claimed.difference_update(batch)
+
+            if self.on_loaded:
+                self.on_loaded(batch)
+            if self.metrics_path:
+                metrics.write(self.metrics_path, {"event": "load", "destination_table": destination_table,
+                                                  "files": len(batch), "bytes": sum(sizes),
+                                                  "seconds": round(seconds, 4),
+                                                  "run_date": datetime.now().strftime("%m/%d/%Y, %H:%M:%S")})
+
+            loaded.append((destination_table, batch, seconds))
+            print(f"Loaded {len(batch)} file(s) into {destination_table} in {round(seconds, 2)} secs")
+
+        return loaded
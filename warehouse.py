@@ -0,0 +1,237 @@
+import os
+import csv
+import sys
+import sqlite3
+import argparse
+import threading
+import logging
+from schema import TABLE_COLUMNS, CREATE_TABLES, INSERT_QUERIES
+from xml_files import base_name
+
+logging.basicConfig(filename="logs.log", filemode='a', format='%(name)s - %(levelname)s - %(message)s')
+
+ARTICLES = "pm_ext_articles_revised_journals"
+MESH = "pm_ext_mesh_headings"
+AUTHORS = "pm_ext_authors_affiliations"
+
+# Secondary indexes and full text indexes, (name, table, column)
+INDEXES = [("mesh_descriptor_uid", MESH, "descriptor_uid"), ("articles_nlm_uid", ARTICLES, "nlm_uid")]
+FULL_TEXT = [("articles_fts", ARTICLES, "article_title", "pmid"), ("affiliations_fts", AUTHORS, "affiliation", "rowid")]
+
+
+def hand_off(spool_dir, filename, deleted, connection=None, rows=None):
+    # Written by the parse worker: the rows of one file, from its temporary database or from the rows the columnar
+    # engine collected, and the PMIDs it deletes. Only the finished file gets a visible name, the warehouse never
+    # takes one that is still being written.
+    os.makedirs(spool_dir, exist_ok=True)
+    name = f"{base_name(filename)}.db"
+    hidden, path = os.path.join(spool_dir, f".{name}"), os.path.join(spool_dir, name)
+    for stale in (hidden, path):
+        if os.path.exists(stale):
+            os.remove(stale)
+
+    target = sqlite3.connect(hidden)
+    try:
+        if connection is not None:
+            connection.backup(target)
+        else:
+            with target:
+                for table, statement in CREATE_TABLES.items():
+                    target.execute(statement)
+                    target.executemany(INSERT_QUERIES[table], rows[table])
+        with target:
+            target.execute("CREATE TABLE handoff(filename TEXT)")
+            target.execute("INSERT INTO handoff VALUES (?)", (filename,))
+            target.execute("CREATE TABLE deleted(pmid INTEGER PRIMARY KEY)")
+            target.executemany("INSERT OR IGNORE INTO deleted VALUES (?)", [(pmid,) for pmid in deleted or ()])
+    finally:
+        target.close()
+
+    os.replace(hidden, path)
+    return path
+
+
+def connect(path):
+    connection = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+    connection.execute("PRAGMA journal_mode = WAL")
+    connection.execute("PRAGMA synchronous = NORMAL")
+    for statement in CREATE_TABLES.values():
+        connection.execute(statement.replace("CREATE TABLE", "CREATE TABLE IF NOT EXISTS", 1))
+    # which file the current version of every PMID came from, deleted ones are kept as tombstones
+    connection.execute("CREATE TABLE IF NOT EXISTS sources(pmid INTEGER PRIMARY KEY, filename TEXT, "
+                       "deleted INTEGER DEFAULT 0)")
+    return connection
+
+
+class Warehouse:
+    # One long lived SQLite database with every file that was converted. Parse workers only write hand off files,
+    # this process is the single writer that merges them, so the workers never wait for each other's locks.
+    def __init__(self, path, spool_dir, full_text=True):
+        self.path = path
+        self.spool_dir = spool_dir
+        self.full_text = full_text
+        self.lock = threading.Lock()
+        os.makedirs(spool_dir, exist_ok=True)
+        connect(path).close()
+
+    def pending(self):
+        return sorted(name for name in os.listdir(self.spool_dir)
+                      if name.endswith(".db") and not name.startswith("."))
+
+    def flush(self):
+        # Called from the upload threads after every file; whoever holds the lock takes the files that came meanwhile
+        if not self.lock.acquire(blocking=False):
+            return 0
+        merged = 0
+        try:
+            connection = connect(self.path)
+            try:
+                while True:
+                    names = self.pending()
+                    if not names:
+                        break
+                    for name in names:
+                        try:
+                            self.merge(connection, os.path.join(self.spool_dir, name))
+                            merged += 1
+                        except Exception as e:
+                            logging.exception(f"Exception occurred! {e}")
+                            print(f"{name} could not be merged into {self.path}, it is kept in {self.spool_dir}")
+                            return merged
+            finally:
+                connection.close()
+        finally:
+            self.lock.release()
+        return merged
+
+    def merge(self, connection, path):
+        # A PMID is taken from this file unless a later file (by name, as PubMed numbers its updates) already
+        # brought a newer version; files merged in any order end up the same
+        connection.execute("ATTACH DATABASE ? AS handoff", (path,))
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                filename = connection.execute("SELECT filename FROM handoff.handoff").fetchone()[0]
+                connection.execute("CREATE TEMP TABLE take(pmid INTEGER PRIMARY KEY)")
+                connection.execute(f"INSERT INTO take SELECT pmid FROM handoff.{ARTICLES} UNION "
+                                   f"SELECT pmid FROM handoff.deleted")
+                connection.execute("DELETE FROM take WHERE pmid IN (SELECT pmid FROM sources WHERE filename > ?)",
+                                   (filename,))
+
+                for table, columns in TABLE_COLUMNS.items():
+                    connection.execute(f"DELETE FROM main.{table} WHERE pmid IN (SELECT pmid FROM take)")
+                    connection.execute(f"INSERT OR IGNORE INTO main.{table}({', '.join(columns)}) "
+                                       f"SELECT {', '.join(columns)} FROM handoff.{table} "
+                                       f"WHERE pmid IN (SELECT pmid FROM take) AND pmid NOT IN "
+                                       f"(SELECT pmid FROM handoff.deleted)")
+                connection.execute("INSERT OR REPLACE INTO sources(pmid, filename, deleted) "
+                                   "SELECT pmid, ?, pmid IN (SELECT pmid FROM handoff.deleted) FROM take", (filename,))
+                connection.execute("DROP TABLE temp.take")
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+        finally:
+            connection.execute("DETACH DATABASE handoff")
+        os.remove(path)
+
+    def finish(self):
+        # Indexes are built once the rows are in, which is cheaper than keeping them up to date row by row
+        self.flush()
+        with self.lock:
+            connection = connect(self.path)
+            try:
+                for name, table, column in INDEXES:
+                    connection.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table}({column})")
+
+                if self.full_text:
+                    try:
+                        for name, table, column, rowid in FULL_TEXT:
+                            create_full_text(connection, name, table, column, rowid)
+                    except sqlite3.OperationalError as e:
+                        print(f"No full text index in {self.path}, this SQLite has no FTS5: {e}")
+
+                articles = connection.execute(f"SELECT count(*) FROM {ARTICLES}").fetchone()[0]
+                print(f"{self.path}: {articles} articles")
+            finally:
+                connection.close()
+
+
+def create_full_text(connection, name, table, column, rowid):
+    # Filled from its table once, when it's created; from then on the triggers keep it in step with every merge, so
+    # a small update file doesn't reindex the whole warehouse
+    if connection.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (name,)).fetchone():
+        return
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        connection.execute(f"CREATE VIRTUAL TABLE {name} USING fts5({column}, content='{table}', "
+                           f"content_rowid='{rowid}')")
+        connection.execute(f"CREATE TRIGGER {name}_insert AFTER INSERT ON {table} BEGIN "
+                           f"INSERT INTO {name}(rowid, {column}) VALUES (new.{rowid}, new.{column}); END")
+        connection.execute(f"CREATE TRIGGER {name}_delete AFTER DELETE ON {table} BEGIN "
+                           f"INSERT INTO {name}({name}, rowid, {column}) VALUES ('delete', old.{rowid}, old.{column}); "
+                           f"END")
+        connection.execute(f"INSERT INTO {name}({name}) VALUES ('rebuild')")
+        connection.execute("COMMIT")
+    except Exception:
+        connection.execute("ROLLBACK")
+        raise
+
+
+def query_arguments(args):
+    parser = argparse.ArgumentParser(prog="main.py query", description="Looks articles up in the local warehouse")
+    parser.add_argument("--mesh", action="append", default=[], help="MeSH descriptor UI, every one has to match")
+    parser.add_argument("--affiliation", help="full text match on the affiliations")
+    parser.add_argument("--title", help="full text match on the article titles")
+    parser.add_argument("--journal", help="NLM unique id of the journal")
+    parser.add_argument("--sql", help="any read only query instead")
+    parser.add_argument("--limit", type=int, default=100, help="0 for every row")
+    return parser.parse_args(args)
+
+
+def build_query(options):
+    conditions, parameters = [], []
+    for descriptor_uid in options.mesh:
+        conditions.append(f"pmid IN (SELECT pmid FROM {MESH} WHERE descriptor_uid = ?)")
+        parameters.append(descriptor_uid)
+    if options.affiliation:
+        conditions.append(f"pmid IN (SELECT {AUTHORS}.pmid FROM affiliations_fts JOIN {AUTHORS} "
+                          f"ON {AUTHORS}.rowid = affiliations_fts.rowid WHERE affiliations_fts MATCH ?)")
+        parameters.append(options.affiliation)
+    if options.title:
+        conditions.append("pmid IN (SELECT rowid FROM articles_fts WHERE articles_fts MATCH ?)")
+        parameters.append(options.title)
+    if options.journal:
+        conditions.append("nlm_uid = ?")
+        parameters.append(options.journal)
+
+    query = f"SELECT pmid, article_title, year, title, nlm_uid FROM {ARTICLES}"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY pmid"
+    if options.limit:
+        query += f" LIMIT {int(options.limit)}"
+    return query, parameters
+
+
+def query(path, args):
+    options = query_arguments(args)
+    if not path or not os.path.exists(path):
+        print(f"No warehouse at {path}, set \"warehouse\" and convert some files first")
+        return
+
+    if options.sql:
+        statement, parameters = options.sql, []
+    else:
+        statement, parameters = build_query(options)
+
+    connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        cursor = connection.execute(statement, parameters)
+        writer = csv.writer(sys.stdout)
+        writer.writerow([column[0] for column in cursor.description])
+        writer.writerows(cursor)
+    except sqlite3.OperationalError as e:
+        print(f"Query failed: {e}")
+    finally:
+        connection.close()
@@ -0,0 +1,119 @@
+import os
+import time
+import select
+import signal
+import ctypes
+import ctypes.util
+import logging
+from xml_files import is_xml_file
+
+logging.basicConfig(filename="logs.log", filemode='a', format='%(name)s - %(levelname)s - %(message)s')
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+
+class Inotify:
+    # Linux only, through libc, so there is nothing extra to install
+    def __init__(self, path):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        if libc.inotify_add_watch(self.fd, os.fsencode(path), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, f"inotify_add_watch failed for {path}")
+
+    def wait(self, timeout):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        try:
+            while os.read(self.fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+        return bool(readable)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Poller:
+    def wait(self, timeout):
+        time.sleep(timeout)
+        return False
+
+    def close(self):
+        pass
+
+
+def open_watcher(in_dir):
+    try:
+        return Inotify(in_dir)
+    except (OSError, AttributeError, TypeError) as e:
+        # not linux, no libc found or out of inotify watches
+        logging.warning(f"inotify not available, polling {in_dir} instead: {e}")
+        return Poller()
+
+
+def ready_files(in_dir, settle_seconds, failed):
+    # A file is taken once it hasn't changed for settle_seconds; hidden names are downloads still in progress
+    ready, settling = [], False
+    for filename in sorted(os.listdir(in_dir)):
+        if filename.startswith(".") or not is_xml_file(filename):
+            continue
+
+        try:
+            stat = os.stat(os.path.join(in_dir, filename))
+        except FileNotFoundError:
+            continue
+
+        signature = (stat.st_size, stat.st_mtime)
+        if failed.get(filename) == signature:
+            continue  # tried before and failed, only taken again once the file changes
+
+        if time.time() - stat.st_mtime < settle_seconds:
+            settling = True
+        else:
+            ready.append(filename)
+
+    return ready, settling
+
+
+def watch(in_dir, process, poll_seconds=5, settle_seconds=2):
+    # process(files) converts a list of files and moves them to converted_xml; whatever it leaves behind failed
+    stopping = []
+
+    def stop(signum, frame):
+        if stopping:
+            raise KeyboardInterrupt
+        stopping.append(signum)
+        print("Stopping once the files in progress are done, signal again to drop the ones still queued")
+
+    handlers = {number: signal.signal(number, stop) for number in (signal.SIGINT, signal.SIGTERM)}
+    watcher = open_watcher(in_dir)
+    failed = {}
+    print(f"Watching {in_dir} ({type(watcher).__name__.lower()}), Ctrl-C to stop")
+
+    try:
+        while not stopping:
+            files, settling = ready_files(in_dir, settle_seconds, failed)
+            if not files:
+                watcher.wait(min(settle_seconds, poll_seconds) if settling else poll_seconds)
+                continue
+
+            process(files)
+
+            for filename in files:
+                path = os.path.join(in_dir, filename)
+                if os.path.exists(path):
+                    stat = os.stat(path)
+                    failed[filename] = (stat.st_size, stat.st_mtime)
+                    print(f"{filename} failed, it is tried again once it changes")
+    finally:
+        watcher.close()
+        for number, handler in handlers.items():
+            signal.signal(number, handler)
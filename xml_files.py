@@ -0,0 +1,35 @@
+import gzip
+
+XML_EXTENSIONS = (".xml", ".xml.gz", ".xml.zst")
+
+
+def is_xml_file(filename):
+    return filename.endswith(XML_EXTENSIONS)
+
+
+def is_compressed(filename):
+    return filename.endswith((".gz", ".zst"))
+
+
+def base_name(filename):
+    # "pubmed21n0001.xml.gz" -> "pubmed21n0001", names without an xml extension are left as they are
+    for extension in XML_EXTENSIONS:
+        if filename.endswith(extension):
+            return filename[:-len(extension)]
+    return filename
+
+
+def open_xml(path):
+    # Binary stream of the xml, decompressed on the fly while the parser reads it
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+
+    if path.endswith(".zst"):
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("Reading .xml.zst files needs the zstandard package (pip install zstandard)")
+
+        return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True)
+
+    return open(path, "rb")